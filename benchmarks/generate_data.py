@@ -0,0 +1,104 @@
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pharmacy_journal import atomic_write_json, apply_sale_to_month, new_sale_id
+from pharmacy_storage import new_month_data
+
+WORDS = ['amoxi', 'para', 'ibu', 'cetiri', 'lora', 'omepra', 'metfor', 'atorva', 'simva', 'lisino',
+         'amlo', 'salbu', 'predni', 'dox', 'azithro', 'cipro', 'fluco', 'panto', 'sertra', 'vita']
+SUFFIXES = ['cillin', 'cetamol', 'profen', 'zine', 'tadine', 'zole', 'min', 'statin', 'pril', 'pine',
+            'mol', 'sone', 'cycline', 'mycin', 'floxacin', 'prazole', 'line', 'plex']
+
+
+def month_starts(months, end=None):
+    # The first day of each of the last `months` months, oldest first
+    end = end or datetime.now()
+    year, month = end.year, end.month
+    starts = []
+    for _ in range(months):
+        starts.append(datetime(year, month, 1))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return starts[::-1]
+
+
+def generate(data_dir, products=1000, sales=10000, months=12, skew=1.1, max_items=5, seed=42):
+    # Write a realistic dataset in the JSON storage layout: `products` SKUs,
+    # `sales` sales spread evenly over `months` monthly files, and product
+    # popularity following a Zipf-like distribution with exponent `skew`
+    rng = random.Random(seed)
+    Path(data_dir, 'monthly').mkdir(parents=True, exist_ok=True)
+
+    catalogue = {}
+    for index in range(products):
+        code = f"{index + 1:06d}"
+        name = f"{rng.choice(WORDS)}{rng.choice(SUFFIXES)} {rng.choice([5, 10, 20, 50, 100, 250, 500])}mg"
+        catalogue[code] = {
+            'name': name,
+            'price': round(rng.uniform(1, 80), 2),
+            'quantity': rng.randint(0, 500)
+        }
+    codes = list(catalogue)
+    weights = [1 / (rank + 1) ** skew for rank in range(products)]
+    rng.shuffle(codes)
+
+    starts = month_starts(months)
+    ends = starts[1:] + [min(datetime.now(), starts[-1] + timedelta(days=31))]
+    per_month = [sales // months + (1 if index < sales % months else 0) for index in range(months)]
+
+    all_sales = []
+    for start, end, count in zip(starts, ends, per_month):
+        month = start.strftime("%Y-%m")
+        monthly_data = new_month_data(month)
+        span = max(1, int((end - start).total_seconds()) - 1)
+        offsets = sorted(rng.randrange(span) for _ in range(count))
+        for offset in offsets:
+            basket = {}
+            for code in rng.choices(codes, weights, k=rng.randint(1, max_items)):
+                basket[code] = basket.get(code, 0) + rng.randint(1, 3)
+            items = []
+            for code, quantity in basket.items():
+                product = catalogue[code]
+                items.append({
+                    'code': code,
+                    'name': product['name'],
+                    'quantity': quantity,
+                    'price': product['price'],
+                    'amount': quantity * product['price']
+                })
+            sale = {
+                'id': new_sale_id(),
+                'date': (start + timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M:%S"),
+                'items': items,
+                'total': sum(item['amount'] for item in items)
+            }
+            all_sales.append(sale)
+            apply_sale_to_month(monthly_data, sale)
+        atomic_write_json(os.path.join(data_dir, 'monthly', f'{month}.json'), monthly_data)
+
+    atomic_write_json(os.path.join(data_dir, 'products.json'), catalogue)
+    atomic_write_json(os.path.join(data_dir, 'sales.json'), all_sales)
+    return catalogue, all_sales
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic pharmacy dataset")
+    parser.add_argument('data_dir')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--sales', type=int, default=10000)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent of product popularity")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    generate(args.data_dir, args.products, args.sales, args.months, args.skew, seed=args.seed)
+    print(f"Wrote {args.products} products and {args.sales} sales over {args.months} months to {args.data_dir}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
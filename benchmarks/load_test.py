@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate_data import generate
+from run_benchmarks import percentile, git_commit
+from pharmacy_client import ServerConnection
+from pharmacy_journal import new_sale_id
+
+
+def start_server(data_dir):
+    # A real server process on a free port
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'pharmacy_server.py'), '--port', '0',
+                                '--data-dir', data_dir, '--no-backups'],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise RuntimeError(f"Server did not start: {line!r}")
+    return process, line.split()[-1]
+
+
+def run_till(address, codes, weights, sales, seed, results):
+    # One till: each sale reserves its items and completes in one pipelined
+    # round trip, the way a cart is rung up and paid
+    rng = random.Random(seed)
+    connection = ServerConnection(address)
+    latencies = []
+    sold = {}
+    rejected = 0
+    for _ in range(sales):
+        token = new_sale_id()
+        items = {}
+        for code in rng.choices(codes, weights, k=rng.randint(1, 3)):
+            items[code] = items.get(code, 0) + 1
+        requests = [('reserve', {'token': token, 'code': code, 'quantity': quantity})
+                    for code, quantity in items.items()]
+        requests.append(('sale', {'items': list(items.items()), 'token': token}))
+
+        start = time.perf_counter()
+        responses = connection.call_many(requests)
+        latencies.append(time.perf_counter() - start)
+
+        sale = responses[-1]
+        if sale['ok']:
+            for item in sale['result']['items']:
+                sold[item['code']] = sold.get(item['code'], 0) + item['quantity']
+        else:
+            rejected += 1
+            connection.call('release', token=token)
+    connection.close()
+    results.append((latencies, sold, rejected))
+
+
+def run_load(address, tills, sales_per_till, codes, weights, seed):
+    results = []
+    threads = [threading.Thread(target=run_till, args=(address, codes, weights, sales_per_till, seed + index, results))
+               for index in range(tills)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for till_latencies, _, _ in results for latency in till_latencies]
+    sold = {}
+    for _, till_sold, _ in results:
+        for code, quantity in till_sold.items():
+            sold[code] = sold.get(code, 0) + quantity
+    rejected = sum(till_rejected for _, _, till_rejected in results)
+    return {
+        'tills': tills,
+        'sales': len(latencies),
+        'rejected': rejected,
+        'throughput_per_s': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }, sold
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive pharmacy_server with many simulated tills")
+    parser.add_argument('--tills', default='1,4,16,64', help="Comma separated numbers of concurrent tills")
+    parser.add_argument('--sales', type=int, default=200, help="Sales per till")
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='pharmacy-load-')
+    data_dir = os.path.join(workdir, 'data')
+    catalogue, _ = generate(data_dir, args.products, 0, 1, seed=args.seed)
+    codes = list(catalogue)
+    # A few best sellers, so tills compete for the same stock
+    weights = [1 / (rank + 1) for rank in range(len(codes))]
+
+    process, address = start_server(data_dir)
+    report = {'commit': git_commit(), 'products': args.products, 'sales_per_till': args.sales, 'results': []}
+    try:
+        control = ServerConnection(address)
+        for tills in (int(count) for count in args.tills.split(',')):
+            print(f"Load testing with {tills} tills...", file=sys.stderr)
+            # Back to the generated stock levels, so every round starts alike
+            current = control.call('products')['products']
+            control.call_many([('restock', {'code': code, 'quantity': catalogue[code]['quantity'] - current[code]['quantity']})
+                               for code in codes if current[code]['quantity'] < catalogue[code]['quantity']])
+            before = control.call('products')['products']
+            commits_before = control.call('stats')['commits']
+            result, sold = run_load(address, tills, args.sales, codes, weights, args.seed)
+            after = control.call('products')['products']
+            commits = control.call('stats')['commits'] - commits_before
+
+            # Every unit sold must be gone from stock, and stock never negative
+            lost = [code for code in codes
+                    if after[code]['quantity'] != before[code]['quantity'] - sold.get(code, 0)]
+            oversold = [code for code in codes if after[code]['quantity'] < 0]
+            result['commits'] = commits
+            result['sales_per_commit'] = round((result['sales'] - result['rejected']) / commits, 2) if commits else None
+            result['consistent'] = not lost and not oversold
+            report['results'].append(result)
+        control.close()
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
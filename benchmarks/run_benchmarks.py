@@ -0,0 +1,292 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate_data import generate
+from pharmacy_storage import migrate
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(func, repeat, setup=None):
+    # Times `repeat` calls, then one more under tracemalloc for peak memory
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total = sum(samples)
+    return {
+        'runs': repeat,
+        'throughput_per_s': round(repeat / total, 2) if total else None,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def random_cart(rng, products):
+    codes = [code for code, product in products.items() if product['quantity'] > 0]
+    cart = []
+    for code in rng.sample(codes, min(3, len(codes))):
+        cart.append((code, 1))
+    return cart
+
+
+def bench_startup(args):
+    # Cold start in a fresh interpreter: imports, opening the storage and
+    # building the engine, which is what a till waits for before its window
+    script = ("import time; start = time.perf_counter(); "
+              "from pharmacy_storage import open_storage; from pharmacy_core import SalesEngine; "
+              "SalesEngine(open_storage()); print(time.perf_counter() - start)")
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True)
+        samples.append(float(output.stdout))
+    return {
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+    }
+
+
+def bench_headless(args, rng):
+    # Engine and storage paths, no Tk involved
+    from pharmacy_storage import open_storage
+    from pharmacy_core import SalesEngine
+    from pharmacy_backup import BackupManager
+    from pharmacy_system import PharmacySystem
+    from pharmacy_analytics import Analytics
+    from pharmacy_cart import Cart
+
+    results = {'startup': bench_startup(args)}
+    storage = None
+
+    def load():
+        # Reopen without closing: close() would checkpoint and be timed too
+        nonlocal storage
+        storage = open_storage()
+    results['load_data'] = measure(load, args.repeat)
+
+    results['save_data'] = measure(storage.checkpoint, args.repeat)
+
+    engine = SalesEngine(storage)
+    for product in storage.products.values():
+        product['quantity'] += 1000000
+    results['complete_sale'] = measure(lambda: engine.process_sale(random_cart(rng, storage.products)),
+                                       args.sale_repeat)
+
+    batch = [random_cart(rng, storage.products) for _ in range(100)]
+    results['process_sales_batch_100'] = measure(lambda: engine.process_sales_batch(batch), args.repeat)
+
+    bulk_codes = list(storage.products)[:500]
+
+    def bulk_order():
+        # A clinic order: up to 500 lines, each product entered twice
+        cart = Cart(engine)
+        for code in bulk_codes:
+            cart.add(code, 1)
+            cart.add(code, 1)
+        cart.checkout()
+    results['bulk_order'] = measure(bulk_order, args.repeat)
+
+    months = storage.list_months()
+
+    def monthly_report():
+        data = storage.month_summary(rng.choice(months))
+        sorted(data['products_sold'].items(), key=lambda x: x[1]['revenue'], reverse=True)[:10]
+    results['show_monthly_report'] = measure(monthly_report, args.repeat)
+
+    def range_report():
+        # A random span of up to three months, answered from the rollups
+        first, last = sorted(rng.sample(months, 2)) if len(months) > 1 else (months[0], months[0])
+        engine.sales_between(f"{first}-{rng.randint(1, 28):02d}", f"{last}-{rng.randint(1, 28):02d} 12")
+    results['sales_between'] = measure(range_report, args.repeat)
+
+    # Seal the finished months first, as a running till would have
+    engine.checkpoint()
+    analytics = Analytics(storage)
+    results['analytics'] = measure(analytics.report, args.repeat)
+
+    def purchase_suggestions():
+        # A full recompute: the demand matrix is read again from the history
+        engine.forecast = None
+        engine.purchase_suggestions()
+    results['purchase_suggestions'] = measure(purchase_suggestions, args.repeat)
+    # The whole history, as the Reports tab holds it; peak memory is its footprint
+    results['sales_history'] = measure(storage.get_sales, args.repeat)
+
+    engine.close()
+    storage = None
+
+    system = PharmacySystem()
+
+    def check_stock():
+        with redirect_stdout(io.StringIO()):
+            system.check_stock()
+    results['check_stock'] = measure(check_stock, args.repeat)
+
+    backups = BackupManager('backups', 'data')
+
+    def touch_and_backup():
+        # Change one file so every snapshot has something to store
+        system.engine.restock(next(iter(system.products)), 1)
+        system.engine.checkpoint()
+    results['auto_backup'] = measure(lambda: system.storage.backup(backups), args.repeat,
+                                     setup=touch_and_backup)
+    system.engine.close()
+    return results
+
+
+def bench_gui(args, rng):
+    # GUI paths against a withdrawn Tk root; skipped when there is no display
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+    except Exception as e:
+        return {'skipped': f"Tk unavailable: {e}"}
+    root.withdraw()
+
+    import pharmacy_gui
+    # Dialogs would block the benchmark
+    pharmacy_gui.messagebox.showinfo = lambda *a, **k: None
+    pharmacy_gui.messagebox.showerror = lambda *a, **k: None
+
+    results = {}
+    app = pharmacy_gui.PharmacyGUI(root)
+    # Runs the startup hook, which records the time to the first idle moment
+    root.update()
+    if app.startup_time is not None:
+        results['startup_ms'] = round(app.startup_time * 1000, 3)
+
+    def load():
+        app.load_data()
+        app.storage.auto_checkpoint = False
+    results['load_data'] = measure(load, args.repeat)
+    results['save_data'] = measure(app.save_data, args.repeat)
+
+    for product in app.products.values():
+        product['quantity'] += 1000000
+
+    def fill_cart():
+        app.cart.clear()
+        app.cart_tree.delete(*app.cart_tree.get_children())
+        for code, quantity in random_cart(rng, app.products):
+            app.sale_code_entry.delete(0, 'end')
+            app.sale_code_entry.insert(0, code)
+            app.sale_quantity_entry.delete(0, 'end')
+            app.sale_quantity_entry.insert(0, str(quantity))
+            app.add_to_cart()
+    results['complete_sale'] = measure(app.complete_sale, args.sale_repeat, setup=fill_cart)
+
+    months = app.storage.list_months()
+
+    def show_report():
+        month = rng.choice(months)
+        app.year_var.set(month[:4])
+        app.month_var.set(month[5:7])
+        app.show_monthly_report()
+    results['show_monthly_report'] = measure(show_report, args.repeat)
+    results['refresh_product_list'] = measure(app.refresh_product_list, args.repeat)
+    results['refresh_sales_report'] = measure(app.refresh_sales_report, args.repeat)
+
+    def backup():
+        app.prepare_backup()()
+    results['auto_backup'] = measure(backup, args.repeat)
+
+    app.persistence.flush()
+    app.engine.close()
+    root.destroy()
+    return results
+
+
+def run_size(products, sales, args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='pharmacy-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        generate('data', products, sales, args.months, seed=args.seed)
+        if args.storage == 'sqlite':
+            migrate('data', None, 'data/pharmacy.db')
+        os.environ['PHARMACY_STORAGE'] = args.storage
+
+        result = {'products': products, 'sales': sales, 'months': args.months}
+        result['headless'] = bench_headless(args, rng)
+        if not args.no_gui:
+            result['gui'] = bench_gui(args, rng)
+        return result
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pharmacy hot paths")
+    parser.add_argument('--sizes', default='100x1000,1000x10000,5000x50000',
+                        help="Comma separated PRODUCTSxSALES dataset sizes")
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per operation")
+    parser.add_argument('--sale-repeat', type=int, default=200, help="Runs for the sale paths")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--no-gui', action='store_true', help="Only run the headless benchmarks")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': args.storage,
+        'results': []
+    }
+    for size in args.sizes.split(','):
+        products, sales = (int(part) for part in size.lower().split('x'))
+        print(f"Benchmarking {products} products / {sales} sales...", file=sys.stderr)
+        report['results'].append(run_size(products, sales, args))
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import heapq
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pharmacy_archive import MonthArchive, load_numpy
+from pharmacy_storage import month_bounds
+from pharmacy_models import to_sale
+
+
+def new_partial(month):
+    # What one month contributes to a report; partials add up
+    return {
+        'month': month,
+        'revenue': 0,
+        'sales': 0,
+        'lines': 0,
+        'units': 0,
+        'largest_basket': 0,
+        'basket_lines': {},     # lines per sale -> number of sales
+        'products': {},         # code -> [quantity, revenue]
+        'names': {}
+    }
+
+
+def summarize_sales(month, sales):
+    # Partial for a month still held as sale dicts
+    # Money is added up in cents, as for archived months
+    partial = new_partial(month)
+    products = {}
+    for sale in map(to_sale, sales):
+        total = sale.total_cents
+        partial['revenue'] += total
+        partial['sales'] += 1
+        lines = sale.line_count
+        partial['lines'] += lines
+        partial['basket_lines'][lines] = partial['basket_lines'].get(lines, 0) + 1
+        partial['largest_basket'] = max(partial['largest_basket'], total)
+        for item in sale.items:
+            stats = products.setdefault(item.code, [0, 0])
+            stats[0] += item.quantity
+            stats[1] += item.amount_cents
+            partial['units'] += item.quantity
+            partial['names'][item.code] = item.name
+    partial['revenue'] /= 100
+    partial['largest_basket'] /= 100
+    partial['products'] = {code: [quantity, cents / 100] for code, (quantity, cents) in products.items()}
+    return partial
+
+
+def summarize_archived(directory, month):
+    # Partial for a sealed month, scanned column-wise. Runs in a worker
+    # process, so it only takes and returns plain data.
+    numpy = load_numpy()
+    archived = MonthArchive(directory).open(month)
+    partial = new_partial(month)
+    partial['names'] = {code: name for code, name in archived.products}
+    partial['products'] = archived.product_totals()
+    sale, quantity, price = archived.column('sale'), archived.column('quantity'), archived.column('price')
+    if numpy and archived.rows:
+        cents = quantity.astype('i8') * price
+        lines = numpy.bincount(sale)
+        lines = lines[lines > 0]
+        partial['revenue'] = int(cents.sum()) / 100
+        partial['sales'] = len(lines)
+        partial['lines'] = archived.rows
+        partial['units'] = int(quantity.sum())
+        partial['largest_basket'] = int(numpy.bincount(sale, cents).max()) / 100
+        counts = numpy.bincount(lines)
+        partial['basket_lines'] = {int(size): int(counts[size]) for size in numpy.flatnonzero(counts)}
+        return partial
+
+    baskets = {}
+    for row in range(archived.rows):
+        basket = baskets.setdefault(sale[row], [0, 0])
+        basket[0] += 1
+        basket[1] += quantity[row] * price[row]
+        partial['units'] += quantity[row]
+    for lines, cents in baskets.values():
+        partial['basket_lines'][lines] = partial['basket_lines'].get(lines, 0) + 1
+        partial['revenue'] += cents
+        partial['largest_basket'] = max(partial['largest_basket'], cents)
+    partial['revenue'] /= 100
+    partial['largest_basket'] /= 100
+    partial['sales'] = len(baskets)
+    partial['lines'] = archived.rows
+    return partial
+
+
+def merge(partials, catalogue=None):
+    # One report out of the monthly partials, in month order
+    report = {'months': {}, 'years': {}, 'products': {}, 'basket': {}}
+    basket_lines = {}
+    units = lines = largest = 0
+    for partial in sorted(partials, key=lambda partial: partial['month']):
+        month, year = partial['month'], partial['month'][:4]
+        report['months'][month] = {'revenue': partial['revenue'], 'sales': partial['sales']}
+        totals = report['years'].setdefault(year, {'revenue': 0, 'sales': 0})
+        totals['revenue'] += partial['revenue']
+        totals['sales'] += partial['sales']
+        for code, (quantity, revenue) in partial['products'].items():
+            product = report['products'].setdefault(code, {'name': partial['names'].get(code, code),
+                                                           'quantity': 0, 'revenue': 0, 'monthly': {}})
+            product['quantity'] += quantity
+            product['revenue'] += revenue
+            product['monthly'][month] = product['monthly'].get(month, 0) + quantity
+        for size, count in partial['basket_lines'].items():
+            size = int(size)
+            basket_lines[size] = basket_lines.get(size, 0) + count
+        units += partial['units']
+        lines += partial['lines']
+        largest = max(largest, partial['largest_basket'])
+
+    # Names from the current catalogue win over the ones sales were made with
+    for code, product in report['products'].items():
+        if catalogue and code in catalogue:
+            product['name'] = catalogue[code]['name']
+
+    previous = None
+    for year in sorted(report['years']):
+        totals = report['years'][year]
+        totals['growth'] = (totals['revenue'] / previous - 1) * 100 if previous else None
+        previous = totals['revenue']
+
+    sales = sum(basket_lines.values())
+    revenue = sum(totals['revenue'] for totals in report['years'].values())
+    report['basket'] = {
+        'sales': sales,
+        'average_value': revenue / sales if sales else 0,
+        'average_lines': lines / sales if sales else 0,
+        'average_units': units / sales if sales else 0,
+        'median_lines': median_of_counts(basket_lines),
+        'single_item_share': basket_lines.get(1, 0) / sales * 100 if sales else 0,
+        'largest_basket': largest
+    }
+    return report
+
+
+def median_of_counts(counts):
+    # Median of a {value: occurrences} histogram
+    total = sum(counts.values())
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen * 2 >= total:
+            return value
+    return 0
+
+
+def top_products(report, limit=10, by='revenue'):
+    # Heap selection: O(n log limit) instead of sorting every product
+    return heapq.nlargest(limit, report['products'].items(), key=lambda entry: entry[1][by])
+
+
+def product_trends(report, window=3, limit=10):
+    # Quantity sold in the last `window` months against the `window` before;
+    # returns the biggest risers and fallers as (code, product, change %)
+    months = sorted(report['months'])
+    recent, before = months[-window:], months[-2 * window:-window]
+    changes = []
+    for code, product in report['products'].items():
+        now = sum(product['monthly'].get(month, 0) for month in recent)
+        then = sum(product['monthly'].get(month, 0) for month in before)
+        if then:
+            changes.append((code, product, (now / then - 1) * 100))
+    risers = heapq.nlargest(limit, changes, key=lambda change: change[2])
+    fallers = heapq.nsmallest(limit, changes, key=lambda change: change[2])
+    return risers, fallers
+
+
+class Analytics:
+    # Reports over many months at once. Sealed months are scanned from the
+    # archive in a process pool, one month per task, and their partial
+    # results merged; the few open months are summarized from the storage's
+    # sales in this process so they include sales not checkpointed yet.
+
+    def __init__(self, storage, workers=None):
+        self.storage = storage
+        self.workers = workers or os.cpu_count() or 1
+
+    def prepare(self, first=None, last=None):
+        # Storage is read here, on the caller's thread; the returned run()
+        # summarizes and merges, and can go to a background thread
+        archive = getattr(self.storage, 'archive', None)
+        months = [month for month in self.storage.list_months()
+                  if (first is None or month >= first) and (last is None or month <= last)]
+        sealed = [month for month in months if archive and archive.has(month) and
+                  month not in getattr(self.storage, 'months', {})]
+        open_sales = [(month, self.storage.get_sales(*month_bounds(month))) for month in months
+                      if month not in sealed]
+        catalogue = {code: dict(product) for code, product in self.storage.products.items()}
+        directory = archive.directory if archive else None
+        workers = self.workers
+
+        def run():
+            partials = [summarize_sales(month, sales) for month, sales in open_sales]
+            if workers > 1 and len(sealed) > 1:
+                with ProcessPoolExecutor(max_workers=min(workers, len(sealed))) as pool:
+                    partials.extend(pool.map(summarize_archived, [directory] * len(sealed), sealed))
+            else:
+                partials.extend(summarize_archived(directory, month) for month in sealed)
+            return merge(partials, catalogue)
+        return run
+
+    def report(self, first=None, last=None):
+        return self.prepare(first, last)()
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Sales analytics across months")
+    parser.add_argument('--from', dest='first', help="First month, YYYY-MM")
+    parser.add_argument('--to', dest='last', help="Last month, YYYY-MM")
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--by', choices=['revenue', 'quantity'], default='revenue')
+    parser.add_argument('--workers', type=int, help="Worker processes (default: one per core)")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    storage = open_storage(data_dir=args.data_dir)
+    report = Analytics(storage, args.workers).report(args.first, args.last)
+    storage.close()
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+        return
+
+    print("=== Revenue by Year ===")
+    for year, totals in sorted(report['years'].items()):
+        growth = f"{totals['growth']:+.1f}%" if totals['growth'] is not None else '-'
+        print(f"{year}\t{totals['sales']} sales\t${totals['revenue']:.2f}\t{growth}")
+
+    print(f"\n=== Top {args.top} Products by {args.by.title()} ===")
+    for code, product in top_products(report, args.top, args.by):
+        print(f"{code}\t{product['name'][:20]}\t{product['quantity']}\t${product['revenue']:.2f}")
+
+    risers, fallers = product_trends(report, limit=5)
+    print("\n=== Trends (last 3 months vs the 3 before) ===")
+    for code, product, change in risers + fallers:
+        print(f"{code}\t{product['name'][:20]}\t{change:+.1f}%")
+
+    basket = report['basket']
+    print("\n=== Baskets ===")
+    print(f"Sales: {basket['sales']}")
+    print(f"Average value: ${basket['average_value']:.2f}")
+    print(f"Average lines: {basket['average_lines']:.2f} (median {basket['median_lines']})")
+    print(f"Average units: {basket['average_units']:.2f}")
+    print(f"Single-item sales: {basket['single_item_share']:.1f}%")
+    print(f"Largest basket: ${basket['largest_basket']:.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import mmap
+import array
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+from pharmacy_journal import atomic_write_json
+from pharmacy_metrics import metrics
+from pharmacy_models import Sale, product_id, shared_cents, to_sale, to_dicts
+from pharmacy_reports import top_products
+
+# NumPy, once looked for; False until then
+_numpy = False
+
+
+def load_numpy():
+    # NumPy or None. Imported on first use rather than with this module, so
+    # starting the GUI or the CLI does not pay for it; without it scans fall
+    # back to the standard library: same results, just slower.
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+EPOCH = datetime(1970, 1, 1)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# One row per sale line; (name, array typecode, bytes per value)
+COLUMNS = [
+    ('sale', 'i', 4),       # position of the sale in the .ids file
+    ('time', 'q', 8),       # seconds since 1970-01-01, local time
+    ('product', 'i', 4),    # position in the header's product list
+    ('quantity', 'i', 4),
+    ('price', 'q', 8),      # integer cents
+]
+DTYPES = {'i': '<i4', 'q': '<i8'}
+
+
+def full_date(date):
+    # "YYYY-MM-DD[ HH[:MM]]" -> "YYYY-MM-DD HH:MM:SS"; compares the same way
+    # against sale dates
+    return date + "0000-01-01 00:00:00"[len(date):]
+
+
+def to_seconds(date):
+    return int((datetime.strptime(full_date(date), DATE_FORMAT) - EPOCH).total_seconds())
+
+
+def to_date(seconds):
+    return (EPOCH + timedelta(seconds=int(seconds))).strftime(DATE_FORMAT)
+
+
+def month_files(directory, month, generation):
+    # {extension: path} of one generation of a month's data files. Each
+    # re-seal writes a new generation, so the header in place always names
+    # complete files; months sealed before generations were numbered are
+    # generation 0, with plain names.
+    stem = os.path.join(directory, f'{month}.{generation}' if generation else month)
+    return {extension: f'{stem}.{extension}' for extension in ('bin', 'ids', 'lots')}
+
+
+def atomic_write_bytes(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.count('bytes_written', len(data))
+    os.replace(tmp_path, path)
+
+
+class ArchivedMonth:
+    # A sealed month, read back from its three files:
+    #   YYYY-MM.N.bin   the columns above, each starting on an 8-byte boundary
+    #   YYYY-MM.N.ids   sale ids, one per line
+    #   YYYY-MM.json    header: generation N, row count, column offsets, the
+    #                   (code, name) product dictionary and the month's summary
+    # and YYYY-MM.N.lots when sales of lot-tracked products took place: the
+    # lots each line was sold from, by sale index.
+    # The .bin file is memory-mapped; column() returns a NumPy array over the
+    # mapping when NumPy is installed, else a memoryview of it, so scanning a
+    # month never copies it into Python objects.
+
+    def __init__(self, directory, month):
+        self.directory = directory
+        self.month = month
+        with open(os.path.join(directory, f'{month}.json'), 'r') as f:
+            header = json.load(f)
+        self.rows = header['rows']
+        self.products = [tuple(product) for product in header['products']]
+        self.offsets = {name: (typecode, offset) for name, typecode, offset in header['columns']}
+        self.summary = header['summary']
+        self.generation = header.get('generation', 0)
+        self.paths = month_files(directory, month, self.generation)
+        self.map = None
+
+    def column(self, name):
+        numpy = load_numpy()
+        typecode, offset = self.offsets[name]
+        if self.rows == 0:
+            return numpy.zeros(0, DTYPES[typecode]) if numpy else array.array(typecode)
+        if self.map is None:
+            with open(self.paths['bin'], 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if numpy:
+            return numpy.frombuffer(self.map, DTYPES[typecode], self.rows, offset)
+        size = array.array(typecode).itemsize
+        values = memoryview(self.map)[offset:offset + self.rows * size]
+        if sys.byteorder == 'big':
+            values = array.array(typecode, values.tobytes())
+            values.byteswap()
+            return values
+        return values.cast(typecode)
+
+    def sale_ids(self):
+        with open(self.paths['ids'], 'r') as f:
+            return f.read().split('\n')
+
+    def in_range(self, start, end):
+        # Row positions (NumPy) or row test (fallback) for [start, end)
+        numpy = load_numpy()
+        start = to_seconds(start) if start is not None else None
+        end = to_seconds(end) if end is not None else None
+        time = self.column('time')
+        if numpy:
+            keep = numpy.ones(self.rows, bool)
+            if start is not None:
+                keep &= time >= start
+            if end is not None:
+                keep &= time < end
+            return keep
+        return lambda row: (start is None or time[row] >= start) and (end is None or time[row] < end)
+
+    def totals(self, start=None, end=None):
+        # (number of sales, revenue) over the lines dated in [start, end)
+        numpy = load_numpy()
+        sale, quantity, price = self.column('sale'), self.column('quantity'), self.column('price')
+        keep = self.in_range(start, end)
+        if numpy:
+            cents = quantity[keep].astype('i8') * price[keep]
+            return len(numpy.unique(sale[keep])), int(cents.sum()) / 100
+        sales, cents = set(), 0
+        for row in range(self.rows):
+            if keep(row):
+                sales.add(sale[row])
+                cents += quantity[row] * price[row]
+        return len(sales), cents / 100
+
+    def product_totals(self, start=None, end=None):
+        # {code: [quantity, revenue]} over the lines dated in [start, end)
+        numpy = load_numpy()
+        product, quantity, price = self.column('product'), self.column('quantity'), self.column('price')
+        if numpy:
+            cents = quantity.astype('i8') * price
+            if start is not None or end is not None:
+                keep = self.in_range(start, end)
+                product, quantity, cents = product[keep], quantity[keep], cents[keep]
+            quantities = numpy.bincount(product, quantity, len(self.products))
+            revenues = numpy.bincount(product, cents, len(self.products))
+            totals = {}
+            for index in numpy.flatnonzero(quantities):
+                code = self.products[index][0]
+                stats = totals.setdefault(code, [0, 0])
+                stats[0] += int(quantities[index])
+                stats[1] += revenues[index] / 100
+            return totals
+
+        keep = self.in_range(start, end)
+        totals = {}
+        for row in range(self.rows):
+            if not keep(row):
+                continue
+            stats = totals.setdefault(self.products[product[row]][0], [0, 0])
+            stats[0] += quantity[row]
+            stats[1] += quantity[row] * price[row] / 100
+        return totals
+
+    def sales(self):
+        # The month's sales as they were recorded, as Sale objects
+        numpy = load_numpy()
+        ids = self.sale_ids()
+        products = [product_id(code, name) for code, name in self.products]
+        columns = [self.column(name) for name, _, _ in COLUMNS]
+        if numpy:
+            columns = [column.tolist() for column in columns]
+        sales = []
+        lines = None
+        for sale_index, time, product, quantity, price in zip(*columns):
+            if lines is None or sales[-1][0] != sale_index:
+                lines = []
+                sales.append((sale_index, time, lines))
+            lines += (products[product], quantity, shared_cents(price))
+        lots = self.sale_lots()
+        return [Sale(ids[sale_index] or None, to_date(time), tuple(lines),
+                     lots.get(sale_index) if lots else None)
+                for sale_index, time, lines in sales]
+
+    def sale_lots(self):
+        # {sale index: one tuple of (lot, quantity) pairs per line}
+        try:
+            with open(self.paths['lots'], 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return {int(index): tuple(tuple(tuple(lot) for lot in line) for line in sale_lots)
+                for index, sale_lots in saved.items()}
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Arrays handed out still use it; freed with them
+            self.map = None
+
+
+class MonthArchive:
+    # Columnar store for sealed months in <data>/archive/. A month is sealed
+    # once it is over: write() stores its sale lines as parallel integer
+    # columns plus a product dictionary, about a tenth of the JSON size, and
+    # reports and analytics scan them through a memory mapping. Until then
+    # the month stays in the writable monthly JSON file.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.opened = {}
+
+    def months(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(file[:-5] for file in os.listdir(self.directory) if file.endswith('.json'))
+
+    def header_path(self, month):
+        return os.path.join(self.directory, f'{month}.json')
+
+    def has(self, month):
+        return os.path.exists(self.header_path(month))
+
+    def open(self, month):
+        if month not in self.opened:
+            self.opened[month] = ArchivedMonth(self.directory, month)
+        return self.opened[month]
+
+    def summary(self, month):
+        return self.open(month).summary
+
+    def month_data(self, month):
+        # Rebuilt as a writable monthly dict, for sales dated in a sealed month
+        archived = self.open(month)
+        data = dict(archived.summary)
+        data['products_sold'] = {code: dict(stats) for code, stats in data['products_sold'].items()}
+        data.pop('sale_count', None)
+        data.pop('top_products', None)
+        data['sales'] = to_dicts(archived.sales())
+        return data
+
+    def write(self, month, sales, summary):
+        # Sealing again (a late sale) writes a new generation of data files
+        # next to the old one, switches the header over, then removes the old
+        # files, so a crash at any point leaves a header that matches its data
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        generation = self.open(month).generation + 1 if self.has(month) else 1
+        archived = self.opened.pop(month, None)
+        if archived:
+            archived.close()
+        paths = month_files(self.directory, month, generation)
+
+        columns = {name: array.array(typecode) for name, typecode, _ in COLUMNS}
+        products, product_index, ids = [], {}, []
+        lots = {}
+        for sale in map(to_sale, sales):
+            if sale.lots:
+                lots[len(ids)] = sale.lots
+            time = to_seconds(sale.date)
+            for item in sale.items:
+                key = (item.code, item.name)
+                if key not in product_index:
+                    product_index[key] = len(products)
+                    products.append(key)
+                columns['sale'].append(len(ids))
+                columns['time'].append(time)
+                columns['product'].append(product_index[key])
+                columns['quantity'].append(item.quantity)
+                columns['price'].append(item.price_cents)
+            ids.append(sale.id or '')
+
+        data = bytearray()
+        offsets = []
+        for name, typecode, _ in COLUMNS:
+            data += bytes(-len(data) % 8)
+            offsets.append([name, typecode, len(data)])
+            if sys.byteorder == 'big':
+                columns[name].byteswap()
+            data += columns[name].tobytes()
+
+        atomic_write_bytes(paths['bin'], bytes(data))
+        atomic_write_bytes(paths['ids'], '\n'.join(ids).encode())
+        # Lots the lines were sold from, for the few sales that have any
+        if lots:
+            atomic_write_json(paths['lots'], {str(index): sale_lots for index, sale_lots in lots.items()}, indent=None)
+        # The header goes last: a month is sealed once it exists
+        atomic_write_json(self.header_path(month), {
+            'month': month,
+            'generation': generation,
+            'rows': len(columns['sale']),
+            'sales': len(ids),
+            'columns': offsets,
+            'products': [list(product) for product in products],
+            'summary': dict(summary, sale_count=len(ids), top_products=top_products(summary['products_sold']))
+        }, indent=None)
+        self.remove_stale(month, paths.values())
+
+    def remove_stale(self, month, current):
+        # Data files of earlier generations, and any left by an interrupted seal
+        current = set(current) | {self.header_path(month)}
+        for file in os.listdir(self.directory):
+            path = os.path.join(self.directory, file)
+            if file.startswith(f'{month}.') and path not in current:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Still mapped by a reader (Windows); removed next time
+
+    def month_paths(self, month):
+        # The header and data files of a month's current generation
+        paths = [path for path in self.open(month).paths.values() if os.path.exists(path)]
+        return paths + [self.header_path(month)]
+
+    def files(self):
+        files = []
+        for month in self.months():
+            files += self.month_paths(month)
+        return files
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Columnar archive of closed months")
+    commands = parser.add_subparsers(dest='command', required=True)
+    seal_parser = commands.add_parser('seal', help="Archive closed months")
+    seal_parser.add_argument('months', nargs='*', help="YYYY-MM (default: every month before this one)")
+    commands.add_parser('list', help="Show the archived months")
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    storage = open_storage(data_dir=args.data_dir)
+    if args.command == 'seal':
+        current = datetime.now().strftime("%Y-%m")
+        months = args.months or [month for month in storage.list_months()
+                                 if month < current and not storage.archive.has(month)]
+        for month in months:
+            storage.seal_month(month)
+            print(f"Sealed {month}")
+    elif args.command == 'list':
+        for month in storage.archive.months():
+            archived = storage.archive.open(month)
+            size = sum(os.path.getsize(path) for path in storage.archive.month_paths(month))
+            print(f"{month}\t{archived.summary['sale_count']} sales\t{archived.rows} lines\t{size // 1024} KB")
+    storage.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+from pharmacy_journal import atomic_write_json
+
+# Tiered retention: (age limit, bucket format). Within each tier only the
+# newest snapshot per bucket is kept; the last tier has no age limit.
+RETENTION = [
+    (timedelta(days=1), '%Y%m%d%H'),   # hourly for a day
+    (timedelta(days=30), '%Y%m%d'),    # daily for a month
+    (None, '%Y%m'),                    # monthly after that
+]
+
+SNAPSHOT_FORMAT = '%Y%m%d_%H%M%S'
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BackupManager:
+    # Content-addressed incremental backups. Each file is stored once under
+    # objects/<hash[:2]>/<hash>; a snapshot is a small manifest in snapshots/
+    # mapping file names (relative to the data directory) to blob hashes.
+
+    def __init__(self, backup_dir='backups', data_dir='data'):
+        self.backup_dir = backup_dir
+        self.data_dir = data_dir
+        self.objects_dir = os.path.join(backup_dir, 'objects')
+        self.snapshots_dir = os.path.join(backup_dir, 'snapshots')
+        Path(self.objects_dir).mkdir(parents=True, exist_ok=True)
+        Path(self.snapshots_dir).mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, file_hash):
+        return os.path.join(self.objects_dir, file_hash[:2], file_hash)
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_dir, f'{snapshot_id}.json')
+
+    def list_snapshots(self):
+        return sorted(file[:-5] for file in os.listdir(self.snapshots_dir) if file.endswith('.json'))
+
+    def load_manifest(self, snapshot_id):
+        with open(self.snapshot_path(snapshot_id), 'r') as f:
+            return json.load(f)
+
+    def data_files(self):
+        # Everything in the data directory except in-flight temp files and
+        # SQLite's WAL side files (the caller checkpoints before backing up)
+        files = []
+        for dirpath, _, filenames in os.walk(self.data_dir):
+            for file in filenames:
+                if not file.endswith(('.tmp', '-wal', '-shm')):
+                    files.append(os.path.join(dirpath, file))
+        return sorted(files)
+
+    def store_blob(self, path, file_hash):
+        object_path = self.object_path(file_hash)
+        if os.path.exists(object_path):
+            return False
+        Path(object_path).parent.mkdir(exist_ok=True)
+        tmp_path = f"{object_path}.tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, object_path)
+        return True
+
+    def backup(self, files=None, now=None):
+        # Returns the new snapshot id, or None when nothing changed since the
+        # last snapshot
+        files = self.data_files() if files is None else files
+        names = {os.path.relpath(path, self.data_dir).replace(os.sep, '/'): path for path in files}
+        return self.backup_files(names, now)
+
+    def backup_files(self, files, now=None):
+        # Snapshot explicit {name: source path} pairs. Files whose size and
+        # mtime match the previous manifest are not even re-read.
+        now = now or datetime.now()
+        snapshot_id = now.strftime(SNAPSHOT_FORMAT)
+        snapshots = [existing for existing in self.list_snapshots() if existing < snapshot_id]
+        previous = self.load_manifest(snapshots[-1])['files'] if snapshots else {}
+
+        entries = {}
+        for name, path in files.items():
+            stat = os.stat(path)
+            old = previous.get(name)
+            if old and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+                file_hash = old['hash']
+            else:
+                file_hash = hash_file(path)
+                self.store_blob(path, file_hash)
+            entries[name] = {'hash': file_hash, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        if snapshots and {name: entry['hash'] for name, entry in entries.items()} == \
+                {name: entry['hash'] for name, entry in previous.items()}:
+            return None
+
+        atomic_write_json(self.snapshot_path(snapshot_id), {
+            'created': now.strftime("%Y-%m-%d %H:%M:%S"),
+            'files': entries
+        })
+        return snapshot_id
+
+    def set_aside(self, target_dir, keep, now=None):
+        # Move files the snapshot does not have out of the way, into
+        # replaced/<timestamp>/: journal segments, archived months, rollups
+        # or a SQLite WAL left there would otherwise be read on top of the
+        # restored files. Returns the names moved.
+        now = now or datetime.now()
+        aside_dir = os.path.join(self.backup_dir, 'replaced', now.strftime(SNAPSHOT_FORMAT))
+        moved = []
+        for dirpath, _, filenames in os.walk(target_dir):
+            for file in filenames:
+                path = os.path.join(dirpath, file)
+                name = os.path.relpath(path, target_dir).replace(os.sep, '/')
+                if name not in keep:
+                    aside = os.path.join(aside_dir, *name.split('/'))
+                    Path(aside).parent.mkdir(parents=True, exist_ok=True)
+                    shutil.move(path, aside)
+                    moved.append(name)
+        return sorted(moved)
+
+    def restore(self, snapshot_id, target_dir=None):
+        # Files are restored atomically one by one, after the ones the
+        # snapshot does not have are set aside. Close the programs first.
+        # Returns the names restored and the names set aside.
+        target_dir = target_dir or self.data_dir
+        manifest = self.load_manifest(snapshot_id)
+        moved = self.set_aside(target_dir, manifest['files']) if os.path.isdir(target_dir) else []
+        for name, entry in manifest['files'].items():
+            target = os.path.join(target_dir, *name.split('/'))
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{target}.tmp"
+            shutil.copyfile(self.object_path(entry['hash']), tmp_path)
+            os.replace(tmp_path, target)
+        return list(manifest['files']), moved
+
+    def prune(self, now=None, retention=RETENTION):
+        # Apply the retention policy, then delete blobs no snapshot uses
+        now = now or datetime.now()
+        snapshots = self.list_snapshots()
+        keep = set(snapshots[-1:])
+        buckets = set()
+        for snapshot_id in reversed(snapshots):
+            taken = datetime.strptime(snapshot_id, SNAPSHOT_FORMAT)
+            for limit, bucket_format in retention:
+                if limit is None or now - taken <= limit:
+                    bucket = (bucket_format, taken.strftime(bucket_format))
+                    if bucket not in buckets:
+                        buckets.add(bucket)
+                        keep.add(snapshot_id)
+                    break
+
+        removed = [snapshot_id for snapshot_id in snapshots if snapshot_id not in keep]
+        for snapshot_id in removed:
+            os.remove(self.snapshot_path(snapshot_id))
+        self.collect_garbage()
+        return removed
+
+    def collect_garbage(self):
+        used = set()
+        for snapshot_id in self.list_snapshots():
+            used.update(entry['hash'] for entry in self.load_manifest(snapshot_id)['files'].values())
+
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for file in filenames:
+                if file not in used:
+                    os.remove(os.path.join(dirpath, file))
+
+    def import_legacy(self, remove=False):
+        # Turn the old backups/backup_<timestamp> full copies into snapshots.
+        # Identical consecutive copies collapse into a single snapshot.
+        imported = []
+        legacy_dirs = sorted(name for name in os.listdir(self.backup_dir) if name.startswith('backup_'))
+        for name in legacy_dirs:
+            directory = os.path.join(self.backup_dir, name)
+            files = {}
+            for file in sorted(os.listdir(directory)):
+                # Old backups kept monthly files next to products.json
+                target = file if file in ('products.json', 'sales.json') else f'monthly/{file}'
+                files[target] = os.path.join(directory, file)
+
+            snapshot_id = self.backup_files(files, datetime.strptime(name[7:], SNAPSHOT_FORMAT))
+            if snapshot_id:
+                imported.append(snapshot_id)
+            if remove:
+                shutil.rmtree(directory)
+        return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pharmacy backups")
+    parser.add_argument('--backup-dir', default='backups')
+    parser.add_argument('--data-dir', default='data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backup', help="Snapshot the data directory if anything changed")
+    commands.add_parser('list', help="List snapshots")
+    restore_parser = commands.add_parser('restore', help="Restore a snapshot")
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('--target', help="Directory to restore into (default: the data directory)")
+    commands.add_parser('prune', help="Apply the retention policy and delete unused blobs")
+    legacy_parser = commands.add_parser('import-legacy', help="Convert old backup_<timestamp> folders")
+    legacy_parser.add_argument('--remove', action='store_true', help="Delete the old folders afterwards")
+    args = parser.parse_args(argv)
+
+    manager = BackupManager(args.backup_dir, args.data_dir)
+    if args.command == 'backup':
+        snapshot_id = manager.backup()
+        print(f"Created snapshot {snapshot_id}" if snapshot_id else "Nothing changed since the last snapshot")
+    elif args.command == 'list':
+        for snapshot_id in manager.list_snapshots():
+            manifest = manager.load_manifest(snapshot_id)
+            size = sum(entry['size'] for entry in manifest['files'].values())
+            print(f"{snapshot_id}\t{len(manifest['files'])} files\t{size} bytes")
+    elif args.command == 'restore':
+        restored, moved = manager.restore(args.snapshot, args.target)
+        print(f"Restored {len(restored)} files from {args.snapshot}")
+        if moved:
+            print(f"Moved {len(moved)} files not in the snapshot to {os.path.join(args.backup_dir, 'replaced')}")
+    elif args.command == 'prune':
+        removed = manager.prune()
+        print(f"Removed {len(removed)} snapshots")
+    elif args.command == 'import-legacy':
+        imported = manager.import_legacy(args.remove)
+        print(f"Imported {len(imported)} snapshots")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
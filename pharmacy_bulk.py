@@ -0,0 +1,430 @@
+import os
+import sys
+import csv
+import json
+import math
+import argparse
+from datetime import datetime
+from pharmacy_archive import full_date
+from pharmacy_journal import new_sale_id
+from pharmacy_models import Sale, product_id, shared_cents, to_cents
+from pharmacy_lots import DEFAULT_LOT, add_lot, set_stock
+from pharmacy_storage import month_bounds
+
+# Rows validated (and, for sales, written) per step
+CHUNK_SIZE = 1000
+# Imported sales held in memory before they are checkpointed
+CHECKPOINT_SALES = 10000
+
+PRODUCT_FIELDS = ['code', 'name', 'price', 'quantity', 'barcode', 'reorder_point']
+STOCK_FIELDS = ['code', 'quantity', 'lot', 'expiry']
+SALE_FIELDS = ['sale_id', 'date', 'code', 'name', 'quantity', 'price', 'amount']
+KINDS = ('products', 'stock', 'sales')
+
+
+class RowError(Exception):
+    pass
+
+
+def file_format(path):
+    # CSV unless the file is JSON Lines
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_int(row, field, default=None):
+    value = row.get(field)
+    if blank(value):
+        if default is None:
+            raise RowError(f"Missing {field}")
+        return default
+    try:
+        number = float(value)
+        if not math.isfinite(number) or number != int(number):
+            raise ValueError
+        return int(number)
+    except (TypeError, ValueError, OverflowError):
+        raise RowError(f"Invalid {field}: {value!r}")
+
+
+def parse_price(row, field='price'):
+    value = row.get(field)
+    try:
+        price = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise RowError(f"Invalid {field}: {value!r}")
+    if not math.isfinite(price) or price <= 0:
+        raise RowError(f"Invalid {field}: {value!r}")
+    return to_cents(price) / 100
+
+
+def parse_text(row, field):
+    value = row.get(field)
+    return '' if blank(value) else str(value).strip()
+
+
+class BulkImport:
+    # Streams a CSV or JSON Lines file into the engine. Rows are read and
+    # validated CHUNK_SIZE at a time; a bad row is reported in `errors` as
+    # (line, message) and skipped, the rest of the file still goes in.
+    #
+    #   products  code,name,price,quantity,barcode,reorder_point: adds new
+    #             products, updates name/price/barcode/reorder point of
+    #             existing ones (their stock is left alone)
+    #   stock     code,quantity[,lot,expiry]: adds (or with a negative
+    #             quantity removes) stock; with a lot, a delivery into that
+    #             lot, which then tracks the product by lot
+    #   sales     historical sales, CSV as one row per line item
+    #             (sale_id,date,code,name,quantity,price; rows of a sale are
+    #             adjacent) or JSONL as one sale dict per line; stock is not
+    #             changed
+    #
+    # Products and stock are applied in one batch at the end: one storage
+    # write and one index/low-stock update. Sales are recorded a chunk at a
+    # time and checkpointed every CHECKPOINT_SALES (automatic checkpoints
+    # are held back otherwise), so no more than that many imported sales are
+    # in memory at once; only the sale ids of the months touched are kept,
+    # to reject duplicates.
+    # checkpoint defaults to engine.checkpoint; the GUI passes one that first
+    # waits for its background writer.
+    #
+    # steps() does one chunk per iteration, so the GUI can run it between
+    # events; run() does it all.
+
+    def __init__(self, engine, kind, path, chunk_size=CHUNK_SIZE, checkpoint=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown import: {kind}")
+        self.engine = engine
+        self.checkpoint = checkpoint or engine.checkpoint
+        self.kind = kind
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.done = 0
+        self.rows = 0
+        self.applied = 0
+        self.unsaved = 0
+        self.errors = []
+
+    def lines(self, f):
+        # Counts what was read, for progress
+        for line in f:
+            self.done += len(line)
+            yield line
+
+    def read_rows(self, f):
+        # (line number, row dict)
+        if file_format(self.path) == 'jsonl':
+            for number, line in enumerate(self.lines(f), 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    self.errors.append((number, "Not valid JSON"))
+                    continue
+                if not isinstance(row, dict):
+                    self.errors.append((number, "Not a JSON object"))
+                    continue
+                yield number, row
+        else:
+            reader = csv.DictReader(self.lines(f))
+            for row in reader:
+                yield reader.line_num, row
+
+    def sale_records(self, rows):
+        # CSV sales come one line item per row; rows of a sale are merged
+        sale, first = None, None
+        for number, row in rows:
+            if 'items' in row:
+                yield number, row
+                continue
+            sale_id = parse_text(row, 'sale_id')
+            if sale is not None and sale_id and sale_id == sale['id']:
+                sale['items'].append(row)
+                continue
+            if sale is not None:
+                yield first, sale
+            sale, first = {'id': sale_id, 'date': row.get('date'), 'items': [row]}, number
+        if sale is not None:
+            yield first, sale
+
+    def chunks(self, records):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def steps(self):
+        storage = self.engine.storage
+        auto_checkpoint, storage.auto_checkpoint = storage.auto_checkpoint, False
+        try:
+            with open(self.path, 'r', newline='', encoding='utf-8-sig') as f:
+                records = self.read_rows(f)
+                if self.kind == 'sales':
+                    records = self.sale_records(records)
+                validate = getattr(self, f'validate_{self.kind}')
+                self.start()
+                for chunk in self.chunks(records):
+                    valid = []
+                    for number, row in chunk:
+                        self.rows += 1
+                        try:
+                            valid.append(validate(row))
+                        except RowError as e:
+                            self.errors.append((number, str(e)))
+                    self.apply_chunk(valid)
+                    yield self
+            self.finish()
+        finally:
+            storage.auto_checkpoint = auto_checkpoint
+        self.done = self.size
+        yield self
+
+    def run(self, progress=None):
+        for _ in self.steps():
+            if progress:
+                progress(self.done, self.size)
+        return self
+
+    # Per kind
+
+    def start(self):
+        self.pending = {}
+        self.barcodes = {}
+        self.sale_ids = set()
+        self.recorded_ids = {}
+
+    def recorded(self, sale_id, date):
+        # Ids already in the history, looked up a month at a time
+        month = date[:7]
+        ids = self.recorded_ids.get(month)
+        if ids is None:
+            ids = self.recorded_ids[month] = {sale.id for sale in self.engine.storage.get_sales(*month_bounds(month))}
+        return sale_id in ids
+
+    def validate_products(self, row):
+        code = parse_text(row, 'code')
+        if not code:
+            raise RowError("Missing code")
+        if code in self.pending:
+            raise RowError(f"Product {code} appears twice")
+        current = self.engine.products.get(code)
+        if current:
+            product = dict(current)
+            if parse_text(row, 'name'):
+                product['name'] = parse_text(row, 'name')
+            if not blank(row.get('price')):
+                product['price'] = parse_price(row)
+        else:
+            if not parse_text(row, 'name'):
+                raise RowError("Missing name")
+            product = {'name': parse_text(row, 'name'), 'price': parse_price(row),
+                       'quantity': parse_int(row, 'quantity', 0)}
+            if product['quantity'] < 0:
+                raise RowError("Invalid quantity")
+        if not blank(row.get('reorder_point')):
+            product['reorder_point'] = parse_int(row, 'reorder_point')
+            if product['reorder_point'] < 0:
+                raise RowError("Invalid reorder_point")
+        barcode = parse_text(row, 'barcode')
+        if barcode:
+            if self.engine.index.lookup(barcode) not in (None, code) or self.barcodes.get(barcode, code) != code:
+                raise RowError(f"Barcode {barcode} already exists")
+            self.barcodes[barcode] = code
+            product['barcode'] = barcode
+        self.pending[code] = product
+        return code
+
+    def validate_stock(self, row):
+        code = parse_text(row, 'code')
+        if code not in self.engine.products:
+            raise RowError(f"Product not found: {code}")
+        quantity = parse_int(row, 'quantity')
+        # Changes pile up on one copy of the product
+        product = self.pending.get(code) or dict(self.engine.products[code])
+        lot, expiry = parse_text(row, 'lot'), parse_text(row, 'expiry') or None
+        try:
+            if lot or expiry:
+                # A delivery into a lot
+                if quantity <= 0:
+                    raise RowError("A lot needs a positive quantity")
+                add_lot(product, lot or DEFAULT_LOT, expiry, quantity)
+            elif product['quantity'] + quantity < 0:
+                raise RowError(f"Stock of {code} would go below zero")
+            else:
+                set_stock(product, product['quantity'] + quantity)
+        except ValueError as e:
+            raise RowError(str(e))
+        self.pending[code] = product
+        return code
+
+    def validate_sales(self, row):
+        date = parse_text(row, 'date')
+        try:
+            date = full_date(date)
+            datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            raise RowError(f"Invalid date: {date!r}")
+        sale_id = parse_text(row, 'id') or new_sale_id()
+        if sale_id in self.sale_ids:
+            raise RowError(f"Sale {sale_id} appears twice")
+        if self.recorded(sale_id, date):
+            raise RowError(f"Sale {sale_id} is already recorded")
+        items = row.get('items')
+        if not isinstance(items, list) or not items:
+            raise RowError("Sale has no items")
+        lines = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise RowError("Sale item is not an object")
+            code = parse_text(item, 'code')
+            product = self.engine.products.get(code)
+            name = parse_text(item, 'name') or (product['name'] if product else '')
+            if not code or not name:
+                raise RowError(f"Unknown product: {code!r}")
+            quantity = parse_int(item, 'quantity')
+            if quantity <= 0:
+                raise RowError("Invalid quantity")
+            price = parse_price(item) if not blank(item.get('price')) or not product else product['price']
+            lines += (product_id(code, name), quantity, shared_cents(to_cents(price)))
+        self.sale_ids.add(sale_id)
+        # Normalized through the Sale model: exact amounts and totals
+        return Sale(sale_id, date, tuple(lines)).to_dict()
+
+    def apply_chunk(self, valid):
+        if self.kind == 'sales' and valid:
+            self.engine.import_sales(valid)
+            self.unsaved += len(valid)
+            if self.unsaved >= CHECKPOINT_SALES:
+                self.save_sales()
+        self.applied += len(valid)
+
+    def save_sales(self):
+        # Finished months among the imported sales are sealed by this
+        # checkpoint, so sales.json only ever holds the open months
+        self.engine.start_month(datetime.now())
+        self.checkpoint()
+        self.unsaved = 0
+
+    def finish(self):
+        if self.kind == 'products' and self.pending:
+            self.engine.save_products(self.pending)
+        elif self.kind == 'stock' and self.pending:
+            self.engine.save_products(self.pending)
+        elif self.kind == 'sales' and self.unsaved:
+            self.save_sales()
+
+
+class SalesExport:
+    # Streams sales dated in [start, end) to CSV (one row per line item, the
+    # import format) or JSON Lines (one sale per line), a month at a time,
+    # so the history is never loaded whole. steps() writes one month per
+    # iteration, like BulkImport.
+
+    def __init__(self, storage, path, start=None, end=None):
+        self.storage = storage
+        self.path = path
+        self.start = full_date(start) if start else None
+        self.end = full_date(end) if end else None
+        self.months = [month for month in storage.list_months()
+                       if (self.start is None or month_bounds(month)[1] > self.start) and
+                       (self.end is None or month_bounds(month)[0] < self.end)]
+        self.size = len(self.months)
+        self.done = 0
+        self.sales = 0
+
+    def steps(self):
+        jsonl = file_format(self.path) == 'jsonl'
+        with open(f"{self.path}.tmp", 'w', newline='', encoding='utf-8') as f:
+            writer = None if jsonl else csv.writer(f)
+            if writer:
+                writer.writerow(SALE_FIELDS)
+            for month in self.months:
+                first, last = month_bounds(month)
+                for sale in self.storage.get_sales(max(first, self.start or first), min(last, self.end or last)):
+                    if jsonl:
+                        f.write(json.dumps(sale.to_dict() if isinstance(sale, Sale) else sale) + '\n')
+                    else:
+                        writer.writerows([sale.get('id', ''), sale['date'], item['code'], item['name'],
+                                          item['quantity'], f"{item['price']:.2f}", f"{item['amount']:.2f}"]
+                                         for item in sale['items'])
+                    self.sales += 1
+                self.done += 1
+                yield self
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def run(self, progress=None):
+        for _ in self.steps():
+            if progress:
+                progress(self.done, self.size)
+        return self
+
+
+def export_products(products, path):
+    # The catalogue, in the products import format
+    with open(f"{path}.tmp", 'w', newline='', encoding='utf-8') as f:
+        if file_format(path) == 'jsonl':
+            for code, product in products.items():
+                f.write(json.dumps(dict(code=code, **product)) + '\n')
+        else:
+            writer = csv.writer(f)
+            writer.writerow(PRODUCT_FIELDS)
+            for code, product in products.items():
+                writer.writerow([code, product['name'], f"{product['price']:.2f}", product['quantity'],
+                                 product.get('barcode', ''), product.get('reorder_point', '')])
+    os.replace(f"{path}.tmp", path)
+    return len(products)
+
+
+def show_progress(done, total):
+    percent = min(done * 100 // total, 100) if total else 100
+    print(f"\r{percent:3d}%", end='', file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+    from pharmacy_core import SalesEngine
+
+    parser = argparse.ArgumentParser(description="Bulk import and export (CSV or JSON Lines)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help="Import products, stock adjustments or historical sales")
+    import_parser.add_argument('kind', choices=KINDS)
+    import_parser.add_argument('file', help=".csv, or .jsonl for JSON Lines")
+    export_parser = commands.add_parser('export', help="Export sales or the product catalogue")
+    export_parser.add_argument('kind', choices=['sales', 'products'])
+    export_parser.add_argument('file', help=".csv, or .jsonl for JSON Lines")
+    export_parser.add_argument('--from', dest='start', help="First day, YYYY-MM-DD")
+    export_parser.add_argument('--to', dest='end', help="Day after the last, YYYY-MM-DD")
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    storage = open_storage(data_dir=args.data_dir)
+    if args.command == 'import':
+        engine = SalesEngine(storage)
+        job = BulkImport(engine, args.kind, args.file).run(show_progress)
+        print(file=sys.stderr)
+        for line, message in sorted(job.errors):
+            print(f"Line {line}: {message}", file=sys.stderr)
+        print(f"Imported {job.applied} {args.kind} rows, {len(job.errors)} rejected")
+        engine.close()
+        return 1 if job.errors else 0
+
+    if args.kind == 'products':
+        print(f"Exported {export_products(storage.products, args.file)} products")
+    else:
+        job = SalesExport(storage, args.file, args.start, args.end).run(show_progress)
+        print(file=sys.stderr)
+        print(f"Exported {job.sales} sales")
+    storage.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+from pharmacy_core import SaleError
+from pharmacy_journal import new_sale_id
+from pharmacy_models import to_cents
+
+
+class Cart:
+    # An open sale: one line per product, in the order products were first
+    # added. Adding a product already in the cart adds to its line, and every
+    # change holds or releases stock through the engine's reservations under
+    # the cart's token, so the cart as a whole can never oversell and the
+    # holds lapse with the reservation timeout if the cart is abandoned.
+    # The total is kept up to date line by line, in cents, so a change costs
+    # the same for a bulk order as for a single item. Works with a local
+    # SalesEngine or a RemoteEngine alike.
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.token = new_sale_id()
+        self.lines = {}         # code -> [quantity, price in cents]
+        self.total_cents = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, code):
+        return code in self.lines
+
+    def line(self, code):
+        # (quantity, price in cents, amount in cents)
+        quantity, price = self.lines[code]
+        return quantity, price, quantity * price
+
+    def set_line(self, code, quantity):
+        old_quantity, old_price = self.lines.get(code, (0, 0))
+        self.total_cents -= old_quantity * old_price
+        if quantity:
+            price = to_cents(self.engine.products[code]['price'])
+            self.lines[code] = [quantity, price]
+            self.total_cents += quantity * price
+        else:
+            self.lines.pop(code, None)
+
+    def add(self, code, quantity):
+        # Returns the line's new quantity; raises SaleError when the stock
+        # is not there, leaving the cart as it was
+        if not isinstance(quantity, int) or quantity <= 0:
+            raise SaleError('Invalid quantity!')
+        held = self.engine.reserve(self.token, code, quantity)
+        self.set_line(code, held)
+        return held
+
+    def set_quantity(self, code, quantity):
+        # Edit a line in place; 0 voids it
+        if code not in self.lines:
+            raise SaleError('Product not in cart!')
+        if not isinstance(quantity, int) or quantity < 0:
+            raise SaleError('Invalid quantity!')
+        held = self.engine.set_reservation(self.token, code, quantity)
+        self.set_line(code, held)
+        return held
+
+    def void(self, code):
+        if code in self.lines:
+            self.engine.release(self.token, code)
+            self.set_line(code, 0)
+
+    def items(self):
+        return [(code, quantity) for code, (quantity, _) in self.lines.items()]
+
+    def reprice(self):
+        # Lines take the catalogue's current prices, which are what the sale
+        # is charged at; returns the codes whose price changed
+        changed = [code for code, (_, price) in self.lines.items()
+                   if to_cents(self.engine.products[code]['price']) != price]
+        for code in changed:
+            self.set_line(code, self.lines[code][0])
+        return changed
+
+    def checkout(self):
+        # Every line is committed in one sale (one journal write), which
+        # also consumes the cart's holds; the cart is then empty again.
+        # A price changed since its line was added is refused once, with
+        # the cart re-priced, so the sale never differs from the total shown.
+        if not self.lines:
+            raise SaleError('Cart is empty!')
+        if self.reprice():
+            raise SaleError(f"Prices changed; the total is now ${self.total_cents / 100:.2f}!")
+        sale = self.engine.process_sale(self.items(), token=self.token)
+        self.reset()
+        return sale
+
+    def clear(self):
+        self.engine.release(self.token)
+        self.reset()
+
+    def reset(self):
+        self.token = new_sale_id()
+        self.lines = {}
+        self.total_cents = 0
@@ -0,0 +1,225 @@
+import json
+import socket
+from datetime import datetime
+from pharmacy_core import SaleError
+from pharmacy_forecast import LEAD_TIME, REVIEW_DAYS
+from pharmacy_search import ProductIndex
+from pharmacy_stock import StockMonitor
+from pharmacy_server import parse_address
+
+
+class ServerConnection:
+    # Blocking client for pharmacy_server. call_many() pipelines: every
+    # request is written before the first answer is read, so a batch costs
+    # one round trip.
+
+    def __init__(self, address, timeout=30):
+        host, port = parse_address(address)
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.next_id = 0
+
+    def call_many(self, requests):
+        # requests are (op, arguments) pairs; returns the raw responses
+        for op, args in requests:
+            self.next_id += 1
+            self.wfile.write((json.dumps(dict(args, id=self.next_id, op=op)) + '\n').encode())
+        self.wfile.flush()
+
+        responses = []
+        for _ in requests:
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionError('Connection to the server was lost!')
+            responses.append(json.loads(line))
+        return responses
+
+    def call(self, op, **args):
+        return result(self.call_many([(op, args)])[0])
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+def result(response):
+    if not response['ok']:
+        raise SaleError(response['error'])
+    return response['result']
+
+
+def date_arg(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+class RemoteStorage:
+    # The read side of the storage interface, answered by the server
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.products = engine.products
+        self.auto_checkpoint = False
+
+    def get_sales(self, start=None, end=None):
+        return self.engine.connection.call('get_sales', start=start, end=end)
+
+    def sales_total(self, start=None, end=None):
+        return tuple(self.engine.connection.call('sales_total', start=start, end=end))
+
+    def list_months(self):
+        return self.engine.connection.call('list_months')
+
+    def month_summary(self, month):
+        return self.engine.connection.call('month_summary', month=month)
+
+    def month_fingerprint(self, month):
+        # Other tills change the server's months; always ask
+        return None
+
+    def data_files(self):
+        # The server owns the data and backs it up
+        return []
+
+
+class RemoteEngine:
+    # Stands in for SalesEngine on a till connected to pharmacy_server.
+    # Every change and every stock check goes to the server; the catalogue
+    # is cached locally, with its own search index and low-stock monitor,
+    # and refresh() pulls the products other tills changed.
+
+    def __init__(self, address):
+        self.connection = ServerConnection(address)
+        self.products = {}
+        self.versions = {}
+        self.seq = 0
+        self.stock_listeners = []
+        self.unseen = set()
+        data = self.connection.call('products')
+        self.seq = data['seq']
+        for code, record in data['products'].items():
+            self.versions[code] = record.pop('version')
+            self.products[code] = record
+        self.index = ProductIndex(self.products)
+        self.stock = StockMonitor(self.products)
+        self.storage = RemoteStorage(self)
+
+    def apply(self, records):
+        for code, record in records.items():
+            record = dict(record)
+            self.versions[code] = record.pop('version')
+            self.products[code] = record
+            self.index.update(code)
+            self.unseen.add(code)
+            event = self.stock.update(code)
+            if event:
+                for callback in self.stock_listeners:
+                    callback(event, code)
+
+    def changes_request(self):
+        return ('changes', {'since': self.seq})
+
+    def apply_changes(self, response):
+        data = result(response)
+        self.seq = max(self.seq, data['seq'])
+        self.apply(data['products'])
+
+    def refresh(self):
+        # Codes of the products that changed since the last refresh, here
+        # or on another till
+        self.apply_changes(self.connection.call_many([self.changes_request()])[0])
+        codes, self.unseen = self.unseen, set()
+        return codes
+
+    def call_and_refresh(self, op, **args):
+        # One round trip for the change and the refreshed catalogue
+        response, changes = self.connection.call_many([(op, args), self.changes_request()])
+        self.apply_changes(changes)
+        return result(response)
+
+    # Same interface as SalesEngine
+
+    def add_stock_listener(self, callback):
+        self.stock_listeners.append(callback)
+
+    def low_stock(self):
+        return self.stock.low_stock()
+
+    def lookup(self, text):
+        return self.index.lookup(text)
+
+    def search(self, text, limit=10):
+        return self.index.search(text, limit)
+
+    def version(self, code):
+        return self.versions.get(code, 0)
+
+    def needs_checkpoint(self):
+        return False
+
+    def prepare_checkpoint(self):
+        return lambda: None
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+    def add_product(self, code, name, price, quantity, barcode=None, reorder_point=None):
+        self.call_and_refresh('add_product', code=code, name=name, price=price, quantity=quantity,
+                              barcode=barcode, reorder_point=reorder_point)
+        return self.products[code]
+
+    def restock(self, code, quantity, lot=None, expiry=None):
+        self.call_and_refresh('restock', code=code, quantity=quantity, lot=lot, expiry=expiry)
+        return self.products[code]
+
+    def write_off(self, code, lot):
+        self.call_and_refresh('write_off', code=code, lot=lot)
+        return self.products[code]
+
+    def expiring(self, days):
+        return self.connection.call('expiring', days=days)
+
+    def purchase_suggestions(self, lead_time=LEAD_TIME, review_days=REVIEW_DAYS):
+        # The server keeps the demand forecast
+        return self.connection.call('purchase_suggestions', lead_time=lead_time, review_days=review_days)
+
+    def set_reorder_point(self, code, reorder_point, version=None):
+        return self.update_product(code, {'reorder_point': reorder_point}, version)
+
+    def update_product(self, code, changes, version=None):
+        # Sends the version this till last saw, so edits made meanwhile on
+        # another till are not silently overwritten
+        if version is None:
+            version = self.version(code)
+        self.call_and_refresh('update_product', code=code, changes=changes, version=version)
+        return self.products[code]
+
+    def check_item(self, code, quantity, in_cart=0, token=None):
+        self.connection.call('check_item', code=code, quantity=quantity, in_cart=in_cart, token=token)
+
+    def reserve(self, token, code, quantity):
+        return self.connection.call('reserve', token=token, code=code, quantity=quantity)
+
+    def set_reservation(self, token, code, quantity):
+        return self.connection.call('set_reservation', token=token, code=code, quantity=quantity)
+
+    def release(self, token, code=None):
+        self.connection.call('release', token=token, code=code)
+
+    def process_sale(self, items, date=None, token=None):
+        return self.call_and_refresh('sale', items=list(items), date=date, token=token)
+
+    def process_sales_batch(self, batch):
+        sales = [entry if isinstance(entry, dict) else {'items': list(entry)} for entry in batch]
+        results = self.call_and_refresh('sales_batch', sales=sales)
+        return [SaleError(entry['error']) if 'error' in entry else entry for entry in results]
+
+    def sales_between(self, start, end, code=None):
+        return self.connection.call('sales_between', start=date_arg(start), end=date_arg(end), code=code)
@@ -0,0 +1,418 @@
+import os
+import time
+from datetime import datetime
+from pharmacy_forecast import DemandForecast, LEAD_TIME, REVIEW_DAYS
+from pharmacy_journal import new_sale_id
+from pharmacy_lots import ExpiryIndex, DEFAULT_LOT, add_lot, remove_lot, allocate, sellable, expiry_cutoff, order_lots
+from pharmacy_models import to_cents
+from pharmacy_rollups import Rollups, next_month
+from pharmacy_search import ProductIndex
+from pharmacy_stock import StockMonitor, StockReservations
+
+
+class SaleError(ValueError):
+    pass
+
+
+class SalesEngine:
+    # UI-free business logic shared by the CLI and the GUI. Front ends
+    # collect input and show results; validation, stock decrements, monthly
+    # aggregates and persistence all happen here, through the storage backend.
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.products = storage.products
+        order_lots(self.products)
+        self.rollups = Rollups(os.path.join(storage.data_dir, 'rollups'))
+        self.rollups.sync(storage)
+        self.index = ProductIndex(self.products)
+        self.stock = StockMonitor(self.products)
+        self.expiry = ExpiryIndex(self.products)
+        # Demand matrix for purchase suggestions, built on first use
+        self.forecast = None
+        self.stock_listeners = []
+        self.reservations = StockReservations()
+        # Bumped on every product edit, for optimistic concurrency between
+        # terminals sharing one engine
+        self.versions = {}
+        self.start_month(datetime.now())
+
+    def start_month(self, now):
+        # Months before this one are sealed at the next checkpoint
+        month = now.strftime("%Y-%m")
+        self.month_end = next_month(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+        self.pending_seals = [old for old in self.storage.list_months()
+                              if old < month and not self.storage.archive.has(old)]
+
+    def check_month(self):
+        # Called at sale time, so a till left running past the end of the
+        # month rolls over on its first sale in the new one. Sealing waits
+        # for the next checkpoint (needs_checkpoint() says so), which the
+        # GUI and the server run on their writer threads: a sale only ever
+        # appends to the journal.
+        now = datetime.now()
+        if now >= self.month_end:
+            self.start_month(now)
+
+    def prepare_seals(self):
+        seals = [self.storage.prepare_seal(month) for month in self.pending_seals]
+        self.pending_seals = []
+        return seals
+
+    def add_stock_listener(self, callback):
+        # callback(event, code) runs when a product drops below its reorder
+        # point ('low') or gets back above it ('restocked')
+        self.stock_listeners.append(callback)
+
+    def update_stock(self, codes):
+        for code in codes:
+            self.expiry.update(code)
+            event = self.stock.update(code)
+            if event:
+                for callback in self.stock_listeners:
+                    callback(event, code)
+
+    def low_stock(self):
+        return self.stock.low_stock()
+
+    def refresh(self):
+        # A local engine is always current; RemoteEngine pulls changes here
+        return []
+
+    def needs_checkpoint(self):
+        return self.storage.needs_checkpoint() or bool(self.pending_seals)
+
+    def prepare_checkpoint(self):
+        # Finished months are archived first, then the storage snapshots,
+        # then the rollups that summarize them
+        write_seals = self.prepare_seals()
+        write_storage = self.storage.prepare_checkpoint()
+        write_rollups = self.rollups.prepare_save()
+
+        def write():
+            for write_seal in write_seals:
+                write_seal()
+            write_storage()
+            write_rollups(self.storage.sales_fingerprint())
+        return write
+
+    def checkpoint(self):
+        for write_seal in self.prepare_seals():
+            write_seal()
+        self.storage.checkpoint()
+        self.rollups.save(self.storage.sales_fingerprint())
+
+    def close(self):
+        for write_seal in self.prepare_seals():
+            write_seal()
+        self.storage.close()
+        self.rollups.save(self.storage.sales_fingerprint())
+
+    def version(self, code):
+        return self.versions.get(code, 0)
+
+    def save_product(self, code, product):
+        self.storage.put_product(code, product)
+        self.versions[code] = self.version(code) + 1
+        self.index.update(code)
+        self.update_stock([code])
+
+    def save_products(self, products):
+        # Many new or changed products in a single storage write
+        self.storage.put_products(products)
+        for code in products:
+            self.versions[code] = self.version(code) + 1
+            self.index.update(code)
+        self.update_stock(products)
+
+    def add_product(self, code, name, price, quantity, barcode=None, reorder_point=None):
+        if code in self.products:
+            raise SaleError('Product code already exists!')
+        if not all([code, name, price > 0, quantity >= 0]):
+            raise SaleError('Please fill all fields correctly!')
+        if reorder_point is not None and reorder_point < 0:
+            raise SaleError('Please fill all fields correctly!')
+        if barcode and self.index.lookup(barcode):
+            raise SaleError('Barcode already exists!')
+
+        product = {
+            'name': name,
+            'price': price,
+            'quantity': quantity
+        }
+        if barcode:
+            product['barcode'] = barcode
+        if reorder_point is not None:
+            product['reorder_point'] = reorder_point
+        self.save_product(code, product)
+        return product
+
+    def restock(self, code, quantity, lot=None, expiry=None):
+        # A delivery; with a lot (and its expiry) the product is tracked by
+        # lot from then on, and a tracked product's unnamed deliveries go to
+        # its default lot
+        if code not in self.products:
+            raise SaleError('Product not found!')
+        if not isinstance(quantity, int) or quantity <= 0:
+            raise SaleError('Invalid quantity!')
+
+        product = dict(self.products[code])
+        if lot or expiry or 'lots' in product:
+            try:
+                add_lot(product, lot or DEFAULT_LOT, expiry or None, quantity)
+            except ValueError as e:
+                raise SaleError(str(e))
+        else:
+            product['quantity'] += quantity
+        self.save_product(code, product)
+        return product
+
+    def write_off(self, code, lot):
+        # Take a lot out of stock, e.g. once it has expired
+        if code not in self.products:
+            raise SaleError('Product not found!')
+        product = dict(self.products[code])
+        try:
+            remove_lot(product, lot)
+        except ValueError as e:
+            raise SaleError(str(e))
+        self.save_product(code, product)
+        return product
+
+    def expiring(self, days):
+        # Lots expiring within `days` days, expired ones first
+        return self.expiry.expiring(expiry_cutoff(days))
+
+    def set_reorder_point(self, code, reorder_point, version=None):
+        if not isinstance(reorder_point, int) or reorder_point < 0:
+            raise SaleError('Invalid reorder point!')
+        return self.update_product(code, {'reorder_point': reorder_point}, version)
+
+    def update_product(self, code, changes, version=None):
+        # Edit name, price, barcode, reorder point or lead time (days from
+        # ordering to delivery). With a version, the edit is rejected if the
+        # product changed since the caller read it.
+        if code not in self.products:
+            raise SaleError('Product not found!')
+        if version is not None and version != self.version(code):
+            raise SaleError('Product was changed on another terminal, please try again!')
+        if set(changes) - {'name', 'price', 'barcode', 'reorder_point', 'lead_time'}:
+            raise SaleError('Please fill all fields correctly!')
+        if 'lead_time' in changes and (not isinstance(changes['lead_time'], int) or changes['lead_time'] < 0):
+            raise SaleError('Invalid lead time!')
+        if not changes.get('name', True) or changes.get('price', 1) <= 0:
+            raise SaleError('Please fill all fields correctly!')
+        barcode = changes.get('barcode')
+        if barcode and self.index.lookup(barcode) not in (None, code):
+            raise SaleError('Barcode already exists!')
+
+        product = dict(self.products[code])
+        product.update(changes)
+        if not product.get('barcode'):
+            product.pop('barcode', None)
+        self.save_product(code, product)
+        return product
+
+    def available(self, code, token=None):
+        # Stock not held by other carts, leaving out expired lots
+        self.reservations.expire(time.monotonic())
+        product = self.products[code]
+        quantity = sellable(product, datetime.now().strftime("%Y-%m-%d")) if 'lots' in product else product['quantity']
+        return quantity - self.reservations.reserved(code, exclude=token)
+
+    def reserve(self, token, code, quantity):
+        # Hold stock for the cart identified by token until the sale is
+        # completed, the hold is released or it times out
+        self.check_item(code, quantity, self.reservations.held(token, code), token)
+        self.reservations.add(token, code, quantity, time.monotonic())
+        return self.reservations.held(token, code)
+
+    def set_reservation(self, token, code, quantity):
+        # Change the stock held for one cart line to `quantity` in one step,
+        # so a line being edited never loses its stock to another till;
+        # 0 releases it
+        if quantity:
+            self.check_item(code, quantity, 0, token)
+        held = self.reservations.held(token, code)
+        if quantity != held:
+            self.reservations.add(token, code, quantity - held, time.monotonic())
+        return self.reservations.held(token, code)
+
+    def release(self, token, code=None):
+        self.reservations.release(token, code)
+
+    def lookup(self, text):
+        # Product code for an exact code or barcode, else None
+        return self.index.lookup(text)
+
+    def search(self, text, limit=10):
+        # Codes matching a code, barcode, name prefix or misspelt name
+        return self.index.search(text, limit)
+
+    def check_item(self, code, quantity, in_cart=0, token=None):
+        # Validate one cart line; in_cart is what is already in the cart.
+        # Stock held for other carts is not available.
+        if code not in self.products:
+            raise SaleError('Product not found!')
+        if not isinstance(quantity, int) or quantity <= 0:
+            raise SaleError('Invalid quantity!')
+        if quantity + in_cart > self.available(code, token):
+            raise SaleError('Insufficient stock!')
+
+    def merge_items(self, items):
+        # Accepts (code, quantity) pairs or {'code', 'quantity'} dicts and
+        # merges repeated codes, keeping the order they were first added in
+        merged = {}
+        for item in items:
+            code, quantity = (item['code'], item['quantity']) if isinstance(item, dict) else item
+            if not isinstance(quantity, int) or quantity <= 0:
+                raise SaleError('Invalid quantity!')
+            merged[code] = merged.get(code, 0) + quantity
+        return merged
+
+    def build_sale(self, items, date=None, used=None, token=None):
+        # used maps codes to stock already taken by earlier sales in a batch;
+        # token is the cart whose reservations the sale consumes
+        merged = self.merge_items(items)
+        if not merged:
+            raise SaleError('Cart is empty!')
+
+        # Amounts are worked out in cents so the total is exact
+        sale_items = []
+        total_cents = 0
+        for code, quantity in merged.items():
+            self.check_item(code, quantity, used.get(code, 0) if used else 0, token)
+            product = self.products[code]
+            amount_cents = quantity * to_cents(product['price'])
+            sale_items.append({
+                'code': code,
+                'name': product['name'],
+                'quantity': quantity,
+                'price': product['price'],
+                'amount': amount_cents / 100
+            })
+            total_cents += amount_cents
+
+        return {
+            'id': new_sale_id(),
+            'date': date or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'items': sale_items,
+            'total': total_cents / 100
+        }
+
+    def allocate_lots(self, sale, taken=None):
+        # Pick the lots each line of a lot-tracked product is sold from,
+        # first expiry first, and note them on the sale item. taken maps
+        # code -> {lot: quantity} claimed by earlier sales of a batch and is
+        # only added to once the whole sale is allocated.
+        allocations = {}
+        for item in sale['items']:
+            product = self.products[item['code']]
+            if 'lots' in product:
+                try:
+                    allocations[item['code']] = allocate(product, item['quantity'], sale['date'][:10],
+                                                         taken.get(item['code']) if taken else None)
+                except ValueError as e:
+                    raise SaleError(str(e))
+        for item in sale['items']:
+            if item['code'] in allocations:
+                item['lots'] = allocations[item['code']]
+                if taken is not None:
+                    used = taken.setdefault(item['code'], {})
+                    for lot, quantity in item['lots']:
+                        used[lot] = used.get(lot, 0) + quantity
+
+    def process_sale(self, items, date=None, token=None):
+        # Validate, decrement stock, update monthly aggregates and persist
+        sale = self.build_sale(items, date, token=token)
+        self.allocate_lots(sale)
+        self.storage.record_sale(sale)
+        if token:
+            self.reservations.release(token)
+        self.rollups.add_sales([sale])
+        if self.forecast:
+            self.forecast.add_sales([sale])
+        self.update_stock(item['code'] for item in sale['items'])
+        self.check_month()
+        return sale
+
+    def process_sales_batch(self, batch):
+        # Each entry is a list of items or a {'items': [...], 'date': ...,
+        # 'token': ...} dict. Stock is validated across the whole batch, and
+        # every valid sale is persisted in a single write. Returns one result
+        # per entry: the recorded sale, or the SaleError that rejected it.
+        used = {}
+        taken = {}
+        sales = []
+        results = []
+        for entry in batch:
+            if isinstance(entry, dict):
+                items, date, token = entry['items'], entry.get('date'), entry.get('token')
+            else:
+                items, date, token = entry, None, None
+            try:
+                sale = self.build_sale(items, date, used, token)
+                self.allocate_lots(sale, taken)
+            except SaleError as e:
+                results.append(e)
+                continue
+            if token:
+                # The sale now accounts for this cart's holds, which would
+                # otherwise be counted twice against later sales in the batch
+                self.reservations.release(token)
+            for item in sale['items']:
+                used[item['code']] = used.get(item['code'], 0) + item['quantity']
+            sales.append(sale)
+            results.append(sale)
+
+        if sales:
+            self.storage.record_sales(sales)
+            self.rollups.add_sales(sales)
+            if self.forecast:
+                self.forecast.add_sales(sales)
+            self.update_stock(used)
+            self.check_month()
+        return results
+
+    def import_sales(self, sales):
+        # Historical sales: recorded and rolled up, stock left as it is
+        self.storage.record_sales(sales, adjust_stock=False)
+        self.rollups.add_sales(sales)
+        if self.forecast:
+            self.forecast.add_sales(sales)
+
+    def sales_between(self, start, end, code=None):
+        # Range report from the rollups; dates are "YYYY-MM-DD", end exclusive
+        return self.rollups.query(start, end, code)
+
+    def prepare_forecast(self):
+        # Storage is read here; the returned run() reads the history and can
+        # go to a background thread. Sales recorded meanwhile are kept and
+        # folded in by the next purchase_suggestions().
+        try:
+            self.forecast = DemandForecast(self.products)
+        except ImportError as e:
+            raise SaleError(str(e))
+        return self.forecast.prepare(self.storage)
+
+    def purchase_suggestions(self, lead_time=LEAD_TIME, review_days=REVIEW_DAYS):
+        # What to order and how much, from the demand forecast
+        if not all(isinstance(days, int) and days >= 0 for days in (lead_time, review_days)):
+            raise SaleError('Invalid lead time!')
+        if self.forecast is None:
+            self.prepare_forecast()()
+        self.forecast.finish()
+        return self.forecast.suggestions(lead_time=lead_time, review_days=review_days)
+
+
+def format_receipt(sale):
+    receipt = f"=== Receipt ===\nDate: {sale['date']}\n\nItems:\n"
+    receipt += "Name\t\tQty\tPrice\tAmount\n"
+    receipt += "-" * 40 + "\n"
+    for item in sale['items']:
+        receipt += f"{item['name'][:12]}\t{item['quantity']}\t${item['price']:.2f}\t${item['amount']:.2f}\n"
+        for lot, quantity in item.get('lots', ()):
+            receipt += f"  lot {lot}\t{quantity}\n"
+    receipt += "-" * 40 + "\n"
+    receipt += f"Total Amount: ${sale['total']:.2f}"
+    return receipt
@@ -0,0 +1,249 @@
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, date
+from pharmacy_archive import MonthArchive, EPOCH, load_numpy
+from pharmacy_lots import sellable
+from pharmacy_models import to_sale
+from pharmacy_storage import month_bounds
+
+HISTORY_DAYS = 400      # a year back plus a window, for the seasonal comparison
+WINDOW = 28             # days in the moving average
+SHORT_WINDOW = 7
+YEAR = 364              # 52 weeks, so last year's days fall on the same weekdays
+LEAD_TIME = 7           # days from ordering to the delivery being on the shelf
+REVIEW_DAYS = 7         # days until the next order; a delivery must cover them
+SERVICE_Z = 1.65        # safety stock in standard deviations: about 95% of
+                        # lead times pass without running out
+SEASON_UNITS = 10       # last year's sales below this are too few to compare
+SEASON_LIMITS = (0.5, 2.0)
+
+EPOCH_DAY = EPOCH.toordinal()
+
+
+def day_number(text):
+    # "YYYY-MM-DD..." -> proleptic ordinal
+    return date(int(text[:4]), int(text[5:7]), int(text[8:10])).toordinal()
+
+
+class DemandForecast:
+    # Units sold per product per day over the last HISTORY_DAYS, held as one
+    # NumPy matrix (a row per product code, a column per day, today last),
+    # so moving averages, seasonality and reorder quantities are computed
+    # for every product at once with array operations.
+    #
+    # Sealed months are added straight from the archive columns, open months
+    # from the storage. Afterwards add_sales() keeps the matrix current as
+    # sales are recorded, and the window slides forward a column per day,
+    # so the history is only read again when the program restarts.
+
+    def __init__(self, products, days=HISTORY_DAYS):
+        numpy = load_numpy()
+        if numpy is None:
+            raise ImportError('Demand forecasts need NumPy: pip install numpy')
+        self.products = products
+        self.days = days
+        self.first = None
+        self.codes = []
+        self.rows = {}
+        self.demand = numpy.zeros((0, days), 'i4')
+        # Sales recorded while the history is being read; None once built
+        self.backlog = None
+
+    def row(self, code):
+        numpy = load_numpy()
+        row = self.rows.get(code)
+        if row is None:
+            row = self.rows[code] = len(self.codes)
+            self.codes.append(code)
+            if row == len(self.demand):
+                # Rows are added in doublings, like a list
+                grown = numpy.zeros((max(64, 2 * row), self.days), 'i4')
+                grown[:row] = self.demand
+                self.demand = grown
+        return row
+
+    def advance(self, day):
+        # Slide the window so `day` is the last column
+        last = self.first + self.days - 1
+        if day <= last:
+            return
+        shift = min(day - last, self.days)
+        self.demand[:, :self.days - shift] = self.demand[:, shift:]
+        self.demand[:, self.days - shift:] = 0
+        self.first = day - self.days + 1
+
+    def add_cells(self, rows, columns, quantities):
+        # Add quantities into (row, column) cells; repeated cells add up
+        numpy = load_numpy()
+        cells = rows.astype('i8') * self.days + columns
+        cells, positions = numpy.unique(cells, return_inverse=True)
+        self.demand.ravel()[cells] += numpy.bincount(positions, quantities).astype('i4')
+
+    def add_archived(self, archived):
+        # One sealed month, straight from its columns
+        numpy = load_numpy()
+        if not archived.rows:
+            return
+        columns = archived.column('time') // 86400 + (EPOCH_DAY - self.first)
+        keep = (columns >= 0) & (columns < self.days)
+        if not keep.any():
+            return
+        rows = numpy.array([self.row(code) for code, _ in archived.products], 'i8')
+        self.add_cells(rows[archived.column('product')[keep]], columns[keep], archived.column('quantity')[keep])
+
+    def add(self, sales):
+        numpy = load_numpy()
+        rows, columns, quantities = [], [], []
+        for sale in map(to_sale, sales):
+            day = day_number(sale.date)
+            self.advance(day)
+            if day < self.first:
+                continue
+            for item in sale.items:
+                rows.append(self.row(item.code))
+                columns.append(day - self.first)
+                quantities.append(item.quantity)
+        if rows:
+            self.add_cells(numpy.array(rows), numpy.array(columns), numpy.array(quantities))
+
+    def add_sales(self, sales):
+        # Called by the engine for every sale recorded
+        if self.backlog is not None:
+            self.backlog.extend(sales)
+        else:
+            self.add(sales)
+
+    def prepare(self, storage, today=None):
+        # The storage is read here, on the caller's thread; the returned run()
+        # fills the matrix and can go to a background thread. Sales recorded
+        # in the meantime wait in the backlog until finish().
+        today = day_number((today or datetime.now()).strftime("%Y-%m-%d"))
+        self.first = today - self.days + 1
+        first_month = date.fromordinal(self.first).strftime("%Y-%m")
+        archive = getattr(storage, 'archive', None)
+        months = [month for month in storage.list_months() if month >= first_month]
+        sealed = [month for month in months if archive and archive.has(month) and
+                  month not in getattr(storage, 'months', {})]
+        open_sales = [storage.get_sales(*month_bounds(month)) for month in months if month not in sealed]
+        directory = archive.directory if archive else None
+        self.backlog = []
+
+        def run():
+            # A private archive reader: the storage's one belongs to its thread
+            reader = MonthArchive(directory)
+            for month in sealed:
+                archived = reader.open(month)
+                self.add_archived(archived)
+                archived.close()
+            for sales in open_sales:
+                self.add(sales)
+        return run
+
+    def finish(self):
+        # Fold in the sales recorded while run() was reading the history
+        if self.backlog is not None:
+            backlog, self.backlog = self.backlog, None
+            self.add(backlog)
+
+    def suggestions(self, today=None, lead_time=LEAD_TIME, review_days=REVIEW_DAYS, window=WINDOW,
+                    service_z=SERVICE_Z):
+        # Products to order now, the ones that run out first first:
+        # [{'code', 'name', 'stock', 'average_7', 'average', 'seasonal',
+        # 'daily', 'days_left', 'lead_time', 'reorder_point', 'order'}, ...].
+        # A product's own 'lead_time' wins over the default.
+        numpy = load_numpy()
+        today = (today or datetime.now()).strftime("%Y-%m-%d")
+        self.advance(day_number(today))
+        count = len(self.codes)
+        if not count:
+            return []
+        # Today is still being sold, so the averages use complete days
+        demand = self.demand[:count, :-1]
+        recent = demand[:, -window:]
+        average = recent.mean(axis=1)
+        sigma = recent.std(axis=1)
+        average_7 = demand[:, -SHORT_WINDOW:].mean(axis=1)
+
+        products = [self.products.get(code) for code in self.codes]
+        known = numpy.array([product is not None for product in products])
+        stock = numpy.array([sellable(product, today) if product else 0 for product in products], 'f8')
+        lead = numpy.array([product.get('lead_time', lead_time) if product else lead_time
+                            for product in products], 'f8')
+        horizon = lead + review_days
+
+        # Seasonality: how last year's sales over the coming horizon compared
+        # with the `window` days before it, applied to this year's average.
+        # Products with too little history a year ago keep an index of 1.
+        seasonal = numpy.ones(count)
+        now = demand.shape[1] - YEAR
+        if now - window >= 0:
+            span = numpy.minimum(horizon, YEAR).astype('i8')
+            totals = numpy.zeros((count, window + int(span.max()) + 1), 'i8')
+            numpy.cumsum(demand[:, now - window:now + int(span.max())], axis=1, dtype='i8', out=totals[:, 1:])
+            before = totals[:, window] - totals[:, 0]
+            after = numpy.take_along_axis(totals, (window + span)[:, None], axis=1)[:, 0] - totals[:, window]
+            enough = before >= SEASON_UNITS
+            ratio = numpy.divide(after * window, before * span, out=numpy.ones(count), where=enough)
+            seasonal = numpy.clip(ratio, *SEASON_LIMITS)
+
+        daily = average * seasonal
+        reorder_points = numpy.ceil(daily * lead + service_z * sigma * numpy.sqrt(lead))
+        order_up_to = numpy.ceil(daily * horizon + service_z * sigma * numpy.sqrt(horizon))
+        order = numpy.where(known & (stock <= reorder_points) & (order_up_to > stock), order_up_to - stock, 0)
+        days_left = numpy.divide(stock, daily, out=numpy.full(count, numpy.inf), where=daily > 0)
+
+        rows = numpy.flatnonzero(order)
+        rows = rows[numpy.argsort(days_left[rows], kind='stable')]
+        return [{
+            'code': self.codes[row],
+            'name': products[row]['name'],
+            'stock': int(stock[row]),
+            'average_7': round(float(average_7[row]), 2),
+            'average': round(float(average[row]), 2),
+            'seasonal': round(float(seasonal[row]), 2),
+            'daily': round(float(daily[row]), 2),
+            'days_left': round(float(days_left[row]), 1) if numpy.isfinite(days_left[row]) else None,
+            'lead_time': int(lead[row]),
+            'reorder_point': int(reorder_points[row]),
+            'order': int(order[row])
+        } for row in rows.tolist()]
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Demand forecast and purchase suggestions")
+    parser.add_argument('--lead-time', type=int, default=LEAD_TIME, help="Days from order to delivery")
+    parser.add_argument('--review-days', type=int, default=REVIEW_DAYS, help="Days until the next order")
+    parser.add_argument('--window', type=int, default=WINDOW, help="Days in the moving average")
+    parser.add_argument('--json', action='store_true', help="Print the suggestions as JSON")
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    storage = open_storage(data_dir=args.data_dir)
+    started = time.perf_counter()
+    forecast = DemandForecast(storage.products)
+    forecast.prepare(storage)()
+    forecast.finish()
+    suggestions = forecast.suggestions(lead_time=args.lead_time, review_days=args.review_days,
+                                       window=args.window)
+    elapsed = time.perf_counter() - started
+    storage.close()
+
+    if args.json:
+        print(json.dumps(suggestions, indent=4))
+        return
+
+    print(f"=== Purchase Suggestions ({len(forecast.codes)} products forecast in {elapsed:.2f} s) ===")
+    print("Code\tName\t\t\tStock\tPer Day\tSeason\tDays Left\tReorder At\tOrder")
+    for suggestion in suggestions:
+        days_left = f"{suggestion['days_left']:.1f}" if suggestion['days_left'] is not None else '-'
+        print(f"{suggestion['code']}\t{suggestion['name'][:20]:<20}\t{suggestion['stock']}\t"
+              f"{suggestion['daily']:.2f}\t{suggestion['seasonal']:.2f}\t{days_left}\t\t"
+              f"{suggestion['reorder_point']}\t\t{suggestion['order']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,32 @@
+import time
+
+# Cold start is measured from here to the first idle moment of the window
+START_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, messagebox
-import json
 import os
-from datetime import datetime
-import calendar
-import shutil
+import sys
+import heapq
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
+from pharmacy_storage import open_storage
+from pharmacy_core import SalesEngine, SaleError, format_receipt
+from pharmacy_forecast import LEAD_TIME, REVIEW_DAYS
+from pharmacy_cart import Cart
+from pharmacy_persist import PersistenceWorker
+from pharmacy_views import VirtualTree, ROW_HEIGHT
+from pharmacy_stock import reorder_point
+from pharmacy_metrics import metrics, HOT_PATHS
+from pharmacy_models import to_sale
+from pharmacy_reports import ReportCache
+
+# Startup budget in seconds; going over it is reported on stderr
+STARTUP_BUDGET = float(os.environ.get('PHARMACY_STARTUP_BUDGET', '1.0'))
+
+# Functions called with the startup time once the window is up
+startup_hooks = []
 
 class PharmacyGUI:
     def __init__(self, root):
@@ -15,30 +36,79 @@ class PharmacyGUI:
         self.root.configure(bg='#f0f0f0')
 
         # Initialize data
+        self.storage = None
         self.products = {}
-        self.sales = []
-        self.monthly_data = {}
-        self.current_month = datetime.now().strftime("%Y-%m")
         self.setup_data_directory()
+        # With PHARMACY_METRICS=1 the hot paths are timed; the methods are
+        # wrapped before any button or timer captures them
+        if metrics.configure('data'):
+            metrics.instrument(self, HOT_PATHS)
         self.load_data()
+        self.backups = None
+        self.startup_time = None
+
+        # Checkpoints and backups run on a background thread
+        self.persistence = PersistenceWorker(root, on_done=self.persistence_done,
+                                             on_error=self.persistence_failed)
+        self.storage.auto_checkpoint = False
 
         # Create main notebook for tabs
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(pady=10, expand=True)
 
+        # Tabs showing history fill in the first time they are opened
+        self.loaded_tabs = set()
+        self.tab_loaders = {
+            'Reports': self.load_reports_tab,
+            'Monthly Reports': self.load_monthly_reports_tab
+        }
+        self.notebook.bind('<<NotebookTabChanged>>', self.tab_changed)
+
         # Create tabs
         self.create_inventory_tab()
+        self.create_low_stock_tab()
+        self.create_purchasing_tab()
         self.create_sales_tab()
         self.create_reports_tab()
         self.create_monthly_reports_tab()
+        self.create_analytics_tab()
+
+        # Status bar for background saves and backups
+        self.status_var = tk.StringVar()
+        ttk.Label(root, textvariable=self.status_var, anchor='w').pack(side='bottom', fill='x', padx=10)
 
         # Style configuration
         style = ttk.Style()
-        style.configure("Treeview", font=('Arial', 10))
+        style.configure("Treeview", font=('Arial', 10), rowheight=ROW_HEIGHT)
         style.configure("TButton", padding=5, font=('Arial', 10))
 
-        # Auto-save timer
-        self.root.after(300000, self.auto_backup)  # Auto backup every 5 minutes
+        # Auto-save timer; a server backs up its own data
+        if self.server is None:
+            self.root.after(300000, self.auto_backup)  # Auto backup every 5 minutes
+        else:
+            self.root.after(2000, self.poll_server)
+
+        # Checkpoint on exit so the next start has nothing to replay
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        self.root.after_idle(self.startup_finished)
+        if metrics.enabled:
+            metrics.watch_event_loop(self.root)
+
+    def startup_finished(self):
+        self.startup_time = time.perf_counter() - START_TIME
+        message = f"Started in {self.startup_time * 1000:.0f} ms"
+        self.status_var.set(message)
+        if self.startup_time > STARTUP_BUDGET:
+            print(f"{message}, over the {STARTUP_BUDGET * 1000:.0f} ms budget", file=sys.stderr)
+        for hook in startup_hooks:
+            hook(self.startup_time)
+
+    def tab_changed(self, event=None):
+        name = self.notebook.tab(self.notebook.select(), 'text')
+        if name in self.tab_loaders and name not in self.loaded_tabs:
+            self.loaded_tabs.add(name)
+            self.tab_loaders[name]()
 
     def setup_data_directory(self):
         # Create directories for data organization
@@ -47,62 +117,108 @@ class PharmacyGUI:
         Path("backups").mkdir(exist_ok=True)
 
     def load_data(self):
-        # Load current data
-        if os.path.exists('data/products.json'):
-            with open('data/products.json', 'r') as f:
-                self.products = json.load(f)
-        
-        if os.path.exists('data/sales.json'):
-            with open('data/sales.json', 'r') as f:
-                self.sales = json.load(f)
-
-        # Load monthly data
-        monthly_file = f'data/monthly/{self.current_month}.json'
-        if os.path.exists(monthly_file):
-            with open(monthly_file, 'r') as f:
-                self.monthly_data = json.load(f)
+        # The storage backend (JSON files or SQLite) replays anything written
+        # since its last checkpoint; the product catalogue stays in memory.
+        # With PHARMACY_SERVER=host:port this till works through a shared
+        # pharmacy_server instead.
+        self.server = os.environ.get('PHARMACY_SERVER')
+        if self.server:
+            from pharmacy_client import RemoteEngine
+            self.engine = RemoteEngine(self.server)
+            self.storage = self.engine.storage
         else:
-            self.monthly_data = {
-                'sales': [],
-                'total_revenue': 0,
-                'products_sold': {},
-                'start_date': datetime.now().strftime("%Y-%m-%d")
-            }
+            self.storage = open_storage()
+            self.engine = SalesEngine(self.storage)
+        self.products = self.engine.products
+        self.cart = Cart(self.engine)
+        # Months already viewed are shown again without re-reading them
+        self.reports = ReportCache(self.storage)
+        # The engine reports products crossing their reorder point
+        self.engine.add_stock_listener(self.stock_changed)
 
     def save_data(self):
-        # Save current data
-        with open('data/products.json', 'w') as f:
-            json.dump(self.products, f, indent=4)
-        
-        with open('data/sales.json', 'w') as f:
-            json.dump(self.sales, f, indent=4)
-
-        # Save monthly data
-        monthly_file = f'data/monthly/{self.current_month}.json'
-        with open(monthly_file, 'w') as f:
-            json.dump(self.monthly_data, f, indent=4)
+        self.engine.checkpoint()
+
+    def checkpoint_now(self):
+        # Saved in place, once any background write has finished
+        self.persistence.wait()
+        self.engine.checkpoint()
+
+    def schedule_checkpoint(self):
+        # Sales are already durable in the journal; folding it into the
+        # snapshot files happens in the background
+        if self.engine.needs_checkpoint():
+            self.persistence.mark_dirty('checkpoint', self.engine.prepare_checkpoint)
+
+    def persistence_done(self, name):
+        self.status_var.set(f"{'Backup' if name == 'backup' else 'Data'} saved at {datetime.now().strftime('%H:%M:%S')}")
+
+    def persistence_failed(self, name, error):
+        self.status_var.set(f"{name.capitalize()} failed: {error}")
+        messagebox.showerror('Error', f'{name.capitalize()} failed: {error}')
+
+    def on_close(self):
+        # Stock held by an unfinished cart goes back to the other tills
+        if len(self.cart):
+            try:
+                self.cart.clear()
+            except (OSError, SaleError):
+                pass
+        # Finish any background write before the final checkpoint
+        self.persistence.flush()
+        self.engine.close()
+        metrics.close()
+        self.root.destroy()
+
+    def poll_server(self):
+        # Pick up stock changes made on other tills
+        try:
+            changed = self.engine.refresh()
+        except (OSError, SaleError) as e:
+            self.status_var.set(f"Server unavailable: {e}")
+            changed = []
+        if len(self.products) != len(self.product_view.keys):
+            self.refresh_product_list()
+        else:
+            for code in changed:
+                self.product_view.update(code)
+        self.root.after(2000, self.poll_server)
 
     def auto_backup(self):
-        # Create backup directory with timestamp
-        backup_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_dir = f"backups/backup_{backup_time}"
-        os.makedirs(backup_dir, exist_ok=True)
-
-        # Backup all data files
-        shutil.copy2('data/products.json', f'{backup_dir}/products.json')
-        shutil.copy2('data/sales.json', f'{backup_dir}/sales.json')
-        
-        # Backup monthly files
-        for file in os.listdir('data/monthly'):
-            shutil.copy2(f'data/monthly/{file}', f'{backup_dir}/{file}')
+        self.persistence.mark_dirty('backup', self.prepare_backup)
 
         # Schedule next backup
         self.root.after(300000, self.auto_backup)
 
+    def prepare_backup(self):
+        if self.backups is None:
+            from pharmacy_backup import BackupManager
+            self.backups = BackupManager('backups', 'data')
+
+        # Checkpoint first so the data files are self-contained
+        write = self.engine.prepare_checkpoint()
+
+        def backup():
+            write()
+            # Incremental snapshot: only changed files are copied, and
+            # nothing at all is written when no file changed since the last one
+            self.storage.backup(self.backups)
+            self.backups.prune()
+        return backup
+
     def create_inventory_tab(self):
         inventory_frame = ttk.Frame(self.notebook)
         self.notebook.add(inventory_frame, text='Inventory')
 
+        # Filter
+        filter_frame = ttk.Frame(inventory_frame)
+        filter_frame.pack(pady=(10, 0), padx=10, fill='x')
+        ttk.Label(filter_frame, text='Filter:').pack(side='left', padx=5)
+        self.product_filter_entry = ttk.Entry(filter_frame)
+        self.product_filter_entry.pack(side='left', padx=5)
+        self.product_filter_entry.bind('<KeyRelease>',
+                                       lambda event: self.product_view.set_filter(self.product_filter_entry.get()))
+
         # Product List
         tree_frame = ttk.Frame(inventory_frame)
         tree_frame.pack(pady=10, padx=10, fill='both', expand=True)
@@ -113,8 +229,10 @@ class PharmacyGUI:
         self.product_tree.heading('Price', text='Price')
         self.product_tree.heading('Quantity', text='Quantity')
 
-        scrollbar = ttk.Scrollbar(tree_frame, orient='vertical', command=self.product_tree.yview)
-        self.product_tree.configure(yscrollcommand=scrollbar.set)
+        # Only the visible rows exist in the widget; headings sort the list
+        scrollbar = ttk.Scrollbar(tree_frame, orient='vertical')
+        self.product_view = VirtualTree(self.product_tree, scrollbar, self.product_row,
+                                        sort_value=self.product_sort_value)
 
         self.product_tree.pack(side='left', fill='both', expand=True)
         scrollbar.pack(side='right', fill='y')
@@ -139,10 +257,302 @@ class PharmacyGUI:
         self.quantity_entry = ttk.Entry(form_frame)
         self.quantity_entry.grid(row=1, column=3, padx=5, pady=5)
 
-        ttk.Button(form_frame, text='Add Product', command=self.add_product).grid(row=2, column=0, columnspan=4, pady=10)
+        ttk.Label(form_frame, text='Barcode:').grid(row=2, column=0, padx=5, pady=5)
+        self.barcode_entry = ttk.Entry(form_frame)
+        self.barcode_entry.grid(row=2, column=1, padx=5, pady=5)
+
+        ttk.Label(form_frame, text='Reorder Point:').grid(row=2, column=2, padx=5, pady=5)
+        self.reorder_entry = ttk.Entry(form_frame)
+        self.reorder_entry.grid(row=2, column=3, padx=5, pady=5)
+
+        ttk.Button(form_frame, text='Add Product', command=self.add_product).grid(row=3, column=0, columnspan=4, pady=10)
+
+        # Bulk import and export, CSV or JSON Lines
+        bulk_frame = ttk.LabelFrame(inventory_frame, text='Import / Export')
+        bulk_frame.pack(pady=(0, 10), padx=10, fill='x')
+        self.import_kind_var = tk.StringVar(value='products')
+        ttk.Combobox(bulk_frame, textvariable=self.import_kind_var, values=['products', 'stock', 'sales'],
+                     state='readonly', width=10).pack(side='left', padx=5)
+        ttk.Button(bulk_frame, text='Import...', command=self.import_file).pack(side='left', padx=5)
+        ttk.Label(bulk_frame, text='Sales from:').pack(side='left', padx=5)
+        self.export_start_entry = ttk.Entry(bulk_frame, width=12)
+        self.export_start_entry.pack(side='left')
+        ttk.Label(bulk_frame, text='to:').pack(side='left', padx=5)
+        self.export_end_entry = ttk.Entry(bulk_frame, width=12)
+        self.export_end_entry.pack(side='left')
+        ttk.Button(bulk_frame, text='Export Sales...', command=self.export_sales).pack(side='left', padx=5)
+        self.bulk_progress = ttk.Progressbar(bulk_frame, maximum=100)
+        self.bulk_progress.pack(side='left', padx=5, fill='x', expand=True)
+        self.bulk_running = False
 
         self.refresh_product_list()
 
+    def create_low_stock_tab(self):
+        low_stock_frame = ttk.Frame(self.notebook)
+        self.notebook.add(low_stock_frame, text='Low Stock')
+
+        # Products below their reorder point, most urgent first
+        list_frame = ttk.LabelFrame(low_stock_frame, text='Below Reorder Point')
+        list_frame.pack(pady=10, padx=10, fill='both', expand=True)
+
+        self.low_stock_tree = ttk.Treeview(list_frame, columns=('Code', 'Name', 'Quantity', 'Reorder Point'),
+                                           show='headings')
+        for column in ('Code', 'Name', 'Quantity', 'Reorder Point'):
+            self.low_stock_tree.heading(column, text=column)
+        self.low_stock_tree.pack(pady=5, fill='both', expand=True)
+
+        # Restock or change a product's reorder point
+        form_frame = ttk.Frame(low_stock_frame)
+        form_frame.pack(pady=10, padx=10, fill='x')
+
+        ttk.Label(form_frame, text='Product Code:').pack(side='left', padx=5)
+        self.stock_code_entry = ttk.Entry(form_frame, width=12)
+        self.stock_code_entry.pack(side='left', padx=5)
+        self.low_stock_tree.bind('<<TreeviewSelect>>', self.choose_low_stock_product)
+
+        ttk.Label(form_frame, text='Quantity:').pack(side='left', padx=5)
+        self.stock_quantity_entry = ttk.Entry(form_frame, width=8)
+        self.stock_quantity_entry.pack(side='left', padx=5)
+        # Optional; a delivery with a lot tracks the product by lot
+        ttk.Label(form_frame, text='Lot:').pack(side='left', padx=5)
+        self.stock_lot_entry = ttk.Entry(form_frame, width=10)
+        self.stock_lot_entry.pack(side='left', padx=5)
+        ttk.Label(form_frame, text='Expiry:').pack(side='left', padx=5)
+        self.stock_expiry_entry = ttk.Entry(form_frame, width=11)
+        self.stock_expiry_entry.pack(side='left', padx=5)
+        ttk.Button(form_frame, text='Restock', command=self.restock_product).pack(side='left', padx=5)
+
+        ttk.Label(form_frame, text='Reorder Point:').pack(side='left', padx=5)
+        self.stock_reorder_entry = ttk.Entry(form_frame, width=8)
+        self.stock_reorder_entry.pack(side='left', padx=5)
+        ttk.Button(form_frame, text='Set', command=self.set_reorder_point).pack(side='left', padx=5)
+
+        # Lots expiring soon, from the engine's expiry index
+        expiring_frame = ttk.LabelFrame(low_stock_frame, text='Expiring Lots')
+        expiring_frame.pack(pady=10, padx=10, fill='both', expand=True)
+
+        days_frame = ttk.Frame(expiring_frame)
+        days_frame.pack(fill='x')
+        ttk.Label(days_frame, text='Within days:').pack(side='left', padx=5)
+        self.expiring_days_entry = ttk.Entry(days_frame, width=6)
+        self.expiring_days_entry.insert(0, '30')
+        self.expiring_days_entry.pack(side='left', padx=5)
+        ttk.Button(days_frame, text='Show', command=self.refresh_expiring).pack(side='left', padx=5)
+        ttk.Button(days_frame, text='Write Off Lot', command=self.write_off_lot).pack(side='left', padx=5)
+
+        self.expiring_tree = ttk.Treeview(expiring_frame, columns=('Expiry', 'Code', 'Name', 'Lot', 'Quantity'),
+                                          show='headings')
+        for column in ('Expiry', 'Code', 'Name', 'Lot', 'Quantity'):
+            self.expiring_tree.heading(column, text=column)
+        self.expiring_tree.pack(pady=5, fill='both', expand=True)
+
+        self.refresh_low_stock()
+        # After the window is up: the first query builds the expiry index
+        self.root.after_idle(self.refresh_expiring)
+
+    def refresh_low_stock(self):
+        self.low_stock_tree.delete(*self.low_stock_tree.get_children())
+        for code in self.engine.low_stock():
+            product = self.products[code]
+            self.low_stock_tree.insert('', 'end', iid=code, values=(
+                code, product['name'], product['quantity'], reorder_point(product)))
+            metrics.count('rows_rendered')
+
+    def refresh_expiring(self):
+        try:
+            days = int(self.expiring_days_entry.get())
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid number of days!')
+            return
+        today = datetime.now().strftime("%Y-%m-%d")
+        self.expiring_tree.delete(*self.expiring_tree.get_children())
+        for lot in self.engine.expiring(days):
+            expiry = f"{lot['expiry']} (expired)" if lot['expiry'] < today else lot['expiry']
+            self.expiring_tree.insert('', 'end', iid=f"{lot['code']}\t{lot['lot']}", values=(
+                expiry, lot['code'], lot['name'], lot['lot'], lot['quantity']))
+            metrics.count('rows_rendered')
+
+    def write_off_lot(self):
+        selection = self.expiring_tree.selection()
+        if not selection:
+            messagebox.showerror('Error', 'Select a lot first!')
+            return
+        code, lot = selection[0].split('\t', 1)
+        if not messagebox.askyesno('Write Off', f"Take lot {lot} of {self.products[code]['name']} out of stock?"):
+            return
+        try:
+            self.engine.write_off(code, lot)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+        self.schedule_checkpoint()
+        self.product_view.update(code)
+        self.refresh_low_stock()
+        self.refresh_expiring()
+
+    def stock_changed(self, event, code):
+        if event == 'low':
+            product = self.products[code]
+            self.status_var.set(f"Low stock: {product['name']} ({product['quantity']} left)")
+        self.refresh_low_stock()
+
+    def choose_low_stock_product(self, event=None):
+        selection = self.low_stock_tree.selection()
+        if selection:
+            self.stock_code_entry.delete(0, 'end')
+            self.stock_code_entry.insert(0, selection[0])
+
+    def restock_product(self):
+        code = self.stock_code_entry.get().strip()
+        try:
+            quantity = int(self.stock_quantity_entry.get())
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid quantity!')
+            return
+
+        lot = self.stock_lot_entry.get().strip() or None
+        expiry = self.stock_expiry_entry.get().strip() or None
+        try:
+            self.engine.restock(code, quantity, lot, expiry)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+
+        self.schedule_checkpoint()
+        self.product_view.update(code)
+        self.refresh_low_stock()
+        if expiry:
+            self.refresh_expiring()
+        self.stock_quantity_entry.delete(0, 'end')
+        self.stock_lot_entry.delete(0, 'end')
+        self.stock_expiry_entry.delete(0, 'end')
+
+    def set_reorder_point(self):
+        code = self.stock_code_entry.get().strip()
+        try:
+            point = int(self.stock_reorder_entry.get())
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid reorder point!')
+            return
+
+        try:
+            self.engine.set_reorder_point(code, point)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+
+        self.schedule_checkpoint()
+        self.refresh_low_stock()
+        self.stock_reorder_entry.delete(0, 'end')
+
+    def create_purchasing_tab(self):
+        purchasing_frame = ttk.Frame(self.notebook)
+        self.notebook.add(purchasing_frame, text='Purchasing')
+
+        settings_frame = ttk.Frame(purchasing_frame)
+        settings_frame.pack(pady=5, padx=10, fill='x')
+
+        ttk.Label(settings_frame, text="Lead time (days):").pack(side='left', padx=5)
+        self.lead_time_entry = ttk.Entry(settings_frame, width=6)
+        self.lead_time_entry.insert(0, str(LEAD_TIME))
+        self.lead_time_entry.pack(side='left', padx=5)
+
+        ttk.Label(settings_frame, text="Days between orders:").pack(side='left', padx=5)
+        self.review_days_entry = ttk.Entry(settings_frame, width=6)
+        self.review_days_entry.insert(0, str(REVIEW_DAYS))
+        self.review_days_entry.pack(side='left', padx=5)
+
+        self.suggest_button = ttk.Button(settings_frame, text="Suggest Orders", command=self.suggest_orders)
+        self.suggest_button.pack(side='left', padx=5)
+        ttk.Button(settings_frame, text="Use Suggested Reorder Point",
+                   command=self.use_suggested_reorder_point).pack(side='left', padx=5)
+
+        # Products to order now, the ones that run out first at the top
+        list_frame = ttk.LabelFrame(purchasing_frame, text='Purchase Suggestions')
+        list_frame.pack(pady=10, padx=10, fill='both', expand=True)
+        columns = ('Code', 'Name', 'Stock', 'Per Day', 'Season', 'Days Left', 'Reorder At', 'Order')
+        self.suggestions_tree = ttk.Treeview(list_frame, columns=columns, show='headings')
+        for column in columns:
+            self.suggestions_tree.heading(column, text=column)
+        self.suggestions_tree.pack(pady=5, fill='both', expand=True)
+        self.purchase_suggestions = {}
+
+    def suggest_orders(self):
+        try:
+            lead_time = int(self.lead_time_entry.get())
+            review_days = int(self.review_days_entry.get())
+        except ValueError:
+            messagebox.showerror("Error", "Invalid number of days!")
+            return
+
+        # The first time, the sales history is read into the demand matrix on
+        # a background thread; the engine keeps it current afterwards
+        if self.server is None and self.engine.forecast is None:
+            try:
+                run = self.engine.prepare_forecast()
+            except SaleError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            result = {}
+
+            def work():
+                try:
+                    run()
+                except Exception as e:
+                    result['error'] = e
+
+            thread = threading.Thread(target=work, name='forecast', daemon=True)
+            thread.start()
+            self.suggest_button.config(state='disabled')
+            self.status_var.set("Reading sales history for the forecast...")
+            self.root.after(100, self.forecast_ready, thread, result, lead_time, review_days)
+            return
+        self.show_suggestions(lead_time, review_days)
+
+    def forecast_ready(self, thread, result, lead_time, review_days):
+        if thread.is_alive():
+            self.root.after(100, self.forecast_ready, thread, result, lead_time, review_days)
+            return
+        self.suggest_button.config(state='normal')
+        if 'error' in result:
+            self.engine.forecast = None
+            self.status_var.set("Forecast failed")
+            messagebox.showerror("Error", f"Forecast failed: {result['error']}")
+            return
+        self.status_var.set("Forecast ready")
+        self.show_suggestions(lead_time, review_days)
+
+    def show_suggestions(self, lead_time, review_days):
+        try:
+            suggestions = self.engine.purchase_suggestions(lead_time, review_days)
+        except SaleError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.purchase_suggestions = {suggestion['code']: suggestion for suggestion in suggestions}
+        self.suggestions_tree.delete(*self.suggestions_tree.get_children())
+        for suggestion in suggestions:
+            days_left = f"{suggestion['days_left']:.1f}" if suggestion['days_left'] is not None else '-'
+            self.suggestions_tree.insert('', 'end', iid=suggestion['code'], values=(
+                suggestion['code'], suggestion['name'], suggestion['stock'], f"{suggestion['daily']:.2f}",
+                f"{suggestion['seasonal']:.2f}", days_left, suggestion['reorder_point'], suggestion['order']))
+            metrics.count('rows_rendered')
+
+    def use_suggested_reorder_point(self):
+        selection = self.suggestions_tree.selection()
+        if not selection:
+            messagebox.showerror('Error', 'Select a product first!')
+            return
+        code = selection[0]
+        try:
+            self.engine.set_reorder_point(code, self.purchase_suggestions[code]['reorder_point'])
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+        self.schedule_checkpoint()
+        self.refresh_low_stock()
+        self.status_var.set(f"Reorder point of {self.products[code]['name']} set to "
+                            f"{self.purchase_suggestions[code]['reorder_point']}")
+
     def create_sales_tab(self):
         sales_frame = ttk.Frame(self.notebook)
         self.notebook.add(sales_frame, text='Sales')
@@ -158,6 +568,14 @@ class PharmacyGUI:
         self.cart_tree.heading('Quantity', text='Quantity')
         self.cart_tree.heading('Total', text='Total')
         self.cart_tree.pack(pady=5, fill='both', expand=True)
+        # Rows are keyed by product code, one per cart line
+
+        cart_buttons = ttk.Frame(cart_frame)
+        cart_buttons.pack(fill='x')
+        ttk.Button(cart_buttons, text='Remove Item', command=self.void_cart_line).pack(side='left', padx=5)
+        ttk.Button(cart_buttons, text='Set Quantity', command=self.set_cart_quantity).pack(side='left', padx=5)
+        self.cart_total_var = tk.StringVar(value='Total: $0.00')
+        ttk.Label(cart_buttons, textvariable=self.cart_total_var).pack(side='right', padx=5)
 
         # Add to Cart Form
         form_frame = ttk.Frame(sales_frame)
@@ -166,6 +584,9 @@ class PharmacyGUI:
         ttk.Label(form_frame, text='Product Code:').pack(side='left', padx=5)
         self.sale_code_entry = ttk.Entry(form_frame)
         self.sale_code_entry.pack(side='left', padx=5)
+        # Code, barcode or part of a name; Enter takes a scanned barcode
+        self.sale_code_entry.bind('<KeyRelease>', self.update_suggestions)
+        self.sale_code_entry.bind('<Return>', self.choose_exact_product)
 
         ttk.Label(form_frame, text='Quantity:').pack(side='left', padx=5)
         self.sale_quantity_entry = ttk.Entry(form_frame)
@@ -174,6 +595,12 @@ class PharmacyGUI:
         ttk.Button(form_frame, text='Add to Cart', command=self.add_to_cart).pack(side='left', padx=5)
         ttk.Button(form_frame, text='Complete Sale', command=self.complete_sale).pack(side='left', padx=5)
 
+        # As-you-type suggestions for the product entry
+        self.suggestions = []
+        self.suggestion_list = tk.Listbox(sales_frame, height=6)
+        self.suggestion_list.pack(pady=(0, 10), padx=10, fill='x')
+        self.suggestion_list.bind('<<ListboxSelect>>', self.choose_suggestion)
+
     def create_reports_tab(self):
         reports_frame = ttk.Frame(self.notebook)
         self.notebook.add(reports_frame, text='Reports')
@@ -186,9 +613,52 @@ class PharmacyGUI:
         self.sales_tree.heading('Date', text='Date')
         self.sales_tree.heading('Items', text='Items')
         self.sales_tree.heading('Total', text='Total')
-        self.sales_tree.pack(pady=5, fill='both', expand=True)
 
+        scrollbar = ttk.Scrollbar(report_frame, orient='vertical')
+        self.sales_rows = []
+        self.sales_view = VirtualTree(self.sales_tree, scrollbar, self.sale_row,
+                                      sort_value=self.sale_sort_value)
+        self.sales_tree.pack(side='left', pady=5, fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+
+        # Sales by date range, answered from the rollups
+        range_frame = ttk.LabelFrame(reports_frame, text='Sales by Date Range')
+        range_frame.pack(pady=10, padx=10, fill='both', expand=True)
+
+        selector_frame = ttk.Frame(range_frame)
+        selector_frame.pack(pady=5, fill='x')
+        ttk.Label(selector_frame, text='From:').pack(side='left', padx=5)
+        self.range_start_entry = ttk.Entry(selector_frame, width=12)
+        self.range_start_entry.pack(side='left', padx=5)
+        ttk.Label(selector_frame, text='To:').pack(side='left', padx=5)
+        self.range_end_entry = ttk.Entry(selector_frame, width=12)
+        self.range_end_entry.pack(side='left', padx=5)
+        ttk.Label(selector_frame, text='Product Code:').pack(side='left', padx=5)
+        self.range_code_entry = ttk.Entry(selector_frame, width=10)
+        self.range_code_entry.pack(side='left', padx=5)
+        ttk.Button(selector_frame, text='View', command=self.show_range_report).pack(side='left', padx=5)
+
+        presets_frame = ttk.Frame(range_frame)
+        presets_frame.pack(pady=5, fill='x')
+        for label in ('Today', 'This Week', 'This Month', 'Year to Date'):
+            ttk.Button(presets_frame, text=label,
+                       command=lambda label=label: self.set_range_preset(label)).pack(side='left', padx=5)
+
+        self.range_stats_tree = ttk.Treeview(range_frame, columns=('Metric', 'Value'), show='headings', height=3)
+        self.range_stats_tree.heading('Metric', text='Metric')
+        self.range_stats_tree.heading('Value', text='Value')
+        self.range_stats_tree.pack(side='left', pady=5, padx=5, fill='both', expand=True)
+
+        self.range_products_tree = ttk.Treeview(range_frame, columns=('Product', 'Quantity', 'Revenue'),
+                                                show='headings', height=5)
+        self.range_products_tree.heading('Product', text='Product')
+        self.range_products_tree.heading('Quantity', text='Quantity Sold')
+        self.range_products_tree.heading('Revenue', text='Revenue')
+        self.range_products_tree.pack(side='left', pady=5, padx=5, fill='both', expand=True)
+
+    def load_reports_tab(self):
         self.refresh_sales_report()
+        self.set_range_preset('This Month')
 
     def create_monthly_reports_tab(self):
         monthly_frame = ttk.Frame(self.notebook)
@@ -198,16 +668,13 @@ class PharmacyGUI:
         selector_frame = ttk.Frame(monthly_frame)
         selector_frame.pack(pady=5, padx=10, fill='x')
 
-        years = sorted(set(file[:4] for file in os.listdir('data/monthly') if file.endswith('.json')))
-        if not years:
-            years = [datetime.now().strftime("%Y")]
-
-        self.year_var = tk.StringVar(value=years[-1])
+        # The years on file are listed when the tab is first opened
+        self.year_var = tk.StringVar(value=datetime.now().strftime("%Y"))
         self.month_var = tk.StringVar(value=datetime.now().strftime("%m"))
 
         ttk.Label(selector_frame, text="Year:").pack(side='left', padx=5)
-        year_combo = ttk.Combobox(selector_frame, textvariable=self.year_var, values=years)
-        year_combo.pack(side='left', padx=5)
+        self.year_combo = ttk.Combobox(selector_frame, textvariable=self.year_var, values=[self.year_var.get()])
+        self.year_combo.pack(side='left', padx=5)
 
         ttk.Label(selector_frame, text="Month:").pack(side='left', padx=5)
         month_combo = ttk.Combobox(selector_frame, textvariable=self.month_var, 
@@ -240,17 +707,153 @@ class PharmacyGUI:
         self.top_products_tree.heading('Revenue', text='Revenue')
         self.top_products_tree.pack(pady=5, fill='both', expand=True)
 
+    def create_analytics_tab(self):
+        analytics_frame = ttk.Frame(self.notebook)
+        self.notebook.add(analytics_frame, text='Analytics')
+
+        # Any span of months, every month when left empty
+        selector_frame = ttk.Frame(analytics_frame)
+        selector_frame.pack(pady=5, padx=10, fill='x')
+
+        ttk.Label(selector_frame, text="From (YYYY-MM):").pack(side='left', padx=5)
+        self.analytics_from_entry = ttk.Entry(selector_frame, width=10)
+        self.analytics_from_entry.pack(side='left', padx=5)
+
+        ttk.Label(selector_frame, text="To (YYYY-MM):").pack(side='left', padx=5)
+        self.analytics_to_entry = ttk.Entry(selector_frame, width=10)
+        self.analytics_to_entry.pack(side='left', padx=5)
+
+        ttk.Label(selector_frame, text="Top by:").pack(side='left', padx=5)
+        self.analytics_by_var = tk.StringVar(value='Revenue')
+        ttk.Combobox(selector_frame, textvariable=self.analytics_by_var, values=['Revenue', 'Quantity'],
+                     width=10).pack(side='left', padx=5)
+
+        self.analytics_button = ttk.Button(selector_frame, text="Run", command=self.run_analytics)
+        self.analytics_button.pack(side='left', padx=5)
+
+        top_frame = ttk.Frame(analytics_frame)
+        top_frame.pack(pady=5, padx=10, fill='both', expand=True)
+
+        years_frame = ttk.LabelFrame(top_frame, text='Revenue by Year')
+        years_frame.pack(side='left', padx=5, fill='both', expand=True)
+        self.analytics_years_tree = ttk.Treeview(years_frame, columns=('Year', 'Sales', 'Revenue', 'Growth'),
+                                                 show='headings')
+        for column in ('Year', 'Sales', 'Revenue', 'Growth'):
+            self.analytics_years_tree.heading(column, text=column)
+        self.analytics_years_tree.pack(pady=5, fill='both', expand=True)
+
+        basket_frame = ttk.LabelFrame(top_frame, text='Baskets')
+        basket_frame.pack(side='left', padx=5, fill='both', expand=True)
+        self.analytics_basket_tree = ttk.Treeview(basket_frame, columns=('Metric', 'Value'), show='headings')
+        self.analytics_basket_tree.heading('Metric', text='Metric')
+        self.analytics_basket_tree.heading('Value', text='Value')
+        self.analytics_basket_tree.pack(pady=5, fill='both', expand=True)
+
+        bottom_frame = ttk.Frame(analytics_frame)
+        bottom_frame.pack(pady=5, padx=10, fill='both', expand=True)
+
+        products_frame = ttk.LabelFrame(bottom_frame, text='Top Products')
+        products_frame.pack(side='left', padx=5, fill='both', expand=True)
+        self.analytics_products_tree = ttk.Treeview(products_frame, columns=('Product', 'Quantity', 'Revenue'),
+                                                    show='headings')
+        self.analytics_products_tree.heading('Product', text='Product')
+        self.analytics_products_tree.heading('Quantity', text='Quantity Sold')
+        self.analytics_products_tree.heading('Revenue', text='Revenue')
+        self.analytics_products_tree.pack(pady=5, fill='both', expand=True)
+
+        trends_frame = ttk.LabelFrame(bottom_frame, text='Trends (last 3 months vs the 3 before)')
+        trends_frame.pack(side='left', padx=5, fill='both', expand=True)
+        self.analytics_trends_tree = ttk.Treeview(trends_frame, columns=('Product', 'Change'), show='headings')
+        self.analytics_trends_tree.heading('Product', text='Product')
+        self.analytics_trends_tree.heading('Change', text='Change')
+        self.analytics_trends_tree.pack(pady=5, fill='both', expand=True)
+
+    def run_analytics(self):
+        first = self.analytics_from_entry.get().strip() or None
+        last = self.analytics_to_entry.get().strip() or None
+        try:
+            for month in (first, last):
+                if month:
+                    datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            messagebox.showerror("Error", "Months must be in YYYY-MM format!")
+            return
+
+        # Loaded on first use; the months are scanned by worker processes
+        # from a background thread so the window stays responsive
+        from pharmacy_analytics import Analytics
+        run = Analytics(self.storage).prepare(first, last)
+        result = {}
+
+        def work():
+            try:
+                result['report'] = run()
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=work, name='analytics', daemon=True)
+        thread.start()
+        self.analytics_button.config(state='disabled')
+        self.status_var.set("Running analytics...")
+        self.root.after(100, self.analytics_finished, thread, result)
+
+    def analytics_finished(self, thread, result):
+        if thread.is_alive():
+            self.root.after(100, self.analytics_finished, thread, result)
+            return
+        self.analytics_button.config(state='normal')
+        if 'error' in result:
+            self.status_var.set("Analytics failed")
+            messagebox.showerror("Error", f"Analytics failed: {result['error']}")
+            return
+        self.status_var.set("Analytics ready")
+        self.show_analytics(result['report'])
+
+    def show_analytics(self, report):
+        from pharmacy_analytics import top_products, product_trends
+
+        for tree in (self.analytics_years_tree, self.analytics_basket_tree,
+                     self.analytics_products_tree, self.analytics_trends_tree):
+            tree.delete(*tree.get_children())
+
+        for year, totals in sorted(report['years'].items()):
+            growth = f"{totals['growth']:+.1f}%" if totals['growth'] is not None else '-'
+            self.analytics_years_tree.insert('', 'end', values=(
+                year, totals['sales'], f"${totals['revenue']:.2f}", growth))
+
+        by = self.analytics_by_var.get().lower()
+        for code, product in top_products(report, 10, by if by in ('revenue', 'quantity') else 'revenue'):
+            self.analytics_products_tree.insert('', 'end', values=(
+                product['name'], product['quantity'], f"${product['revenue']:.2f}"))
+
+        risers, fallers = product_trends(report, limit=5)
+        for code, product, change in risers + fallers:
+            self.analytics_trends_tree.insert('', 'end', values=(product['name'], f"{change:+.1f}%"))
+
+        basket = report['basket']
+        for metric, value in (('Sales', basket['sales']),
+                              ('Average Value', f"${basket['average_value']:.2f}"),
+                              ('Average Lines', f"{basket['average_lines']:.2f}"),
+                              ('Median Lines', basket['median_lines']),
+                              ('Average Units', f"{basket['average_units']:.2f}"),
+                              ('Single-Item Sales', f"{basket['single_item_share']:.1f}%"),
+                              ('Largest Basket', f"${basket['largest_basket']:.2f}")):
+            self.analytics_basket_tree.insert('', 'end', values=(metric, value))
+
+    def load_monthly_reports_tab(self):
+        years = sorted(set(month[:4] for month in self.storage.list_months()))
+        if years:
+            self.year_combo['values'] = years
+            self.year_var.set(years[-1])
+
     def show_monthly_report(self):
         selected_month = f"{self.year_var.get()}-{self.month_var.get()}"
-        monthly_file = f'data/monthly/{selected_month}.json'
+        data = self.reports.report(selected_month)
 
-        if not os.path.exists(monthly_file):
+        if data is None:
             messagebox.showinfo("Info", "No data available for selected month")
             return
 
-        with open(monthly_file, 'r') as f:
-            data = json.load(f)
-
         # Clear existing data
         for item in self.monthly_stats_tree.get_children():
             self.monthly_stats_tree.delete(item)
@@ -259,17 +862,58 @@ class PharmacyGUI:
 
         # Update statistics
         self.monthly_stats_tree.insert('', 'end', values=('Total Revenue', f"${data['total_revenue']:.2f}"))
-        self.monthly_stats_tree.insert('', 'end', values=('Total Sales', len(data['sales'])))
+        self.monthly_stats_tree.insert('', 'end', values=('Total Sales', data['sale_count']))
         self.monthly_stats_tree.insert('', 'end', values=('Start Date', data['start_date']))
         
-        # Update top products
-        sorted_products = sorted(data['products_sold'].items(), 
-                               key=lambda x: x[1]['revenue'], 
-                               reverse=True)
-        for product_code, stats in sorted_products[:10]:  # Show top 10
-            product_name = self.products[product_code]['name']
+        # Top products come ready-sorted with the report
+        for product_code, quantity, revenue in data['top_products']:
+            product_name = self.products[product_code]['name'] if product_code in self.products else product_code
             self.top_products_tree.insert('', 'end', values=(
                 product_name,
+                quantity,
+                f"${revenue:.2f}"
+            ))
+
+    def set_range_preset(self, preset):
+        today = datetime.now().date()
+        if preset == 'This Week':
+            start = today - timedelta(days=today.weekday())
+        elif preset == 'This Month':
+            start = today.replace(day=1)
+        elif preset == 'Year to Date':
+            start = today.replace(month=1, day=1)
+        else:
+            start = today
+        self.range_start_entry.delete(0, 'end')
+        self.range_start_entry.insert(0, start.strftime("%Y-%m-%d"))
+        self.range_end_entry.delete(0, 'end')
+        self.range_end_entry.insert(0, today.strftime("%Y-%m-%d"))
+        self.show_range_report()
+
+    def show_range_report(self):
+        # Both dates are inclusive in the form; the rollups take an exclusive end
+        try:
+            start = datetime.strptime(self.range_start_entry.get().strip(), "%Y-%m-%d")
+            end = datetime.strptime(self.range_end_entry.get().strip(), "%Y-%m-%d") + timedelta(days=1)
+        except ValueError:
+            messagebox.showerror('Error', 'Dates must be in YYYY-MM-DD format!')
+            return
+        code = self.range_code_entry.get().strip() or None
+
+        result = self.engine.sales_between(start, end, code)
+
+        self.range_stats_tree.delete(*self.range_stats_tree.get_children())
+        self.range_products_tree.delete(*self.range_products_tree.get_children())
+
+        self.range_stats_tree.insert('', 'end', values=('Total Revenue', f"${result['revenue']:.2f}"))
+        if code is None:
+            self.range_stats_tree.insert('', 'end', values=('Total Sales', result['sales']))
+
+        top_products = heapq.nlargest(10, result['products'].items(), key=lambda x: x[1]['revenue'])
+        for product_code, stats in top_products:
+            product = self.products.get(product_code)
+            self.range_products_tree.insert('', 'end', values=(
+                product['name'] if product else product_code,
                 stats['quantity'],
                 f"${stats['revenue']:.2f}"
             ))
@@ -280,139 +924,263 @@ class PharmacyGUI:
             name = self.name_entry.get()
             price = float(self.price_entry.get())
             quantity = int(self.quantity_entry.get())
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid price or quantity!')
+            return
+        barcode = self.barcode_entry.get().strip() or None
+        try:
+            point = int(self.reorder_entry.get()) if self.reorder_entry.get().strip() else None
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid reorder point!')
+            return
 
-            if code in self.products:
-                messagebox.showerror('Error', 'Product code already exists!')
-                return
+        try:
+            self.engine.add_product(code, name, price, quantity, barcode, point)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
 
-            if not all([code, name, price > 0, quantity >= 0]):
-                messagebox.showerror('Error', 'Please fill all fields correctly!')
-                return
+        self.schedule_checkpoint()
+        self.product_view.append(code)
+        self.clear_product_form()
+        messagebox.showinfo('Success', f'Product "{name}" added successfully!')
 
-            self.products[code] = {
-                'name': name,
-                'price': price,
-                'quantity': quantity
-            }
+    def import_file(self):
+        if self.bulk_running:
+            return
+        if self.server:
+            messagebox.showerror('Error', 'Imports are run on the server computer!')
+            return
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(filetypes=[('CSV or JSON Lines', '*.csv *.jsonl'), ('All files', '*')])
+        if not path:
+            return
+        from pharmacy_bulk import BulkImport
+        job = BulkImport(self.engine, self.import_kind_var.get(), path, checkpoint=self.checkpoint_now)
+        self.run_bulk_steps(job, job.steps(), self.import_finished)
 
-            self.save_data()
+    def export_sales(self):
+        if self.bulk_running:
+            return
+        start = self.export_start_entry.get().strip() or None
+        end = self.export_end_entry.get().strip() or None
+        try:
+            for date in (start, end):
+                if date:
+                    datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror('Error', 'Dates must be in YYYY-MM-DD format!')
+            return
+        from tkinter import filedialog
+        path = filedialog.asksaveasfilename(defaultextension='.csv',
+                                            filetypes=[('CSV', '*.csv'), ('JSON Lines', '*.jsonl')])
+        if not path:
+            return
+        from pharmacy_bulk import SalesExport
+        job = SalesExport(self.storage, path, start, end)
+        self.run_bulk_steps(job, job.steps(), lambda job: self.status_var.set(
+            f"Exported {job.sales} sales to {os.path.basename(path)}"))
+
+    def run_bulk_steps(self, job, steps, finished):
+        # One chunk per turn of the event loop, so the window stays
+        # responsive and the progress bar moves
+        self.bulk_running = True
+        try:
+            next(steps)
+        except StopIteration:
+            self.bulk_running = False
+            self.bulk_progress['value'] = 100
+            finished(job)
+            return
+        except Exception as e:
+            self.bulk_running = False
+            self.bulk_progress['value'] = 0
+            messagebox.showerror('Error', str(e))
+            return
+        self.bulk_progress['value'] = job.done * 100 / job.size if job.size else 100
+        self.root.after(1, self.run_bulk_steps, job, steps, finished)
+
+    def import_finished(self, job):
+        # Saved and redrawn once, however many rows came in
+        self.schedule_checkpoint()
+        if job.kind == 'sales':
+            if 'Reports' in self.loaded_tabs:
+                self.refresh_sales_report()
+        else:
             self.refresh_product_list()
-            self.clear_product_form()
-            messagebox.showinfo('Success', f'Product "{name}" added successfully!')
+            self.refresh_low_stock()
+        message = f"Imported {job.applied} {job.kind} rows."
+        if job.errors:
+            message += f"\n{len(job.errors)} rows were rejected:\n"
+            message += '\n'.join(f"Line {line}: {error}" for line, error in job.errors[:20])
+            if len(job.errors) > 20:
+                message += f"\n... and {len(job.errors) - 20} more"
+            messagebox.showwarning('Import', message)
+        else:
+            messagebox.showinfo('Import', message)
 
-        except ValueError:
-            messagebox.showerror('Error', 'Invalid price or quantity!')
+    def update_suggestions(self, event=None):
+        if event is not None and event.keysym == 'Return':
+            return
+        text = self.sale_code_entry.get()
+        self.suggestions = self.engine.search(text)
+        self.suggestion_list.delete(0, 'end')
+        for code in self.suggestions:
+            product = self.products[code]
+            self.suggestion_list.insert('end', f"{code} - {product['name']} (${product['price']:.2f}, {product['quantity']} in stock)")
+
+    def choose_suggestion(self, event=None):
+        selection = self.suggestion_list.curselection()
+        if selection:
+            self.select_sale_product(self.suggestions[selection[0]])
+
+    def choose_exact_product(self, event=None):
+        code = self.engine.lookup(self.sale_code_entry.get())
+        if code:
+            self.select_sale_product(code)
+
+    def select_sale_product(self, code):
+        self.sale_code_entry.delete(0, 'end')
+        self.sale_code_entry.insert(0, code)
+        self.suggestions = []
+        self.suggestion_list.delete(0, 'end')
+        if not self.sale_quantity_entry.get():
+            self.sale_quantity_entry.insert(0, '1')
+        self.sale_quantity_entry.focus_set()
 
     def add_to_cart(self):
-        code = self.sale_code_entry.get()
+        # Accepts a product code or a barcode
+        text = self.sale_code_entry.get()
+        code = self.engine.lookup(text) or text
         try:
             quantity = int(self.sale_quantity_entry.get())
         except ValueError:
             messagebox.showerror('Error', 'Invalid quantity!')
             return
 
-        if code not in self.products:
-            messagebox.showerror('Error', 'Product not found!')
-            return
-
-        product = self.products[code]
-        if quantity > product['quantity']:
-            messagebox.showerror('Error', 'Insufficient stock!')
+        # The stock is held for this cart until the sale is completed, so it
+        # cannot be sold by another till in the meantime
+        try:
+            self.cart.add(code, quantity)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
             return
+        self.show_cart_line(code)
 
-        total = quantity * product['price']
-        self.cart_tree.insert('', 'end', values=(code, product['name'], f"${product['price']:.2f}", quantity, f"${total:.2f}"))
-        
         self.sale_code_entry.delete(0, 'end')
         self.sale_quantity_entry.delete(0, 'end')
+        self.update_suggestions()
+
+    def show_cart_line(self, code):
+        # Only the changed line is touched
+        if code in self.cart:
+            quantity, price, amount = self.cart.line(code)
+            values = (code, self.products[code]['name'], f"${price / 100:.2f}", quantity, f"${amount / 100:.2f}")
+            if self.cart_tree.exists(code):
+                self.cart_tree.item(code, values=values)
+            else:
+                self.cart_tree.insert('', 'end', iid=code, values=values)
+        elif self.cart_tree.exists(code):
+            self.cart_tree.delete(code)
+        self.cart_total_var.set(f"Total: ${self.cart.total_cents / 100:.2f}")
+
+    def void_cart_line(self):
+        for code in self.cart_tree.selection():
+            self.cart.void(code)
+            self.show_cart_line(code)
+
+    def set_cart_quantity(self):
+        # The selected line takes the quantity typed in the Quantity field
+        selection = self.cart_tree.selection()
+        if not selection:
+            messagebox.showerror('Error', 'Select an item in the cart!')
+            return
+        try:
+            quantity = int(self.sale_quantity_entry.get())
+        except ValueError:
+            messagebox.showerror('Error', 'Invalid quantity!')
+            return
+        try:
+            self.cart.set_quantity(selection[0], quantity)
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+        self.show_cart_line(selection[0])
+        self.sale_quantity_entry.delete(0, 'end')
 
     def complete_sale(self):
-        if not self.cart_tree.get_children():
-            messagebox.showerror('Error', 'Cart is empty!')
-            return
-
-        sale_items = []
-        total_amount = 0
-
-        for item in self.cart_tree.get_children():
-            values = self.cart_tree.item(item)['values']
-            code = values[0]
-            quantity = int(values[3])
-            amount = float(values[4].replace('$', ''))
-
-            self.products[code]['quantity'] -= quantity
-            sale_items.append({
-                'code': code,
-                'name': self.products[code]['name'],
-                'quantity': quantity,
-                'price': self.products[code]['price'],
-                'amount': amount
-            })
-            total_amount += amount
-
-            # Update monthly statistics
-            if code not in self.monthly_data['products_sold']:
-                self.monthly_data['products_sold'][code] = {
-                    'quantity': 0,
-                    'revenue': 0
-                }
-            self.monthly_data['products_sold'][code]['quantity'] += quantity
-            self.monthly_data['products_sold'][code]['revenue'] += amount
-
-        sale = {
-            'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'items': sale_items,
-            'total': total_amount
-        }
-
-        self.sales.append(sale)
-        self.monthly_data['sales'].append(sale)
-        self.monthly_data['total_revenue'] += total_amount
-
-        self.save_data()
-        self.refresh_product_list()
-        self.refresh_sales_report()
+        # A price changed while the cart was open is shown before charging
+        changed = self.cart.reprice()
+        for code in changed:
+            self.show_cart_line(code)
+        if changed and not messagebox.askyesno(
+                'Prices Changed', f"Prices changed since the items were added. The total is now "
+                                  f"${self.cart.total_cents / 100:.2f}. Complete the sale?"):
+            return
+        try:
+            sale = self.cart.checkout()
+        except SaleError as e:
+            messagebox.showerror('Error', str(e))
+            return
+        self.schedule_checkpoint()
+
+        # Only the sold products' rows and the new sale row are touched
+        for item in sale['items']:
+            self.product_view.update(item['code'])
+        if any(self.engine.stock.is_low(item['code']) for item in sale['items']):
+            self.refresh_low_stock()
+        if any('lots' in item for item in sale['items']):
+            self.refresh_expiring()
+        if 'Reports' in self.loaded_tabs:
+            self.sales_rows.append(to_sale(sale))
+            self.sales_view.append(len(self.sales_rows) - 1)
         self.cart_tree.delete(*self.cart_tree.get_children())
+        self.cart_total_var.set('Total: $0.00')
 
-        receipt = f"=== Receipt ===\nDate: {sale['date']}\n\nItems:\n"
-        receipt += "Name\t\tQty\tPrice\tAmount\n"
-        receipt += "-" * 40 + "\n"
-        for item in sale_items:
-            receipt += f"{item['name'][:12]}\t{item['quantity']}\t${item['price']:.2f}\t${item['amount']:.2f}\n"
-        receipt += "-" * 40 + "\n"
-        receipt += f"Total Amount: ${total_amount:.2f}"
-
-        messagebox.showinfo('Sale Complete', receipt)
+        messagebox.showinfo('Sale Complete', format_receipt(sale))
 
     def refresh_product_list(self):
-        for item in self.product_tree.get_children():
-            self.product_tree.delete(item)
-
-        for code, product in self.products.items():
-            self.product_tree.insert('', 'end', values=(
-                code,
-                product['name'],
-                f"${product['price']:.2f}",
-                product['quantity']
-            ))
+        # Full reload of the view model; changes after that are applied as diffs
+        self.product_view.set_keys(self.products)
+
+    def product_row(self, code):
+        product = self.products[code]
+        return (code, product['name'], f"${product['price']:.2f}", product['quantity'])
+
+    def product_sort_value(self, code, column):
+        product = self.products[code]
+        if column == 'Name':
+            return product['name'].lower()
+        if column == 'Price':
+            return product['price']
+        if column == 'Quantity':
+            return product['quantity']
+        return code
 
     def refresh_sales_report(self):
-        for item in self.sales_tree.get_children():
-            self.sales_tree.delete(item)
-
-        for sale in self.sales:
-            items_str = f"{len(sale['items'])} items"
-            self.sales_tree.insert('', 'end', values=(
-                sale['date'],
-                items_str,
-                f"${sale['total']:.2f}"
-            ))
+        # Sales from a server arrive as dicts
+        self.sales_rows = [to_sale(sale) for sale in self.storage.get_sales()]
+        self.sales_view.set_keys(range(len(self.sales_rows)))
+
+    def sale_row(self, index):
+        sale = self.sales_rows[index]
+        return (sale.date, f"{sale.line_count} items", f"${sale.total_cents / 100:.2f}")
+
+    def sale_sort_value(self, index, column):
+        sale = self.sales_rows[index]
+        if column == 'Items':
+            return sale.line_count
+        if column == 'Total':
+            return sale.total_cents
+        return sale.date
 
     def clear_product_form(self):
         self.code_entry.delete(0, 'end')
         self.name_entry.delete(0, 'end')
         self.price_entry.delete(0, 'end')
         self.quantity_entry.delete(0, 'end')
+        self.barcode_entry.delete(0, 'end')
+        self.reorder_entry.delete(0, 'end')
 
 def main():
     root = tk.Tk()
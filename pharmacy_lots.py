@@ -0,0 +1,253 @@
+import sys
+import argparse
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+
+DEFAULT_LOT = 'DEFAULT'
+
+# A product tracked by lot carries product['lots'], a list of
+# {'lot', 'expiry', 'quantity'} dicts in first-expiry-first-out order, and
+# its 'quantity' is always the sum of its lots. Products without 'lots' are
+# sold from their quantity alone, as before. The lists are replaced, never
+# changed in place, so a copy of the catalogue taken for a background write
+# stays as it was.
+
+
+def lot_key(lot):
+    # FEFO order. Lots without an expiry date come last, so they never hold
+    # back a lot that is about to expire; expired lots are then always at
+    # the front.
+    return (lot['expiry'] is None, lot['expiry'] or '', lot['lot'])
+
+
+def order_lots(products):
+    # Puts lot lists saved in an older order (undated lots first) in FEFO
+    # order, as allocate() expects; called once at startup
+    for product in products.values():
+        if 'lots' in product:
+            lots = sorted(product['lots'], key=lot_key)
+            if lots != product['lots']:
+                product['lots'] = lots
+
+
+def is_expired(lot, today):
+    # The expiry date is the last day a lot may be sold
+    return lot['expiry'] is not None and lot['expiry'] < today
+
+
+def first_unexpired(lots, today):
+    # Index of the first lot that may be sold today: a binary search, as
+    # the expired lots are the front of a FEFO list
+    low, high = 0, len(lots)
+    while low < high:
+        middle = (low + high) // 2
+        if is_expired(lots[middle], today):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def product_lots(product):
+    # The product's lots; untracked stock shows as one default lot
+    if 'lots' in product:
+        return product['lots']
+    if product['quantity'] > 0:
+        return [{'lot': DEFAULT_LOT, 'expiry': None, 'quantity': product['quantity']}]
+    return []
+
+
+def add_lot(product, lot, expiry, quantity):
+    # Receive stock into a lot of a product dict (a copy the caller will
+    # save); the first lot received starts tracking the product
+    if expiry is not None:
+        try:
+            datetime.strptime(expiry, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            raise ValueError('Expiry must be in YYYY-MM-DD format!')
+    lots = [dict(entry) for entry in product_lots(product)]
+    for entry in lots:
+        if entry['lot'] == lot:
+            if entry['expiry'] != expiry:
+                raise ValueError(f"Lot {lot} already exists with expiry {entry['expiry']}!")
+            entry['quantity'] += quantity
+            break
+    else:
+        entry = {'lot': lot, 'expiry': expiry, 'quantity': quantity}
+        lots.insert(bisect_right([lot_key(other) for other in lots], lot_key(entry)), entry)
+    product['lots'] = lots
+    product['quantity'] += quantity
+
+
+def remove_lot(product, lot):
+    # Write a lot off, e.g. once it has expired; returns its quantity
+    lots = product_lots(product)
+    for entry in lots:
+        if entry['lot'] == lot:
+            product['lots'] = [other for other in lots if other is not entry]
+            product['quantity'] -= entry['quantity']
+            return entry['quantity']
+    raise ValueError(f"Lot {lot} not found!")
+
+
+def set_stock(product, quantity):
+    # Set a product's stock to `quantity` (stock counts, bulk adjustments):
+    # on a tracked product more stock goes to the default lot and less is
+    # taken first-expiry-first
+    change = quantity - product['quantity']
+    if 'lots' not in product or change == 0:
+        product['quantity'] = quantity
+    elif change > 0:
+        add_lot(product, DEFAULT_LOT, None, change)
+    else:
+        allocation = allocate(product, -change)
+        product['lots'] = consume(product['lots'], allocation)
+        product['quantity'] = quantity
+
+
+def sellable(product, today):
+    # Stock that may be sold today: everything but expired lots
+    if 'lots' not in product:
+        return product['quantity']
+    lots = product['lots']
+    return product['quantity'] - sum(lot['quantity'] for lot in lots[:first_unexpired(lots, today)])
+
+
+def allocate(product, quantity, today=None, taken=None):
+    # Lots to sell `quantity` from, first expiry first, as [[lot, quantity],
+    # ...]; expired lots are skipped when today is given. taken maps lots
+    # to what earlier sales of the same batch already claimed. Only the
+    # lots used are visited.
+    allocation = []
+    lots = product['lots']
+    for index in range(first_unexpired(lots, today) if today is not None else 0, len(lots)):
+        lot = lots[index]
+        free = lot['quantity'] - (taken.get(lot['lot'], 0) if taken else 0)
+        if free <= 0:
+            continue
+        used = min(free, quantity)
+        allocation.append([lot['lot'], used])
+        quantity -= used
+        if not quantity:
+            return allocation
+    raise ValueError('Insufficient stock!')
+
+
+def consume(lots, allocation):
+    # New lot list with an allocation taken out; emptied lots are dropped
+    used = dict(allocation)
+    result = []
+    for lot in lots:
+        if lot['lot'] in used:
+            lot = dict(lot, quantity=lot['quantity'] - used[lot['lot']])
+            if lot['quantity'] <= 0:
+                continue
+        result.append(lot)
+    return result
+
+
+def set_remaining(lots, remaining):
+    # Replay of a journaled sale: lots set to the absolute quantities left
+    result = []
+    for lot in lots:
+        if lot['lot'] in remaining:
+            lot = dict(lot, quantity=remaining[lot['lot']])
+            if lot['quantity'] <= 0:
+                continue
+        result.append(lot)
+    return result
+
+
+class ExpiryIndex:
+    # Every dated lot in stock, ordered by expiry in a sorted list of
+    # (expiry, code, lot) entries, so "what expires before X" is a binary
+    # search plus the k lots returned, never a scan of every lot. Only
+    # products touched by a sale, delivery or edit are re-indexed. The index
+    # is built by the first query, so startup does not pay for it.
+
+    def __init__(self, products):
+        self.products = products
+        self.keys = {}
+        self.entries = None
+
+    def build(self):
+        entries = []
+        for code, product in self.products.items():
+            keys = {(lot['expiry'], code, lot['lot']) for lot in product.get('lots', ()) if lot['expiry']}
+            if keys:
+                self.keys[code] = keys
+                entries += keys
+        self.entries = sorted(entries)
+
+    def update(self, code):
+        # Only lots that appeared or ran out move; a sale that leaves every
+        # lot in stock changes nothing
+        if self.entries is None:
+            return
+        product = self.products.get(code)
+        keys = {(lot['expiry'], code, lot['lot']) for lot in product.get('lots', ()) if lot['expiry']} \
+            if product is not None else set()
+        old = self.keys.get(code, set())
+        if keys == old:
+            return
+        for key in old - keys:
+            del self.entries[bisect_left(self.entries, key)]
+        for key in keys - old:
+            insort(self.entries, key)
+        if keys:
+            self.keys[code] = keys
+        else:
+            self.keys.pop(code, None)
+
+    def expiring(self, until):
+        # Lots expiring on or before `until` (YYYY-MM-DD), soonest first,
+        # expired ones included: [{'code', 'name', 'lot', 'expiry',
+        # 'quantity'}, ...]
+        if self.entries is None:
+            self.build()
+        end = bisect_right(self.entries, (until, '\uffff'))
+        result = []
+        for expiry, code, lot in self.entries[:end]:
+            product = self.products[code]
+            quantity = next(entry['quantity'] for entry in product['lots'] if entry['lot'] == lot)
+            result.append({'code': code, 'name': product['name'], 'lot': lot, 'expiry': expiry,
+                           'quantity': quantity})
+        return result
+
+
+def expiry_cutoff(days, today=None):
+    # Last day included in "expiring within `days` days"
+    today = today or datetime.now()
+    return (today + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Lot and expiry tracking")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help="Track every product by lot; current stock becomes the default lot")
+    expiring_parser = commands.add_parser('expiring', help="Lots expiring within a number of days")
+    expiring_parser.add_argument('days', type=int, nargs='?', default=30)
+    parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    storage = open_storage(data_dir=args.data_dir)
+    if args.command == 'migrate':
+        changed = {}
+        for code, product in storage.products.items():
+            if 'lots' not in product:
+                changed[code] = dict(product, lots=product_lots(product))
+        if changed:
+            storage.put_products(changed)
+        print(f"{len(changed)} products now tracked by lot")
+    else:
+        today = datetime.now().strftime("%Y-%m-%d")
+        for lot in ExpiryIndex(storage.products).expiring(expiry_cutoff(args.days)):
+            state = 'EXPIRED' if lot['expiry'] < today else ''
+            print(f"{lot['expiry']}\t{lot['code']}\t{lot['name'][:20]}\t{lot['lot']}\t{lot['quantity']}\t{state}")
+    storage.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import threading
+from datetime import datetime
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# GUI methods timed when metrics are on
+HOT_PATHS = ('load_data', 'save_data', 'complete_sale', 'add_to_cart', 'refresh_product_list',
+             'refresh_sales_report', 'refresh_low_stock', 'show_monthly_report', 'show_range_report',
+             'auto_backup')
+
+
+class NullTimer:
+    # What timer() hands out while metrics are off: does nothing, shared
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        # One profiler at a time: the outermost operation on the main thread
+        if self.metrics.profile and not self.metrics.profiling and \
+                threading.current_thread() is threading.main_thread():
+            import cProfile
+            self.metrics.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.profiler:
+            self.profiler.disable()
+            self.metrics.profiling = False
+        self.metrics.observe(self.name, elapsed, self.profiler)
+        return False
+
+
+class Metrics:
+    # Timers and counters for the hot paths, off by default. While off,
+    # timer() returns a shared no-op context manager and count() returns at
+    # once, and GUI methods are not wrapped at all, so the cost is a flag
+    # check.
+    #
+    # When on (PHARMACY_METRICS=1), everything is kept in memory and
+    # exported in Prometheus text format to <data>/metrics.prom, rewritten
+    # every few seconds, and optionally served over HTTP on localhost
+    # (PHARMACY_METRICS_PORT). Operations slower than their threshold
+    # (PHARMACY_SLOW_MS="100,complete_sale=50") are appended to
+    # <data>/slow_ops.log; with PHARMACY_PROFILE=1 each one also leaves a
+    # cProfile dump in <data>/profiles/.
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.slow_default = 0.1
+        self.slow_thresholds = {}
+        self.profile = False
+        self.profiling = False
+        self.directory = 'data'
+        self.write_every = 5
+        self.last_write = 0
+        self.server = None
+
+    def configure(self, directory='data', environ=None):
+        # Turns metrics on from the environment; returns whether they are on
+        environ = os.environ if environ is None else environ
+        if environ.get('PHARMACY_METRICS', '0') in ('', '0'):
+            return False
+        port = environ.get('PHARMACY_METRICS_PORT')
+        self.enable(directory, int(port) if port else None, environ.get('PHARMACY_SLOW_MS'),
+                    environ.get('PHARMACY_PROFILE', '0') not in ('', '0'))
+        return True
+
+    def enable(self, directory='data', port=None, slow_ms=None, profile=False):
+        self.directory = directory
+        self.profile = profile
+        for part in (slow_ms or '').split(','):
+            name, _, value = part.strip().rpartition('=')
+            if value:
+                if name:
+                    self.slow_thresholds[name] = float(value) / 1000
+                else:
+                    self.slow_default = float(value) / 1000
+        self.enabled = True
+        if port is not None:
+            self.serve(port)
+
+    # Recording
+
+    def timer(self, name):
+        return Timer(self, name) if self.enabled else NULL_TIMER
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, metric, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.get((metric, labels))
+            if histogram is None:
+                histogram = self.histograms[(metric, labels)] = {'count': 0, 'sum': 0, 'buckets': [0] * len(BUCKETS)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+
+    def observe(self, name, seconds, profiler=None):
+        self.record('operation_seconds', (('operation', name),), seconds)
+        if seconds >= self.slow_thresholds.get(name, self.slow_default):
+            self.log_slow(name, seconds, profiler)
+
+    def log_slow(self, name, seconds, profiler):
+        now = datetime.now()
+        line = f"{now.strftime('%Y-%m-%d %H:%M:%S')}\t{name}\t{seconds * 1000:.1f} ms"
+        if profiler:
+            os.makedirs(os.path.join(self.directory, 'profiles'), exist_ok=True)
+            path = os.path.join(self.directory, 'profiles', f"{name}-{now.strftime('%Y%m%d_%H%M%S_%f')}.prof")
+            profiler.dump_stats(path)
+            line += f"\t{path}"
+        try:
+            with open(os.path.join(self.directory, 'slow_ops.log'), 'a') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            print(f"Could not write the slow operation log: {e}", file=sys.stderr)
+
+    def instrument(self, obj, names):
+        # Replace obj's methods by timed wrappers; done before any widget
+        # callback captures them
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is not None:
+                setattr(obj, name, self.wrap(name, method))
+
+    def wrap(self, name, method):
+        def timed(*args, **kwargs):
+            with self.timer(name):
+                return method(*args, **kwargs)
+        timed.__name__ = name
+        return timed
+
+    def watch_event_loop(self, root, interval=100):
+        # A heartbeat scheduled every `interval` ms: how late it runs is how
+        # long the Tk event loop was blocked. It also rewrites the metrics file.
+        expected = time.perf_counter() + interval / 1000
+
+        def beat():
+            nonlocal expected
+            now = time.perf_counter()
+            self.record('event_loop_stall_seconds', (), max(0, now - expected))
+            if now - self.last_write >= self.write_every:
+                self.last_write = now
+                self.write()
+            expected = time.perf_counter() + interval / 1000
+            root.after(interval, beat)
+        root.after(interval, beat)
+
+    # Export
+
+    def export(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in self.histograms.items()}
+
+        for name in sorted(counters):
+            lines.append(f"# TYPE pharmacy_{name}_total counter")
+            lines.append(f"pharmacy_{name}_total {counters[name]}")
+
+        described = set()
+        for (metric, labels), histogram in sorted(histograms.items()):
+            name = f"pharmacy_{metric}"
+            if metric not in described:
+                described.add(metric)
+                lines.append(f"# TYPE {name} histogram")
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+            prefix = label_text + ',' if label_text else ''
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}')
+            suffix = f'{{{label_text}}}' if label_text else ''
+            lines.append(f"{name}_sum{suffix} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{suffix} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # Replaced as a whole, so a scraper never sees half a file
+        path = os.path.join(self.directory, 'metrics.prom')
+        try:
+            with open(f"{path}.tmp", 'w') as f:
+                f.write(self.export())
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"Could not write metrics: {e}", file=sys.stderr)
+
+    def serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.export().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# Shared by every module of a process
+metrics = Metrics()
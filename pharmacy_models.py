@@ -0,0 +1,164 @@
+def to_cents(amount):
+    # Money is kept as integer cents so totals add up exactly
+    return round(amount * 100)
+
+
+class Product:
+    # A product as it appears on sales: there is one shared instance per
+    # (code, name) pair, known to sales by its position in `product_table`
+    __slots__ = ('code', 'name')
+
+    def __init__(self, code, name):
+        self.code = code
+        self.name = name
+
+    def __repr__(self):
+        return f"Product({self.code!r}, {self.name!r})"
+
+
+product_table = []
+product_ids = {}
+# Every sale line of the same price shares one int object
+known_cents = {}
+
+
+def product_id(code, name):
+    found = product_ids.get((code, name))
+    if found is None:
+        found = product_ids[(code, name)] = len(product_table)
+        product_table.append(Product(code, name))
+    return found
+
+
+def shared_cents(cents):
+    return known_cents.setdefault(cents, cents)
+
+
+class SaleItem:
+    # One line of a sale, made on demand from the sale's packed lines.
+    # lots holds (lot, quantity) pairs for products tracked by lot.
+    __slots__ = ('product', 'quantity', 'price_cents', 'lots')
+
+    def __init__(self, product, quantity, price_cents, lots=()):
+        self.product = product
+        self.quantity = quantity
+        self.price_cents = price_cents
+        self.lots = lots
+
+    @property
+    def code(self):
+        return self.product.code
+
+    @property
+    def name(self):
+        return self.product.name
+
+    @property
+    def amount_cents(self):
+        return self.quantity * self.price_cents
+
+    # Read like the JSON dict, so code written for either form works
+    def __getitem__(self, key):
+        if key == 'price':
+            return self.price_cents / 100
+        if key == 'amount':
+            return self.amount_cents / 100
+        if key in ('code', 'name', 'quantity'):
+            return getattr(self, key)
+        if key == 'lots' and self.lots:
+            return [list(lot) for lot in self.lots]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        item = {
+            'code': self.code,
+            'name': self.name,
+            'quantity': self.quantity,
+            'price': self.price_cents / 100,
+            'amount': self.amount_cents / 100
+        }
+        if self.lots:
+            item['lots'] = [list(lot) for lot in self.lots]
+        return item
+
+
+class Sale:
+    # A recorded sale, in a fraction of the memory of the dict it is read
+    # from. Its lines are packed in one tuple of ints, (product id, quantity,
+    # price in cents) per line, which also keeps the garbage collector from
+    # tracking anything but the Sale itself. Sales in the history are never
+    # changed. id is None for sales written before sales had ids. lots is
+    # None unless a line was sold from lot-tracked stock; then it holds one
+    # tuple of (lot, quantity) pairs per line.
+    __slots__ = ('id', 'date', 'lines', 'lots')
+
+    def __init__(self, id, date, lines, lots=None):
+        self.id = id
+        self.date = date
+        self.lines = lines
+        self.lots = lots
+
+    @property
+    def items(self):
+        lines = self.lines
+        lots = self.lots or ((),) * (len(lines) // 3)
+        return [SaleItem(product_table[lines[index]], lines[index + 1], lines[index + 2], lots[index // 3])
+                for index in range(0, len(lines), 3)]
+
+    @property
+    def line_count(self):
+        return len(self.lines) // 3
+
+    @property
+    def total_cents(self):
+        lines = self.lines
+        return sum(quantity * price for quantity, price in zip(lines[1::3], lines[2::3]))
+
+    def __getitem__(self, key):
+        if key == 'total':
+            return self.total_cents / 100
+        if key in ('date', 'items') or (key == 'id' and self.id is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('date', 'items', 'total') or (key == 'id' and self.id is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return f"Sale({self.id!r}, {self.date!r}, {self.line_count} items)"
+
+    @classmethod
+    def from_dict(cls, sale):
+        lines = []
+        for item in sale['items']:
+            lines += (product_id(item['code'], item['name']), item['quantity'], shared_cents(to_cents(item['price'])))
+        lots = None
+        if any('lots' in item for item in sale['items']):
+            lots = tuple(tuple(tuple(lot) for lot in item.get('lots', ())) for item in sale['items'])
+        return cls(sale.get('id'), sale['date'], tuple(lines), lots)
+
+    def to_dict(self):
+        # The JSON schema of sales.json and the monthly files
+        sale = {'id': self.id} if self.id is not None else {}
+        sale['date'] = self.date
+        sale['items'] = [item.to_dict() for item in self.items]
+        sale['total'] = self.total_cents / 100
+        return sale
+
+
+def to_sale(sale):
+    # A Sale from either form
+    return sale if isinstance(sale, Sale) else Sale.from_dict(sale)
+
+
+def to_dicts(sales):
+    return [sale.to_dict() if isinstance(sale, Sale) else sale for sale in sales]
@@ -0,0 +1,118 @@
+import queue
+import threading
+from pharmacy_metrics import metrics
+
+_DONE = object()
+
+
+class PersistenceWorker:
+    # Runs checkpoints and backups on a background thread so Tk callbacks
+    # never wait for disk. Tk is not thread-safe, so all coordination stays
+    # on the Tk thread: jobs are prepared there and results come back through
+    # a queue polled with root.after.
+    #
+    # Callers mark work as dirty with a name and a `prepare` function.
+    # prepare() runs on the Tk thread and returns the slow part to run in
+    # the background. Marks that arrive while a write is queued or running
+    # are merged, so a burst of sales costs one write.
+
+    def __init__(self, root, on_done=None, on_error=None, delay=200, poll=100):
+        self.root = root
+        self.on_done = on_done
+        self.on_error = on_error
+        self.delay = delay
+        self.poll = poll
+        self.dirty = {}
+        self.busy = False
+        self.scheduled = False
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='persistence', daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, name, prepare):
+        self.dirty[name] = prepare
+        if not self.busy and not self.scheduled:
+            self.scheduled = True
+            self.root.after(self.delay, self.start)
+
+    def start(self):
+        self.scheduled = False
+        if self.busy or not self.dirty:
+            return
+        self.busy = True
+        self.jobs.put(self.prepare_jobs())
+        self.root.after(self.poll, self.check)
+
+    def prepare_jobs(self):
+        jobs = []
+        for name, prepare in self.dirty.items():
+            try:
+                jobs.append((name, prepare()))
+            except Exception as e:
+                self.results.put((name, e))
+        self.dirty.clear()
+        return jobs
+
+    def run(self):
+        while True:
+            jobs = self.jobs.get()
+            if jobs is None:
+                break
+            for name, job in jobs:
+                try:
+                    with metrics.timer(f'{name}_write'):
+                        job()
+                    self.results.put((name, None))
+                except Exception as e:
+                    self.results.put((name, e))
+            self.results.put(_DONE)
+
+    def check(self):
+        if not self.busy:
+            return  # wait() already collected the batch
+        if self.drain():
+            self.busy = False
+            if self.dirty and not self.scheduled:
+                self.scheduled = True
+                self.root.after(self.delay, self.start)
+        else:
+            self.root.after(self.poll, self.check)
+
+    def drain(self, block=False):
+        # Report finished jobs; returns True once the running batch is done
+        while True:
+            try:
+                result = self.results.get(block=block)
+            except queue.Empty:
+                return False
+            if result is _DONE:
+                return True
+            name, error = result
+            if error is None:
+                if self.on_done:
+                    self.on_done(name)
+            elif self.on_error:
+                self.on_error(name, error)
+
+    def wait(self):
+        # Block until the running batch is done, so the caller can write in
+        # place without racing it. Call from the Tk thread.
+        if self.busy:
+            self.drain(block=True)
+            self.busy = False
+            if self.dirty and not self.scheduled:
+                self.scheduled = True
+                self.root.after(self.delay, self.start)
+
+    def flush(self):
+        # Flush-on-exit: wait for the running batch, then run whatever is
+        # still dirty and stop the thread. Call from the Tk thread.
+        if self.busy:
+            self.drain(block=True)
+            self.busy = False
+        if self.dirty:
+            self.jobs.put(self.prepare_jobs())
+            self.drain(block=True)
+        self.jobs.put(None)
+        self.thread.join()
@@ -0,0 +1,82 @@
+import sys
+import heapq
+from collections import OrderedDict
+
+TOP_PRODUCTS = 10
+
+
+def top_products(products_sold, count=TOP_PRODUCTS):
+    # [[code, quantity, revenue], ...], best revenue first; a heap picks
+    # them without sorting every product
+    return [[code, stats['quantity'], stats['revenue']] for code, stats in
+            heapq.nlargest(count, products_sold.items(), key=lambda x: x[1]['revenue'])]
+
+
+def month_report(summary):
+    # The part of a month summary the monthly report shows. Sealed months
+    # carry their top products in the archive header.
+    top = summary.get('top_products')
+    if top is None:
+        top = top_products(summary['products_sold'])
+    return {
+        'total_revenue': summary['total_revenue'],
+        'sale_count': summary['sale_count'],
+        'start_date': summary['start_date'],
+        'top_products': top
+    }
+
+
+def report_size(report):
+    # Rough bytes held by a report
+    size = sys.getsizeof(report) + sys.getsizeof(report['top_products'])
+    for row in report['top_products']:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class ReportCache:
+    # Monthly reports, most recently used kept, up to max_bytes. Each entry
+    # remembers the storage's fingerprint of its month (file size and
+    # modification time, or a row count) and is rebuilt when that changes.
+    # Months the storage is changing in memory have no fingerprint and are
+    # summarized live every time, without touching the disk.
+
+    def __init__(self, storage, max_bytes=1 << 20):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # month -> (fingerprint, report, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def report(self, month):
+        # {'total_revenue', 'sale_count', 'start_date', 'top_products'} or None
+        fingerprint = self.storage.month_fingerprint(month)
+        entry = self.entries.get(month)
+        if entry is not None:
+            if fingerprint is not None and entry[0] == fingerprint:
+                self.hits += 1
+                self.entries.move_to_end(month)
+                return entry[1]
+            self.drop(month)
+
+        self.misses += 1
+        summary = self.storage.month_summary(month)
+        if summary is None:
+            return None
+        report = month_report(summary)
+        if fingerprint is not None:
+            size = report_size(report)
+            self.entries[month] = (fingerprint, report, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self.drop(next(iter(self.entries)))
+        return report
+
+    def drop(self, month):
+        _, _, size = self.entries.pop(month)
+        self.size -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+from pharmacy_journal import atomic_write_json
+
+# Bucket key lengths in a "YYYY-MM-DD HH:MM:SS" date
+MONTH, DAY, HOUR = 7, 10, 13
+
+
+def new_bucket():
+    return {'revenue': 0, 'sales': 0, 'products': {}}
+
+
+def add_to_bucket(bucket, sale):
+    bucket['revenue'] += sale['total']
+    bucket['sales'] += 1
+    for item in sale['items']:
+        stats = bucket['products'].setdefault(item['code'], [0, 0])
+        stats[0] += item['quantity']
+        stats[1] += item['amount']
+
+
+def next_month(moment):
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1)
+    return moment.replace(month=moment.month + 1)
+
+
+def parse_moment(value):
+    # Accepts datetimes or "YYYY-MM-DD[ HH[:MM[:SS]]]" strings, floored to the hour
+    if isinstance(value, str):
+        value = datetime.strptime(value[:13], "%Y-%m-%d %H") if len(value) > 10 else \
+            datetime.strptime(value, "%Y-%m-%d")
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+class Rollups:
+    # Hourly, daily and monthly sales aggregates per product, maintained as
+    # each sale is committed. A range query combines the coarsest buckets
+    # that fit inside the range, so a year costs about a dozen lookups
+    # instead of a scan of every sale.
+    #
+    # On disk (in <data>/rollups/): months.json holds every monthly bucket,
+    # the number of sales folded in so far and the storage's fingerprint of
+    # the sales history they match; YYYY-MM.json holds that
+    # month's daily and hourly buckets and is only loaded when a query needs
+    # it. Each bucket is {'revenue', 'sales', 'products': {code: [qty, revenue]}}.
+
+    def __init__(self, directory):
+        self.directory = directory
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.months = {}
+        self.details = {}
+        self.dirty = set()
+        self.saved_months = {}
+        self.sale_count = 0
+        self.source = None
+        self.load()
+
+    def index_path(self):
+        return os.path.join(self.directory, 'months.json')
+
+    def detail_path(self, month):
+        return os.path.join(self.directory, f'{month}.json')
+
+    def load(self):
+        if os.path.exists(self.index_path()):
+            with open(self.index_path(), 'r') as f:
+                data = json.load(f)
+            self.months = data['months']
+            self.sale_count = data['sale_count']
+            self.source = data.get('source')
+            self.saved_months = {month: copy_bucket(bucket) for month, bucket in self.months.items()}
+
+    def detail(self, month):
+        if month not in self.details:
+            if os.path.exists(self.detail_path(month)):
+                with open(self.detail_path(month), 'r') as f:
+                    self.details[month] = json.load(f)
+            else:
+                self.details[month] = {'day': {}, 'hour': {}}
+        return self.details[month]
+
+    def sync(self, storage):
+        # Catch up with sales recorded since the rollups were last saved,
+        # e.g. after a crash or journal replay; rebuild if they are ahead.
+        # When the storage knows what was added to the history they were
+        # saved with, only those sales are read.
+        added = storage.sales_added_since(self.source)
+        if added is not None:
+            self.add_sales(added)
+            return
+        count, _ = storage.sales_total()
+        if count < self.sale_count:
+            self.rebuild(storage)
+        elif count > self.sale_count:
+            self.add_sales(storage.sales_since(self.sale_count))
+
+    def add_sales(self, sales):
+        for sale in sales:
+            date = sale['date']
+            month = date[:MONTH]
+            add_to_bucket(self.months.setdefault(month, new_bucket()), sale)
+            detail = self.detail(month)
+            add_to_bucket(detail['day'].setdefault(date[:DAY], new_bucket()), sale)
+            add_to_bucket(detail['hour'].setdefault(date[:HOUR], new_bucket()), sale)
+            self.dirty.add(month)
+        self.sale_count += len(sales)
+
+    def rebuild(self, storage):
+        # Regenerate every rollup from the raw sales history
+        for file in os.listdir(self.directory):
+            if file.endswith('.json'):
+                os.remove(os.path.join(self.directory, file))
+        self.months = {}
+        self.details = {}
+        self.dirty = set()
+        self.saved_months = {}
+        self.sale_count = 0
+        self.add_sales(storage.get_sales())
+        self.save(storage.sales_fingerprint())
+
+    def buckets(self, start, end):
+        # Coarsest buckets covering [start, end), as (level, key) pairs
+        moment = parse_moment(start)
+        end = parse_moment(end)
+        while moment < end:
+            if moment.day == 1 and moment.hour == 0 and next_month(moment) <= end:
+                yield 'month', moment.strftime("%Y-%m")
+                moment = next_month(moment)
+            elif moment.hour == 0 and moment + timedelta(days=1) <= end:
+                yield 'day', moment.strftime("%Y-%m-%d")
+                moment += timedelta(days=1)
+            else:
+                yield 'hour', moment.strftime("%Y-%m-%d %H")
+                moment += timedelta(hours=1)
+
+    def query(self, start, end, code=None):
+        # Totals for [start, end): {'revenue', 'sales', 'products': {code:
+        # {'quantity', 'revenue'}}}. With a product code, revenue only counts
+        # that product and the number of sales is not available.
+        result = {'revenue': 0, 'sales': 0, 'products': {}}
+        for level, key in self.buckets(start, end):
+            if level == 'month':
+                bucket = self.months.get(key)
+            elif key[:MONTH] in self.months:
+                bucket = self.detail(key[:MONTH])[level].get(key)
+            else:
+                bucket = None
+            if bucket is None:
+                continue
+
+            if code is None:
+                result['revenue'] += bucket['revenue']
+                result['sales'] += bucket['sales']
+                products = bucket['products'].items()
+            else:
+                products = [(code, bucket['products'][code])] if code in bucket['products'] else []
+
+            for product_code, (quantity, revenue) in products:
+                stats = result['products'].setdefault(product_code, {'quantity': 0, 'revenue': 0})
+                stats['quantity'] += quantity
+                stats['revenue'] += revenue
+                if code is not None:
+                    result['revenue'] += revenue
+        return result
+
+    def prepare_save(self):
+        # Copy only what changed so the write can happen on another thread;
+        # copies of unchanged months are reused from the previous save. The
+        # returned write(source) takes the fingerprint of the sales history
+        # saved alongside.
+        details = {}
+        for month in self.dirty:
+            self.saved_months[month] = copy_bucket(self.months[month])
+            detail = self.details[month]
+            details[month] = {level: {key: copy_bucket(bucket) for key, bucket in detail[level].items()}
+                              for level in ('day', 'hour')}
+        months = dict(self.saved_months)
+        sale_count = self.sale_count
+
+        # Keep the latest month's details in memory, and the ones being
+        # written until the next save
+        latest = max(self.details, default=None)
+        self.details = {month: detail for month, detail in self.details.items()
+                        if month == latest or month in self.dirty}
+        self.dirty = set()
+
+        def write(source=None):
+            for month, detail in details.items():
+                atomic_write_json(self.detail_path(month), detail, indent=None)
+            # The index goes last: its sale count says what is on disk
+            atomic_write_json(self.index_path(), {'sale_count': sale_count, 'source': source, 'months': months},
+                              indent=None)
+            self.source = source
+        return write
+
+    def save(self, source=None):
+        self.prepare_save()(source)
+
+
+def copy_bucket(bucket):
+    return {
+        'revenue': bucket['revenue'],
+        'sales': bucket['sales'],
+        'products': {code: list(stats) for code, stats in bucket['products'].items()}
+    }
+
+
+def main(argv=None):
+    from pharmacy_storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Sales rollups")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help="Regenerate the rollups from the raw sales history")
+    query_parser = commands.add_parser('query', help="Totals for a date range")
+    query_parser.add_argument('start', help="YYYY-MM-DD")
+    query_parser.add_argument('end', help="YYYY-MM-DD (exclusive)")
+    query_parser.add_argument('--product', help="Only this product code")
+    args = parser.parse_args(argv)
+
+    storage = open_storage()
+    rollups = Rollups(os.path.join(storage.data_dir, 'rollups'))
+    if args.command == 'rebuild':
+        rollups.rebuild(storage)
+        print(f"Rebuilt rollups from {rollups.sale_count} sales")
+    elif args.command == 'query':
+        rollups.sync(storage)
+        result = rollups.query(args.start, args.end, args.product)
+        print(f"Sales: {result['sales']}")
+        print(f"Revenue: ${result['revenue']:.2f}")
+        for code, stats in sorted(result['products'].items(), key=lambda x: x[1]['revenue'], reverse=True)[:10]:
+            print(f"{code}\t{stats['quantity']}\t${stats['revenue']:.2f}")
+    storage.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+from bisect import bisect_left, insort
+
+
+def name_words(name):
+    # The full name plus each of its words, so "para" and "500mg" both
+    # prefix-match "Paracetamol 500mg"
+    name = name.lower()
+    return sorted(set([name] + name.split())) if name.strip() else []
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, bound):
+    # Levenshtein distance, or bound + 1 as soon as it must exceed bound
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > bound:
+            return bound + 1
+        previous = current
+    return previous[-1]
+
+
+class ProductIndex:
+    # In-memory search over the product catalogue: exact code and barcode
+    # lookups, case-insensitive prefix search on names through a sorted list
+    # of (word, code) pairs, and typo-tolerant matching that narrows the
+    # candidates by shared trigrams before computing a bounded edit distance.
+    # add()/update()/remove() keep it current without rebuilding.
+
+    FUZZY_CANDIDATES = 50
+
+    def __init__(self, products):
+        self.products = products
+        self.words = []
+        self.trigrams = {}
+        self.barcodes = {}
+        self.indexed = {}
+        for code in products:
+            self.add(code)
+
+    def add(self, code):
+        product = self.products[code]
+        name = product['name']
+        barcode = product.get('barcode')
+        self.indexed[code] = (name, barcode)
+        if barcode:
+            self.barcodes[barcode] = code
+        for word in name_words(name):
+            insort(self.words, (word, code))
+            for gram in trigrams(word):
+                self.trigrams.setdefault(gram, set()).add(code)
+
+    def remove(self, code):
+        if code not in self.indexed:
+            return
+        name, barcode = self.indexed.pop(code)
+        if barcode and self.barcodes.get(barcode) == code:
+            del self.barcodes[barcode]
+        for word in name_words(name):
+            index = bisect_left(self.words, (word, code))
+            if index < len(self.words) and self.words[index] == (word, code):
+                del self.words[index]
+            for gram in trigrams(word):
+                codes = self.trigrams.get(gram)
+                if codes is not None:
+                    codes.discard(code)
+                    if not codes:
+                        del self.trigrams[gram]
+
+    def update(self, code):
+        # Stock and price changes leave the index alone; only a new name or
+        # barcode needs re-indexing
+        product = self.products.get(code)
+        if product is None:
+            self.remove(code)
+        elif self.indexed.get(code) != (product['name'], product.get('barcode')):
+            self.remove(code)
+            self.add(code)
+
+    def lookup(self, text):
+        # Exact product code or barcode, else None
+        text = text.strip()
+        if text in self.products:
+            return text
+        return self.barcodes.get(text)
+
+    def prefix(self, text, limit):
+        text = text.lower()
+        codes = []
+        index = bisect_left(self.words, (text, ''))
+        while index < len(self.words) and len(codes) < limit:
+            word, code = self.words[index]
+            if not word.startswith(text):
+                break
+            if code not in codes:
+                codes.append(code)
+            index += 1
+        return codes
+
+    def fuzzy(self, text, limit, exclude=()):
+        text = text.lower()
+        bound = 1 if len(text) <= 4 else 2
+        shared = {}
+        for gram in trigrams(text):
+            for code in self.trigrams.get(gram, ()):
+                if code not in exclude:
+                    shared[code] = shared.get(code, 0) + 1
+        candidates = sorted(shared, key=shared.get, reverse=True)[:self.FUZZY_CANDIDATES]
+
+        scored = []
+        for code in candidates:
+            # Compare against whole words and, for partly typed words, their
+            # first len(text) characters
+            distance = min(min(edit_distance(text, word, bound), edit_distance(text, word[:len(text)], bound))
+                           for word in name_words(self.products[code]['name']))
+            if distance <= bound:
+                scored.append((distance, -shared[code], self.products[code]['name'].lower(), code))
+        return [code for *_, code in sorted(scored)[:limit]]
+
+    def search(self, text, limit=10):
+        # Exact matches first, then name prefixes, then close spellings
+        text = text.strip()
+        if not text:
+            return []
+        codes = []
+        exact = self.lookup(text)
+        if exact:
+            codes.append(exact)
+        for code in self.prefix(text, limit):
+            if code not in codes:
+                codes.append(code)
+        if len(codes) < limit:
+            codes += self.fuzzy(text, limit - len(codes), exclude=set(codes))
+        return codes[:limit]
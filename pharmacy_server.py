@@ -0,0 +1,351 @@
+import sys
+import json
+import signal
+import asyncio
+import argparse
+from pharmacy_storage import open_storage
+from pharmacy_core import SalesEngine, SaleError
+from pharmacy_backup import BackupManager
+from pharmacy_metrics import metrics
+from pharmacy_models import to_dicts
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Longest request line read; a sales batch is sent as one line
+MAX_LINE = 64 * 1024 * 1024
+
+
+def parse_address(address):
+    # "host:port", "host" or ":port"
+    host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+    return host or DEFAULT_HOST, int(port) if port else DEFAULT_PORT
+
+
+class PharmacyServer:
+    # Owns the engine for every till. Clients talk JSON lines over TCP: each
+    # request is {'id', 'op', ...arguments} and each response {'id', 'ok',
+    # 'result'} or {'id', 'ok': False, 'error'}. Requests may be pipelined;
+    # responses come back in request order.
+    #
+    # Everything runs on the event loop thread, so each request sees and
+    # changes the stock atomically. Sales are group-committed: sales that
+    # arrive while the previous batch is being written go out together in
+    # one process_sales_batch call (one journal write), so throughput grows
+    # with the number of tills instead of being capped by fsync.
+
+    def __init__(self, engine, backups=None, backup_every=300, checkpoint_every=10):
+        self.engine = engine
+        self.backups = backups
+        self.backup_every = backup_every
+        self.checkpoint_every = checkpoint_every
+        self.pending = []
+        self.wakeup = None
+        self.change_seq = 0
+        self.changed = {}
+        self.server = None
+        self.commits = 0
+
+    def product_record(self, code):
+        return dict(self.engine.products[code], version=self.engine.version(code))
+
+    def touch(self, codes):
+        # Remember which products changed, for clients refreshing their cache
+        self.change_seq += 1
+        for code in codes:
+            self.changed[code] = self.change_seq
+
+    # Operations
+
+    def op_products(self):
+        return {'seq': self.change_seq,
+                'products': {code: self.product_record(code) for code in self.engine.products}}
+
+    def op_changes(self, since):
+        return {'seq': self.change_seq,
+                'products': {code: self.product_record(code)
+                             for code, seq in self.changed.items() if seq > since}}
+
+    def op_add_product(self, code, name, price, quantity, barcode=None, reorder_point=None):
+        self.engine.add_product(code, name, price, quantity, barcode, reorder_point)
+        self.touch([code])
+        return self.product_record(code)
+
+    def op_restock(self, code, quantity, lot=None, expiry=None):
+        self.engine.restock(code, quantity, lot, expiry)
+        self.touch([code])
+        return self.product_record(code)
+
+    def op_write_off(self, code, lot):
+        self.engine.write_off(code, lot)
+        self.touch([code])
+        return self.product_record(code)
+
+    def op_update_product(self, code, changes, version=None):
+        self.engine.update_product(code, changes, version)
+        self.touch([code])
+        return self.product_record(code)
+
+    def op_check_item(self, code, quantity, in_cart=0, token=None):
+        self.engine.check_item(code, quantity, in_cart, token)
+        return True
+
+    def op_reserve(self, token, code, quantity):
+        return self.engine.reserve(token, code, quantity)
+
+    def op_set_reservation(self, token, code, quantity):
+        return self.engine.set_reservation(token, code, quantity)
+
+    def op_release(self, token, code=None):
+        self.engine.release(token, code)
+        return True
+
+    def op_sales_between(self, start, end, code=None):
+        return self.engine.sales_between(start, end, code)
+
+    def op_low_stock(self):
+        return self.engine.low_stock()
+
+    def op_expiring(self, days):
+        return self.engine.expiring(days)
+
+    def op_purchase_suggestions(self, lead_time, review_days):
+        return self.engine.purchase_suggestions(lead_time, review_days)
+
+    def op_get_sales(self, start=None, end=None):
+        return to_dicts(self.engine.storage.get_sales(start, end))
+
+    def op_sales_total(self, start=None, end=None):
+        return self.engine.storage.sales_total(start, end)
+
+    def op_list_months(self):
+        return self.engine.storage.list_months()
+
+    def op_month_summary(self, month):
+        return self.engine.storage.month_summary(month)
+
+    def op_stats(self):
+        return {'commits': self.commits, 'sales': self.engine.storage.sales_total()[0]}
+
+    # Sales go through the group commit instead of running inline
+
+    def enqueue_sales(self, entries):
+        futures = []
+        for entry in entries:
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((entry, future))
+            futures.append(future)
+        self.wakeup.set()
+        return futures
+
+    async def commit_loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            # Let every connection with data waiting add its sales first
+            await asyncio.sleep(0)
+            batch, self.pending = self.pending, []
+            if not batch:
+                continue
+            try:
+                with metrics.timer('sales_batch'):
+                    results = self.engine.process_sales_batch([entry for entry, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.commits += 1
+
+            codes = set()
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, SaleError):
+                    future.set_exception(result)
+                else:
+                    codes.update(item['code'] for item in result['items'])
+                    future.set_result(result)
+            if codes:
+                self.touch(codes)
+
+    async def sale_result(self, futures, batch=False):
+        # A single sale answers with the sale; a batch with one entry per
+        # sale, either the sale or {'error': message}
+        if not batch:
+            return await futures[0]
+        results = []
+        for future in futures:
+            try:
+                results.append(await future)
+            except SaleError as e:
+                results.append({'error': str(e)})
+        return results
+
+    async def changes_after(self, futures, since):
+        await asyncio.gather(*futures, return_exceptions=True)
+        return self.op_changes(since)
+
+    def dispatch(self, request):
+        # Returns the result, or a coroutine for requests that must wait
+        op = request.get('op')
+        args = {key: value for key, value in request.items() if key not in ('id', 'op')}
+        if op == 'sale':
+            return self.sale_result(self.enqueue_sales([args]))
+        if op == 'sales_batch':
+            return self.sale_result(self.enqueue_sales(args['sales']), batch=True)
+        if op == 'changes' and self.pending:
+            # Include the sales pipelined ahead of this request
+            return self.changes_after([future for _, future in self.pending], **args)
+        handler = getattr(self, f'op_{op}', None)
+        if handler is None:
+            raise SaleError(f'Unknown operation: {op}')
+        return handler(**args)
+
+    # Connections
+
+    async def respond(self, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            result = self.dispatch(request)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return {'id': request_id, 'ok': True, 'result': result}
+        except Exception as e:
+            # Rejected sales, malformed requests and failed writes are all
+            # reported to the till; the server keeps running
+            return {'id': request_id, 'ok': False, 'error': str(e)}
+
+    async def rejected(self, message):
+        return {'id': None, 'ok': False, 'error': message}
+
+    async def read_request(self, reader):
+        # The next request line, or None at the end of the stream. A line
+        # longer than the limit is skipped to its end and answered with an
+        # error, so the till stays connected and its answers in order.
+        try:
+            return await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial or None
+        except asyncio.LimitOverrunError:
+            pass
+        while True:
+            try:
+                await reader.readuntil(b'\n')
+                return False
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+
+    async def write_responses(self, writer, responses):
+        while True:
+            response = await responses.get()
+            if response is None:
+                break
+            writer.write((json.dumps(await response) + '\n').encode())
+            if responses.empty():
+                await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        # Requests are started in the order they are read without waiting
+        # for earlier answers; a writer task sends the answers back in
+        # order, so one till can keep many requests in flight
+        responses = asyncio.Queue()
+        writer_task = asyncio.create_task(self.write_responses(writer, responses))
+        try:
+            while True:
+                line = await self.read_request(reader)
+                if line is None:
+                    break
+                if line is False:
+                    response = self.rejected(f'Request longer than {MAX_LINE} bytes!')
+                else:
+                    response = self.respond(line)
+                responses.put_nowait(asyncio.ensure_future(response))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            responses.put_nowait(None)
+            try:
+                await writer_task
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def prepare_backup(self):
+        write = self.engine.prepare_checkpoint()
+
+        def backup():
+            write()
+            self.engine.storage.backup(self.backups)
+            self.backups.prune()
+        return backup
+
+    async def persist_loop(self):
+        # Checkpoints and backups are prepared on the loop and written by a
+        # worker thread, as the GUI does, so tills are never kept waiting
+        loop = asyncio.get_running_loop()
+        since_backup = 0
+        while True:
+            await asyncio.sleep(self.checkpoint_every)
+            since_backup += self.checkpoint_every
+            if metrics.enabled:
+                metrics.write()
+            if self.backups and since_backup >= self.backup_every:
+                since_backup = 0
+                name, write = 'Backup', self.prepare_backup()
+            elif self.engine.needs_checkpoint():
+                name, write = 'Checkpoint', self.engine.prepare_checkpoint()
+            else:
+                continue
+            try:
+                with metrics.timer(f'{name.lower()}_write'):
+                    await loop.run_in_executor(None, write)
+            except Exception as e:
+                print(f"{name} failed: {e}", file=sys.stderr)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.wakeup = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle_client, host, port, limit=MAX_LINE)
+        self.tasks = [asyncio.create_task(self.commit_loop()),
+                      asyncio.create_task(self.persist_loop())]
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        host, port = await self.start(host, port)
+        print(f"Listening on {host}:{port}", flush=True)
+        # Stop cleanly on SIGTERM too, so the engine is closed and saved
+        stop = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Not available on Windows
+        await stop.wait()
+        self.server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inventory and sales server for several tills")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="0 picks a free port")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--backups-dir', default='backups')
+    parser.add_argument('--backup-every', type=int, default=300, help="Seconds between backups")
+    parser.add_argument('--no-backups', action='store_true')
+    args = parser.parse_args(argv)
+
+    metrics.configure(args.data_dir)
+    storage = open_storage(data_dir=args.data_dir)
+    # Checkpoints run in the background instead of inside a sale
+    storage.auto_checkpoint = False
+    engine = SalesEngine(storage)
+    backups = None if args.no_backups else BackupManager(args.backups_dir, args.data_dir)
+    server = PharmacyServer(engine, backups, args.backup_every)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+        metrics.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+from bisect import bisect_left, insort
+
+DEFAULT_REORDER_POINT = 10
+
+
+def reorder_point(product):
+    return product.get('reorder_point', DEFAULT_REORDER_POINT)
+
+
+class StockMonitor:
+    # Products ordered by stock minus reorder point, kept in a sorted list of
+    # (margin, code) pairs. Everything below its reorder point has a
+    # negative margin and sits at the front, so listing low stock costs
+    # O(k) for k results. Only products touched by a sale, restock or edit
+    # are re-positioned.
+
+    def __init__(self, products):
+        self.products = products
+        self.margins = {}
+        self.entries = []
+        for code in products:
+            self.add(code)
+
+    def margin(self, code):
+        product = self.products[code]
+        return product['quantity'] - reorder_point(product)
+
+    def add(self, code):
+        margin = self.margin(code)
+        self.margins[code] = margin
+        insort(self.entries, (margin, code))
+
+    def remove(self, code):
+        margin = self.margins.pop(code)
+        index = bisect_left(self.entries, (margin, code))
+        del self.entries[index]
+
+    def update(self, code):
+        # Re-position one product; returns 'low' when it just dropped below
+        # its reorder point, 'restocked' when it just got back above it
+        if code not in self.products:
+            if code in self.margins:
+                self.remove(code)
+            return None
+        if code not in self.margins:
+            self.add(code)
+            return 'low' if self.margins[code] < 0 else None
+
+        old = self.margins[code]
+        new = self.margin(code)
+        if new == old:
+            return None
+        self.remove(code)
+        self.margins[code] = new
+        insort(self.entries, (new, code))
+        if old >= 0 > new:
+            return 'low'
+        if new >= 0 > old:
+            return 'restocked'
+        return None
+
+    def low_stock(self):
+        # Codes below their reorder point, most urgent first
+        end = bisect_left(self.entries, (0, ''))
+        return [code for _, code in self.entries[:end]]
+
+    def is_low(self, code):
+        return self.margins.get(code, 0) < 0
+
+
+class StockReservations:
+    # Stock held for open carts, so a till's check is still true when the
+    # sale is completed. Holds belong to a token (one per cart) and expire
+    # after `timeout` seconds without activity, so an abandoned cart never
+    # locks stock for good.
+
+    def __init__(self, timeout=900):
+        self.timeout = timeout
+        self.holds = {}
+        self.expires = {}
+        self.totals = {}
+
+    def held(self, token, code):
+        return self.holds.get(token, {}).get(code, 0)
+
+    def reserved(self, code, exclude=None):
+        # Stock held for code by every token except `exclude`
+        return self.totals.get(code, 0) - (self.held(exclude, code) if exclude else 0)
+
+    def add(self, token, code, quantity, now):
+        holds = self.holds.setdefault(token, {})
+        holds[code] = holds.get(code, 0) + quantity
+        self.totals[code] = self.totals.get(code, 0) + quantity
+        self.expires[token] = now + self.timeout
+        if holds[code] <= 0:
+            self.drop(token, code)
+
+    def drop(self, token, code):
+        quantity = self.holds[token].pop(code, 0)
+        remaining = self.totals.get(code, 0) - quantity
+        if remaining:
+            self.totals[code] = remaining
+        else:
+            self.totals.pop(code, None)
+
+    def release(self, token, code=None):
+        if token not in self.holds:
+            return
+        for held_code in [code] if code else list(self.holds[token]):
+            self.drop(token, held_code)
+        if not self.holds[token]:
+            del self.holds[token]
+            del self.expires[token]
+
+    def expire(self, now):
+        for token in [token for token, expires in self.expires.items() if expires <= now]:
+            self.release(token)
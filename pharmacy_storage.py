@@ -0,0 +1,973 @@
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+from pathlib import Path
+from pharmacy_journal import Journal, atomic_write_json, apply_sale_to_month
+from pharmacy_archive import MonthArchive, full_date
+from pharmacy_models import Sale, product_id, shared_cents, to_cents, to_dicts
+from pharmacy_lots import consume, set_remaining
+
+
+def new_month_data(month=None):
+    # A month opened today starts today; one opened for older sales starts
+    # on its first day
+    today = datetime.now().strftime("%Y-%m-%d")
+    return {
+        'sales': [],
+        'total_revenue': 0,
+        'products_sold': {},
+        'start_date': today if month is None or today.startswith(month) else f"{month}-01"
+    }
+
+
+def copy_month_data(data):
+    # Copy of a monthly aggregate that later sales will not mutate. Sale
+    # dicts themselves are never changed once recorded, so they are shared.
+    copy = dict(data)
+    copy['sales'] = list(data['sales'])
+    copy['products_sold'] = {code: dict(stats) for code, stats in data['products_sold'].items()}
+    return copy
+
+
+def month_data_summary(data):
+    return {
+        'total_revenue': data['total_revenue'],
+        'sale_count': len(data['sales']),
+        'products_sold': data['products_sold'],
+        'start_date': data['start_date']
+    }
+
+
+def month_bounds(month):
+    # 'YYYY-MM' -> (first second of the month, first second of the next one)
+    year, mon = int(month[:4]), int(month[5:7])
+    if mon == 12:
+        year, mon = year + 1, 1
+    else:
+        mon += 1
+    return f"{month}-01 00:00:00", f"{year:04d}-{mon:02d}-01 00:00:00"
+
+
+def sale_uid(sale):
+    # Sales written before the journal have no id; derive a stable one from
+    # their content so the same sale found in several backups is kept once
+    if 'id' in sale:
+        return sale['id']
+    digest = hashlib.sha1(json.dumps(sale, sort_keys=True).encode()).hexdigest()
+    return f"legacy-{digest}"
+
+
+class Storage:
+    # Interface shared by every backend. The product catalogue is kept in
+    # memory as `products` (code -> product dict); sales history and monthly
+    # aggregates are only reached through the query methods below.
+    # Dates are the usual "YYYY-MM-DD HH:MM:SS" strings, ranges are [start, end).
+
+    def __init__(self):
+        self.products = {}
+        self.data_dir = 'data'
+        # Set to False when a PersistenceWorker schedules the checkpoints
+        self.auto_checkpoint = True
+
+    def get_product(self, code):
+        return self.products.get(code)
+
+    def put_product(self, code, product):
+        raise NotImplementedError
+
+    def put_products(self, products):
+        for code, product in products.items():
+            self.put_product(code, product)
+
+    def record_sale(self, sale):
+        self.record_sales([sale])
+
+    def record_sales(self, sales, adjust_stock=True):
+        # Persist sales together with their stock decrements and monthly
+        # aggregates. adjust_stock=False is for importing historical sales.
+        raise NotImplementedError
+
+    def get_sales(self, start=None, end=None):
+        raise NotImplementedError
+
+    def sales_since(self, index):
+        # Sales after the first `index` ones, in the order they were recorded
+        raise NotImplementedError
+
+    def sales_total(self, start=None, end=None):
+        # (number of sales, revenue) for the range
+        raise NotImplementedError
+
+    def list_months(self):
+        raise NotImplementedError
+
+    def month_summary(self, month):
+        # {'total_revenue', 'sale_count', 'products_sold', 'start_date'} or None
+        raise NotImplementedError
+
+    def month_fingerprint(self, month):
+        # Cheap marker that changes whenever the month's summary may have, so
+        # reports of it can be cached; None when it cannot be cached
+        return None
+
+    def data_files(self):
+        # Files that make up a complete copy of the data, for backups
+        raise NotImplementedError
+
+    def backup(self, backups):
+        # Snapshot the data files with a BackupManager; runs on the writer
+        # thread after a checkpoint
+        return backups.backup(self.data_files())
+
+    def sales_fingerprint(self):
+        # Cheap marker that changes whenever the saved sales history does,
+        # so derived data can tell it is current without reading every sale;
+        # None when the backend has no such marker
+        return None
+
+    def sales_added_since(self, fingerprint):
+        # Sales recorded since the history had this fingerprint, or None if
+        # that is not known
+        return None
+
+    def needs_checkpoint(self):
+        return False
+
+    def prepare_seal(self, month):
+        # Copy a finished month into the columnar archive (self.archive);
+        # returns the write, which can run on another thread
+        summary = self.month_summary(month)
+        if summary is None:
+            raise ValueError(f"No data for {month}")
+        sales = self.get_sales(*month_bounds(month))
+
+        def write():
+            self.archive.write(month, sales, summary)
+        return write
+
+    def seal_month(self, month):
+        self.prepare_seal(month)()
+
+    def prepare_checkpoint(self):
+        # Split checkpoint for background persistence: this part runs on the
+        # caller's thread and must be quick; the returned function does the
+        # slow writing and may run on any thread
+        self.checkpoint()
+        return lambda: None
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONStorage(Storage):
+    # The original layout: products.json, sales.json and monthly/YYYY-MM.json,
+    # plus journal.log holding every change since the last checkpoint.
+    #
+    # Only the catalogue is read at startup. sales.json is read the first
+    # time the history is queried; until then new sales are kept aside and
+    # checkpoints append them to the file instead of rewriting it from a
+    # full copy in memory.
+    #
+    # Sealed months live in archive/ instead of monthly/ and their sales are
+    # moved out of sales.json, which only holds the open months. A sale dated
+    # in a sealed month still works: the month is read back from the archive
+    # and re-sealed when it is written.
+
+    def __init__(self, data_dir='data', checkpoint_every=200):
+        super().__init__()
+        self.data_dir = data_dir
+        Path(data_dir, 'monthly').mkdir(parents=True, exist_ok=True)
+        # Sales of the open months, once sales.json has been read
+        self.sales = None
+        # Sales recorded before that and not checkpointed yet, the ones a
+        # background checkpoint is writing, and the ones of those (in open
+        # months) that are not in sales.json yet
+        self.new_sales = []
+        self.saving_sales = []
+        self.unsaved_sales = []
+        # Sales the journal added at startup, for the rollups to catch up on
+        self.replayed_sales = []
+        # Unsaved sales and months handed to the last background write,
+        # until it has put them on disk
+        self.writing = None
+        self.months = {}
+        self.dirty_months = set()
+        self.journal = Journal(os.path.join(data_dir, 'journal.log'), checkpoint_every)
+        self.archive = MonthArchive(self.path('archive'))
+        self.sealed = set(self.archive.months())
+        self.load()
+
+    def path(self, *parts):
+        return os.path.join(self.data_dir, *parts)
+
+    def month_path(self, month):
+        return self.path('monthly', f'{month}.json')
+
+    def load(self):
+        if os.path.exists(self.path('products.json')):
+            with open(self.path('products.json'), 'r') as f:
+                self.products = json.load(f)
+
+        # Replaying the journal may append to sales.json
+        self.opened_fingerprint = self.sales_fingerprint()
+        self.replay_journal()
+
+    def read_sales_file(self):
+        # Sales of sealed months still in the file are left out; they are in
+        # the archive
+        if not os.path.exists(self.path('sales.json')):
+            return []
+        with open(self.path('sales.json'), 'r') as f:
+            return [sale for sale in json.load(f) if sale['date'][:7] not in self.sealed]
+
+    def open_sales(self):
+        # Sales of the months not sealed yet, read on first use. Sales
+        # recorded earlier in this session are added unless a checkpoint
+        # already saved them.
+        if self.sales is None:
+            # Taken before the file is read: a background checkpoint only
+            # lets go of its sales once they are in the file
+            pending = self.saving_sales + self.new_sales
+            sales = self.read_sales_file()
+            sale_ids = {sale['id'] for sale in sales if 'id' in sale}
+            sales += [sale for sale in pending
+                      if sale['id'] not in sale_ids and sale['date'][:7] not in self.sealed]
+            # Held as compact Sale objects while in memory
+            self.sales = [Sale.from_dict(sale) for sale in sales]
+            self.new_sales = []
+            self.saving_sales = []
+            self.unsaved_sales = []
+        return self.sales
+
+    def append_sales_file(self, sales):
+        # Add sales to sales.json; the history is only read for the write
+        # and not kept in memory
+        saved = self.read_sales_file()
+        sale_ids = {sale['id'] for sale in saved if 'id' in sale}
+        saved += [sale for sale in sales if sale['id'] not in sale_ids]
+        atomic_write_json(self.path('sales.json'), saved)
+
+    def month_sales(self, month):
+        # Sales of a sealed month: from memory while it is being changed or
+        # has not reached the archive yet
+        if month in self.months or not self.archive.has(month):
+            return [Sale.from_dict(sale) for sale in self.load_month(month)['sales']]
+        return self.archive.open(month).sales()
+
+    def read_month(self, month):
+        # A month from disk: its monthly file, else the archive. A month
+        # being sealed is archived before its file is removed, so one or the
+        # other is always there.
+        try:
+            with open(self.month_path(month), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if self.archive.has(month):
+                return self.archive.month_data(month)
+            return new_month_data(month)
+
+    def load_month(self, month):
+        if month not in self.months:
+            self.months[month] = self.read_month(month)
+        return self.months[month]
+
+    def replay_journal(self):
+        records = self.journal.replay()
+        if not records:
+            return
+
+        # Stock is journaled as absolute quantities and sales carry an id, so
+        # replaying records already folded into a snapshot changes nothing.
+        # Replayed sales that sales.json already has are dropped when the
+        # history is merged or checkpointed.
+        sale_ids = set()
+        month_ids = {}
+
+        for record in records:
+            if record['op'] == 'product':
+                self.products[record['code']] = record['product']
+            elif record['op'] == 'sale':
+                sale = record['sale']
+                for code, quantity in record['stock'].items():
+                    if code in self.products:
+                        self.products[code]['quantity'] = quantity
+                for code, remaining in record.get('lots', {}).items():
+                    if code in self.products and 'lots' in self.products[code]:
+                        self.products[code]['lots'] = set_remaining(self.products[code]['lots'], remaining)
+
+                month = sale['date'][:7]
+                if sale['id'] not in sale_ids:
+                    self.new_sales.append(sale)
+                    self.replayed_sales.append(sale)
+                    if month not in self.sealed:
+                        self.unsaved_sales.append(sale)
+                    sale_ids.add(sale['id'])
+
+                data = self.load_month(month)
+                if month not in month_ids:
+                    month_ids[month] = {s['id'] for s in data['sales'] if 'id' in s}
+                if sale['id'] not in month_ids[month]:
+                    apply_sale_to_month(data, sale)
+                    month_ids[month].add(sale['id'])
+                self.dirty_months.add(month)
+
+        self.checkpoint()
+
+    def put_product(self, code, product):
+        self.products[code] = product
+        self.journal.append({'op': 'product', 'code': code, 'product': product})
+        self.maybe_checkpoint()
+
+    def put_products(self, products):
+        # One journal write for the whole batch
+        self.products.update(products)
+        self.journal.append_many([{'op': 'product', 'code': code, 'product': product}
+                                  for code, product in products.items()])
+        self.maybe_checkpoint()
+
+    def record_sales(self, sales, adjust_stock=True):
+        records = []
+        for sale in sales:
+            lots = {}
+            if adjust_stock:
+                for item in sale['items']:
+                    product = self.products[item['code']]
+                    product['quantity'] -= item['quantity']
+                    if 'lots' in item and 'lots' in product:
+                        product['lots'] = consume(product['lots'], item['lots'])
+                        # Journaled as what is left, like the stock
+                        left = {lot['lot']: lot['quantity'] for lot in product['lots']}
+                        lots[item['code']] = {lot: left.get(lot, 0) for lot, _ in item['lots']}
+
+            month = sale['date'][:7]
+            self.replayed_sales = None
+            if self.sales is None:
+                self.new_sales.append(sale)
+                if month not in self.sealed:
+                    self.unsaved_sales.append(sale)
+            elif month not in self.sealed:
+                self.sales.append(Sale.from_dict(sale))
+            apply_sale_to_month(self.load_month(month), sale)
+            self.dirty_months.add(month)
+
+            stock = {}
+            if adjust_stock:
+                stock = {item['code']: self.products[item['code']]['quantity'] for item in sale['items']}
+            record = {'op': 'sale', 'sale': sale, 'stock': stock}
+            if lots:
+                record['lots'] = lots
+            records.append(record)
+
+        # One small fsync'd write instead of rewriting every file
+        self.journal.append_many(records)
+        self.maybe_checkpoint()
+
+    def sealed_in_range(self, start, end):
+        # Sealed months overlapping [start, end), and whether each is whole
+        start = full_date(start) if start is not None else None
+        end = full_date(end) if end is not None else None
+        months = []
+        for month in sorted(self.sealed):
+            first, last = month_bounds(month)
+            if (start is None or last > start) and (end is None or first < end):
+                months.append((month, (start is None or start <= first) and (end is None or end >= last)))
+        return months
+
+    def get_sales(self, start=None, end=None):
+        sales = []
+        for month, whole in self.sealed_in_range(start, end):
+            month_sales = self.month_sales(month)
+            sales += month_sales if whole else [sale for sale in month_sales
+                                                if (start is None or sale.date >= start) and
+                                                (end is None or sale.date < end)]
+        if start is None and end is None:
+            return sales + self.open_sales()
+        return sales + [sale for sale in self.open_sales()
+                        if (start is None or sale.date >= start) and (end is None or sale.date < end)]
+
+    def sales_since(self, index):
+        return self.get_sales()[index:]
+
+    def sales_total(self, start=None, end=None):
+        # Sealed months are answered from their summary or a column scan.
+        # Added up in cents, so the total is exact.
+        count, cents = 0, 0
+        for month, whole in self.sealed_in_range(start, end):
+            if month in self.months or not self.archive.has(month):
+                month_sales = [sale for sale in self.load_month(month)['sales'] if whole or
+                               ((start is None or sale['date'] >= start) and (end is None or sale['date'] < end))]
+                month_count, month_total = len(month_sales), sum(to_cents(sale['total']) for sale in month_sales)
+            elif whole:
+                summary = self.archive.summary(month)
+                month_count, month_total = summary['sale_count'], to_cents(summary['total_revenue'])
+            else:
+                month_count, month_total = self.archive.open(month).totals(start, end)
+                month_total = to_cents(month_total)
+            count += month_count
+            cents += month_total
+        sales = self.open_sales()
+        if start is not None or end is not None:
+            sales = [sale for sale in sales
+                     if (start is None or sale.date >= start) and (end is None or sale.date < end)]
+        return count + len(sales), (cents + sum(sale.total_cents for sale in sales)) / 100
+
+    def list_months(self):
+        months = {file[:-5] for file in os.listdir(self.path('monthly')) if file.endswith('.json')}
+        return sorted(months | set(self.months) | set(self.archive.months()))
+
+    def live_month(self, month):
+        # Months being changed are summarized from memory; the current one
+        # is kept there as it is where today's sales go
+        return month in self.months or \
+            (month == datetime.now().strftime("%Y-%m") and month not in self.sealed)
+
+    def month_summary(self, month):
+        if month not in self.months and not os.path.exists(self.month_path(month)):
+            if self.archive.has(month):
+                return self.archive.summary(month)
+            return None
+        if self.live_month(month):
+            return month_data_summary(self.load_month(month))
+        # An older open month is read without keeping its sales in memory
+        return month_data_summary(self.read_month(month))
+
+    def month_fingerprint(self, month):
+        if self.live_month(month):
+            return None
+        for path in (self.month_path(month), self.archive.header_path(month)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            return [path, stat.st_size, stat.st_mtime_ns]
+        return None
+
+    def data_files(self):
+        files = [self.path('products.json'), self.path('sales.json'), self.path('journal.log')]
+        files += self.journal.segments()
+        files += [self.path('monthly', file) for file in sorted(os.listdir(self.path('monthly')))
+                  if file.endswith('.json')]
+        files += self.archive.files()
+        return [file for file in files if os.path.exists(file)]
+
+    def sales_fingerprint(self):
+        try:
+            stat = os.stat(self.path('sales.json'))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def sales_added_since(self, fingerprint):
+        # What the journal added to the history opened at startup; handed
+        # out once, and not at all after other sales were recorded
+        added, self.replayed_sales = self.replayed_sales, None
+        if added is None or fingerprint is None or fingerprint != self.opened_fingerprint:
+            return None
+        return added
+
+    def needs_checkpoint(self):
+        return self.journal.needs_checkpoint()
+
+    def write_month(self, month, data):
+        # Sealed months stay sealed when a late sale changes them
+        if self.archive.has(month):
+            self.archive.write(month, data['sales'], month_data_summary(data))
+            if os.path.exists(self.month_path(month)):
+                os.remove(self.month_path(month))
+        else:
+            atomic_write_json(self.month_path(month), data)
+
+    def recover_write(self):
+        # A background write that failed (or never ran, as an earlier write
+        # of the batch failed) leaves sales and months only the journal has;
+        # they go back in the queue, so the next checkpoint writes them
+        # before the journal segments holding them are discarded
+        if self.writing is None:
+            return
+        unsaved, months = self.writing
+        self.writing = None
+        self.unsaved_sales = [sale for sale in unsaved if sale['date'][:7] not in self.sealed] + \
+            self.unsaved_sales
+        for month, data in months.items():
+            if month not in self.months:
+                self.months[month] = data
+            self.dirty_months.add(month)
+
+    def prepare_seal(self, month):
+        # Only bookkeeping here; a month that is not in memory is read by
+        # the write, on the writer thread
+        self.recover_write()
+        if month not in self.months and not os.path.exists(self.month_path(month)) and \
+                not self.archive.has(month):
+            raise ValueError(f"No data for {month}")
+        data = copy_month_data(self.months[month]) if month in self.months else None
+        self.dirty_months.discard(month)
+        # From now on the month's sales are read from its data, not sales.json
+        self.sealed.add(month)
+        self.unsaved_sales = [sale for sale in self.unsaved_sales if sale['date'][:7] != month]
+        if self.sales is not None:
+            self.sales = [sale for sale in self.sales if sale.date[:7] != month]
+
+        def write():
+            # Archive first, so the month is always in one place or the other
+            month_data = data if data is not None else self.read_month(month)
+            self.archive.write(month, month_data['sales'], month_data_summary(month_data))
+            if os.path.exists(self.month_path(month)):
+                os.remove(self.month_path(month))
+            # Then move its sales out of sales.json, keeping the file small
+            if os.path.exists(self.path('sales.json')):
+                with open(self.path('sales.json'), 'r') as f:
+                    saved = json.load(f)
+                kept = [sale for sale in saved if sale['date'][:7] != month]
+                if len(kept) < len(saved):
+                    atomic_write_json(self.path('sales.json'), kept)
+        return write
+
+    def release_sealed_months(self):
+        # Sealed months changed by late sales are dropped from memory once
+        # the archive has caught up with them
+        for month in [month for month in self.months if month in self.sealed and month not in self.dirty_months]:
+            if self.archive.has(month) and \
+                    self.archive.summary(month)['sale_count'] == len(self.months[month]['sales']):
+                del self.months[month]
+
+    def release_months(self):
+        # Once checkpoint() has written every month, only the current one,
+        # where today's sales go, stays in memory; the others are read back
+        # from disk when needed
+        current = datetime.now().strftime("%Y-%m")
+        for month in [month for month in self.months if month != current]:
+            del self.months[month]
+
+    def write_sales(self, sales, unsaved):
+        # Full rewrite once the history is loaded, else append what is new
+        if sales is not None:
+            atomic_write_json(self.path('sales.json'), to_dicts(sales))
+        elif unsaved:
+            self.append_sales_file(unsaved)
+
+    def prepare_checkpoint(self):
+        # Copy the state and rotate the journal; new sales go to a fresh
+        # journal file while the copies are written out
+        self.recover_write()
+        products = {code: dict(product) for code, product in self.products.items()}
+        sales = list(self.sales) if self.sales is not None else None
+        unsaved, self.unsaved_sales = self.unsaved_sales, []
+        # Set aside until written; a failed write leaves them there
+        self.saving_sales, self.new_sales = self.saving_sales + self.new_sales, []
+        months = {month: copy_month_data(self.months[month]) for month in self.dirty_months}
+        self.dirty_months.clear()
+        self.writing = (unsaved, months)
+        self.release_sealed_months()
+        segment = self.journal.rotate()
+
+        def write():
+            # Write full snapshots atomically, then drop the rotated journal
+            atomic_write_json(self.path('products.json'), products)
+            self.write_sales(sales, unsaved)
+            for month in sorted(months):
+                self.write_month(month, months[month])
+            self.saving_sales = []
+            self.writing = None
+            if segment:
+                self.journal.discard(segment)
+        return write
+
+    def checkpoint(self):
+        # Snapshots are written in place here, so no copies are needed
+        self.recover_write()
+        atomic_write_json(self.path('products.json'), self.products)
+        self.write_sales(self.sales, self.unsaved_sales)
+        self.unsaved_sales = []
+        self.new_sales = []
+        for month in sorted(self.dirty_months):
+            self.write_month(month, self.months[month])
+        self.dirty_months.clear()
+        self.release_months()
+        self.journal.reset()
+
+    def maybe_checkpoint(self):
+        if self.auto_checkpoint and self.journal.needs_checkpoint():
+            self.checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        self.journal.close()
+
+
+class SQLiteStorage(Storage):
+    # Indexed SQLite database. Fields of a product beyond name, price and
+    # quantity are kept as JSON in products.extra so the schema never has to
+    # change when products grow new attributes.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS products (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            quantity INTEGER NOT NULL,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS sales (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL UNIQUE,
+            date TEXT NOT NULL,
+            total REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sale_items (
+            sale_id INTEGER NOT NULL REFERENCES sales(id),
+            code TEXT NOT NULL,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            amount REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sale_item_lots (
+            sale_id INTEGER NOT NULL REFERENCES sales(id),
+            code TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            quantity INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS months (
+            month TEXT PRIMARY KEY,
+            start_date TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sales_date ON sales(date);
+        CREATE INDEX IF NOT EXISTS idx_sale_items_sale ON sale_items(sale_id);
+        CREATE INDEX IF NOT EXISTS idx_sale_items_code ON sale_items(code, sale_id);
+        CREATE INDEX IF NOT EXISTS idx_sale_item_lots_sale ON sale_item_lots(sale_id);
+        CREATE INDEX IF NOT EXISTS idx_sale_item_lots_lot ON sale_item_lots(code, lot);
+    """
+
+    def __init__(self, path='data/pharmacy.db'):
+        super().__init__()
+        self.db_path = path
+        self.data_dir = os.path.dirname(path) or '.'
+        # Sealed months are archived as well, for analytics; the rows stay
+        self.archive = MonthArchive(os.path.join(self.data_dir, 'archive'))
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self.load_products()
+
+    def load_products(self):
+        self.products = {}
+        for code, name, price, quantity, extra in self.conn.execute(
+                'SELECT code, name, price, quantity, extra FROM products'):
+            product = {'name': name, 'price': price, 'quantity': quantity}
+            if extra:
+                product.update(json.loads(extra))
+            self.products[code] = product
+
+    def product_extra(self, product):
+        extra = {key: value for key, value in product.items() if key not in ('name', 'price', 'quantity')}
+        return json.dumps(extra) if extra else None
+
+    def product_row(self, code, product):
+        return (code, product['name'], product['price'], product['quantity'], self.product_extra(product))
+
+    def put_product(self, code, product):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)',
+                              self.product_row(code, product))
+        self.products[code] = product
+
+    def put_products(self, products):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)',
+                                  [self.product_row(code, product) for code, product in products.items()])
+        self.products.update(products)
+
+    def record_sales(self, sales, adjust_stock=True):
+        # Lots left of lot-tracked products, applied with the stock once
+        # the transaction has committed
+        lots = {}
+        # Sales already recorded are skipped, and leave the stock alone
+        inserted = []
+        with self.conn:
+            for sale in sales:
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO sales (uid, date, total) VALUES (?, ?, ?)',
+                    (sale_uid(sale), sale['date'], sale['total']))
+                if cursor.rowcount == 0:
+                    continue
+                inserted.append(sale)
+                sale_id = cursor.lastrowid
+                self.conn.executemany(
+                    'INSERT INTO sale_items VALUES (?, ?, ?, ?, ?, ?)',
+                    [(sale_id, item['code'], item['name'], item['quantity'], item['price'], item['amount'])
+                     for item in sale['items']])
+                self.conn.execute('INSERT OR IGNORE INTO months VALUES (?, ?)',
+                                  (sale['date'][:7], sale['date'][:10]))
+                self.conn.executemany(
+                    'INSERT INTO sale_item_lots VALUES (?, ?, ?, ?)',
+                    [(sale_id, item['code'], lot, quantity)
+                     for item in sale['items'] for lot, quantity in item.get('lots', ())])
+                if adjust_stock:
+                    self.conn.executemany(
+                        'UPDATE products SET quantity = quantity - ? WHERE code = ?',
+                        [(item['quantity'], item['code']) for item in sale['items']])
+                    for item in sale['items']:
+                        product = self.products[item['code']]
+                        if 'lots' in item and 'lots' in product:
+                            lots[item['code']] = consume(lots.get(item['code'], product['lots']), item['lots'])
+            self.conn.executemany(
+                'UPDATE products SET extra = ? WHERE code = ?',
+                [(self.product_extra(dict(self.products[code], lots=code_lots)), code)
+                 for code, code_lots in lots.items()])
+
+        if adjust_stock:
+            for sale in inserted:
+                for item in sale['items']:
+                    self.products[item['code']]['quantity'] -= item['quantity']
+            for code, code_lots in lots.items():
+                self.products[code]['lots'] = code_lots
+
+    def range_clause(self, start, end):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('s.date >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('s.date < ?')
+            params.append(end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        return where, params
+
+    def get_sales(self, start=None, end=None):
+        where, params = self.range_clause(start, end)
+        return self.query_sales(where, params)
+
+    def sales_since(self, index):
+        row = self.conn.execute('SELECT id FROM sales ORDER BY id LIMIT 1 OFFSET ?', (index,)).fetchone()
+        if row is None:
+            return []
+        return self.query_sales('WHERE s.id >= ?', [row[0]])
+
+    def query_sales(self, where, params, conn=None):
+        conn = conn or self.conn
+        sales = {}
+        for sale_id, uid, date in conn.execute(
+                f'SELECT s.id, s.uid, s.date FROM sales s {where} ORDER BY s.id', params):
+            sales[sale_id] = (uid, date, [])
+
+        codes = {}
+        for sale_id, code, name, quantity, price in conn.execute(
+                f'SELECT i.sale_id, i.code, i.name, i.quantity, i.price '
+                f'FROM sale_items i JOIN sales s ON s.id = i.sale_id {where} ORDER BY i.sale_id, i.rowid',
+                params):
+            sales[sale_id][2].extend((product_id(code, name), quantity, shared_cents(to_cents(price))))
+            codes.setdefault(sale_id, []).append(code)
+
+        # Lots the lines were sold from, for the sales that have any
+        lots = {}
+        for sale_id, code, lot, quantity in conn.execute(
+                f'SELECT l.sale_id, l.code, l.lot, l.quantity '
+                f'FROM sale_item_lots l JOIN sales s ON s.id = l.sale_id {where} ORDER BY l.sale_id, l.rowid',
+                params):
+            lots.setdefault(sale_id, {}).setdefault(code, []).append((lot, quantity))
+        return [Sale(uid, date, tuple(lines),
+                     tuple(tuple(lots[sale_id].get(code, ())) for code in codes[sale_id]) if sale_id in lots else None)
+                for sale_id, (uid, date, lines) in sales.items()]
+
+    def sales_total(self, start=None, end=None, conn=None):
+        where, params = self.range_clause(start, end)
+        # Summed in cents, so the total is exact
+        count, cents = (conn or self.conn).execute(
+            f'SELECT COUNT(*), COALESCE(SUM(ROUND(s.total * 100)), 0) FROM sales s {where}', params).fetchone()
+        return count, cents / 100
+
+    def list_months(self):
+        return [row[0] for row in self.conn.execute('SELECT month FROM months ORDER BY month')]
+
+    def month_summary(self, month, conn=None):
+        conn = conn or self.conn
+        row = conn.execute('SELECT start_date FROM months WHERE month = ?', (month,)).fetchone()
+        if row is None:
+            return None
+
+        start, end = month_bounds(month)
+        count, total = self.sales_total(start, end, conn)
+        products_sold = {}
+        for code, quantity, revenue in conn.execute(
+                'SELECT i.code, SUM(i.quantity), SUM(i.amount) FROM sale_items i '
+                'JOIN sales s ON s.id = i.sale_id WHERE s.date >= ? AND s.date < ? GROUP BY i.code',
+                (start, end)):
+            products_sold[code] = {'quantity': quantity, 'revenue': revenue}
+        return {
+            'total_revenue': total,
+            'sale_count': count,
+            'products_sold': products_sold,
+            'start_date': row[0]
+        }
+
+    def month_fingerprint(self, month):
+        start, end = month_bounds(month)
+        return list(self.conn.execute(
+            'SELECT m.start_date, COUNT(s.id), MAX(s.id) FROM months m '
+            'LEFT JOIN sales s ON s.date >= ? AND s.date < ? WHERE m.month = ?',
+            (start, end, month)).fetchone())
+
+    def prepare_seal(self, month):
+        # The month is read back by the write, through a connection of its
+        # own as it runs on the writer thread
+        if self.conn.execute('SELECT 1 FROM months WHERE month = ?', (month,)).fetchone() is None:
+            raise ValueError(f"No data for {month}")
+
+        def write():
+            conn = sqlite3.connect(self.db_path)
+            try:
+                summary = self.month_summary(month, conn)
+                sales = self.query_sales(*self.range_clause(*month_bounds(month)), conn)
+            finally:
+                conn.close()
+            self.archive.write(month, sales, summary)
+        return write
+
+    def put_month(self, month, start_date):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?)', (month, start_date))
+
+    def data_files(self):
+        return [self.db_path] + self.archive.files()
+
+    def backup(self, backups):
+        # The database is copied with SQLite's online backup, which gives a
+        # consistent copy while sales are being written, into a temporary
+        # file that is snapshotted under the database's name. Own
+        # connections, as this runs on the writer thread.
+        tmp_path = f"{self.db_path}.backup.tmp"
+        source, copy = sqlite3.connect(self.db_path), sqlite3.connect(tmp_path)
+        try:
+            source.backup(copy)
+        finally:
+            copy.close()
+            source.close()
+        files = {os.path.relpath(path, self.data_dir).replace(os.sep, '/'): path for path in self.archive.files()}
+        files[os.path.basename(self.db_path)] = tmp_path
+        try:
+            return backups.backup_files(files)
+        finally:
+            os.remove(tmp_path)
+
+    def prepare_checkpoint(self):
+        # Connections can't be shared across threads, so the background half
+        # checkpoints the WAL through its own connection
+        def write():
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            finally:
+                conn.close()
+        return write
+
+    def checkpoint(self):
+        # Fold the WAL back into the main file
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.checkpoint()
+        self.conn.close()
+
+
+def open_storage(backend=None, data_dir='data'):
+    # The backend can be picked with the PHARMACY_STORAGE environment variable
+    backend = backend or os.environ.get('PHARMACY_STORAGE', 'json')
+    if backend == 'json':
+        return JSONStorage(data_dir)
+    if backend == 'sqlite':
+        return SQLiteStorage(os.path.join(data_dir, 'pharmacy.db'))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def read_json_dir(directory):
+    # Products, sales and monthly files from a data/ or backups/backup_* dir,
+    # sealed months included. Backups keep their monthly files next to
+    # products.json.
+    products, sales, months = {}, [], {}
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        if file == 'products.json':
+            with open(path, 'r') as f:
+                products = json.load(f)
+        elif file == 'sales.json':
+            with open(path, 'r') as f:
+                sales.extend(json.load(f))
+        elif file == 'monthly' and os.path.isdir(path):
+            _, month_sales, month_files = read_json_dir(path)
+            sales.extend(month_sales)
+            months.update(month_files)
+        elif file == 'archive' and os.path.isdir(path):
+            archive = MonthArchive(path)
+            for month in archive.months():
+                archived = archive.open(month)
+                sales.extend(to_dicts(archived.sales()))
+                months[month] = archived.summary['start_date']
+                archived.close()
+        elif file.endswith('.json') and len(file) == 12 and file[4] == '-':
+            with open(path, 'r') as f:
+                data = json.load(f)
+            sales.extend(data.get('sales', []))
+            months[file[:7]] = data.get('start_date', f"{file[:7]}-01")
+    return products, sales, months
+
+
+def migrate(data_dir='data', backups_dir='backups', db_path='data/pharmacy.db'):
+    # One-shot import of the JSON data (and every JSON backup) into SQLite.
+    # Products come from the live data only, as the backups hold older
+    # prices and stock; sales are merged and de-duplicated. Stock is not
+    # adjusted.
+    sources = []
+    if backups_dir and os.path.isdir(backups_dir):
+        sources += [os.path.join(backups_dir, name) for name in sorted(os.listdir(backups_dir))
+                    if os.path.isdir(os.path.join(backups_dir, name))]
+
+    # Opening the JSON storage replays any pending journal into the snapshots
+    JSONStorage(data_dir).close()
+    sources.append(data_dir)
+
+    products, sales, months = {}, {}, {}
+    for source in sources:
+        source_products, source_sales, source_months = read_json_dir(source)
+        if source == data_dir:
+            products = source_products
+        for sale in source_sales:
+            sales.setdefault(sale_uid(sale), sale)
+        for month, start_date in source_months.items():
+            months.setdefault(month, start_date)
+
+    storage = SQLiteStorage(db_path)
+    storage.put_products(products)
+    storage.record_sales(sorted(sales.values(), key=lambda sale: sale['date']), adjust_stock=False)
+    for month, start_date in months.items():
+        storage.put_month(month, start_date)
+    storage.close()
+    return len(products), len(sales), len(months)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pharmacy storage tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help="Import the JSON data and backups into SQLite")
+    migrate_parser.add_argument('--data-dir', default='data')
+    migrate_parser.add_argument('--backups-dir', default='backups')
+    migrate_parser.add_argument('--db', default='data/pharmacy.db')
+    args = parser.parse_args(argv)
+
+    if args.command == 'migrate':
+        products, sales, months = migrate(args.data_dir, args.backups_dir, args.db)
+        print(f"Migrated {products} products, {sales} sales and {months} months into {args.db}")
+        print("Run with PHARMACY_STORAGE=sqlite to use it.")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,44 @@
 import os
+import sys
 import json
-from datetime import datetime
+import heapq
+import argparse
+from datetime import datetime, timedelta
+from pharmacy_storage import open_storage
+from pharmacy_core import SalesEngine, SaleError, format_receipt
+from pharmacy_cart import Cart
+from pharmacy_forecast import LEAD_TIME, REVIEW_DAYS
+from pharmacy_stock import reorder_point
+
+def open_engine(server=None):
+    if server:
+        from pharmacy_client import RemoteEngine
+        return RemoteEngine(server)
+    return SalesEngine(open_storage())
+
 
 class PharmacySystem:
-    def __init__(self):
+    def __init__(self, server=None):
+        self.storage = None
         self.products = {}
-        self.sales = []
+        self.server = server or os.environ.get('PHARMACY_SERVER')
         self.load_data()
 
     def load_data(self):
-        # Load products from file if exists
-        if os.path.exists('products.json'):
-            with open('products.json', 'r') as f:
-                self.products = json.load(f)
-        
-        # Load sales from file if exists
-        if os.path.exists('sales.json'):
-            with open('sales.json', 'r') as f:
-                self.sales = json.load(f)
+        # Same data directory and backend as the GUI, or a shared
+        # pharmacy_server when one is given
+        self.engine = open_engine(self.server)
+        self.storage = self.engine.storage
+        self.products = self.engine.products
+        self.engine.add_stock_listener(self.stock_alert)
+
+    def stock_alert(self, event, code):
+        if event == 'low':
+            product = self.products[code]
+            print(f"Low stock: {product['name']} ({product['quantity']} left, reorder point {reorder_point(product)})")
 
     def save_data(self):
-        # Save products to file
-        with open('products.json', 'w') as f:
-            json.dump(self.products, f, indent=4)
-        
-        # Save sales to file
-        with open('sales.json', 'w') as f:
-            json.dump(self.sales, f, indent=4)
+        self.engine.checkpoint()
 
     def add_product(self):
         print("\n=== Add New Product ===")
@@ -42,16 +54,23 @@ class PharmacySystem:
         except ValueError:
             print("Invalid input! Price and quantity must be numbers.")
             return
+        barcode = input("Enter barcode (optional): ").strip() or None
+        try:
+            point = input("Enter reorder point (Enter for default): ").strip()
+            point = int(point) if point else None
+        except ValueError:
+            print("Invalid input! Reorder point must be a number.")
+            return
 
-        self.products[code] = {
-            "name": name,
-            "price": price,
-            "quantity": quantity
-        }
-        self.save_data()
+        try:
+            self.engine.add_product(code, name, price, quantity, barcode, point)
+        except SaleError as e:
+            print(e)
+            return
         print(f"\nProduct '{name}' added successfully!")
 
     def view_products(self):
+        self.engine.refresh()
         print("\n=== Product List ===")
         print("Code\tName\t\tPrice\tQuantity")
         print("-" * 40)
@@ -60,18 +79,19 @@ class PharmacySystem:
 
     def make_sale(self):
         print("\n=== New Sale ===")
-        sale_items = []
-        total_amount = 0
+        # Stock is held for this sale as items are added; a product entered
+        # twice adds to its line
+        cart = Cart(self.engine)
+        self.engine.refresh()
 
         while True:
-            self.view_products()
-            code = input("\nEnter product code (or 'done' to finish): ")
+            text = input("\nEnter product code, barcode or name (or 'done' to finish): ")
             
-            if code.lower() == 'done':
+            if text.lower() == 'done':
                 break
 
-            if code not in self.products:
-                print("Product not found!")
+            code = self.find_product(text)
+            if code is None:
                 continue
 
             try:
@@ -80,67 +100,361 @@ class PharmacySystem:
                 print("Invalid quantity!")
                 continue
 
-            if quantity > self.products[code]['quantity']:
-                print("Insufficient stock!")
+            try:
+                cart.add(code, quantity)
+            except SaleError as e:
+                print(e)
                 continue
+            print(f"Cart total: ${cart.total_cents / 100:.2f}")
+
+        if len(cart):
+            if cart.reprice():
+                print(f"Prices changed since the items were added. Cart total: ${cart.total_cents / 100:.2f}")
+                if input("Complete the sale? (y/n): ").lower() != 'y':
+                    cart.clear()
+                    return
+            # Decrements stock and records the sale in a single write
+            try:
+                sale = cart.checkout()
+            except SaleError as e:
+                print(e)
+                cart.clear()
+                return
+            print()
+            print(format_receipt(sale))
+
+    def find_product(self, text):
+        # Exact codes and barcodes are taken directly; anything else is
+        # searched by name and picked from a short numbered list
+        code = self.engine.lookup(text)
+        if code:
+            return code
 
+        matches = self.engine.search(text)
+        if not matches:
+            print("Product not found!")
+            return None
+
+        print("Code\tName\t\tPrice\tQuantity")
+        print("-" * 40)
+        for number, code in enumerate(matches, 1):
             product = self.products[code]
-            amount = quantity * product['price']
-            
-            sale_items.append({
-                "code": code,
-                "name": product['name'],
-                "quantity": quantity,
-                "price": product['price'],
-                "amount": amount
-            })
-
-            # Update stock
-            self.products[code]['quantity'] -= quantity
-            total_amount += amount
-
-        if sale_items:
-            # Record the sale
-            sale = {
-                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "items": sale_items,
-                "total": total_amount
-            }
-            self.sales.append(sale)
-            self.save_data()
-
-            # Print receipt
-            print("\n=== Receipt ===")
-            print("Date:", sale["date"])
-            print("\nItems:")
-            print("Name\t\tQty\tPrice\tAmount")
-            print("-" * 40)
-            for item in sale_items:
-                print(f"{item['name'][:12]}\t{item['quantity']}\t${item['price']:.2f}\t${item['amount']:.2f}")
-            print("-" * 40)
-            print(f"Total Amount: ${total_amount:.2f}")
+            print(f"{number}. {code}\t{product['name'][:12]}\t${product['price']:.2f}\t{product['quantity']}")
+        choice = input("Choose a product (Enter to search again): ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            return matches[int(choice) - 1]
+        return None
 
     def check_stock(self):
+        self.engine.refresh()
         print("\n=== Low Stock Alert ===")
-        print("Products with quantity less than 10:")
-        print("Code\tName\t\tQuantity")
-        print("-" * 40)
-        for code, product in self.products.items():
-            if product['quantity'] < 10:
-                print(f"{code}\t{product['name'][:12]}\t{product['quantity']}")
+        print("Products below their reorder point:")
+        print("Code\tName\t\tQuantity\tReorder Point")
+        print("-" * 50)
+        for code in self.engine.low_stock():
+            product = self.products[code]
+            print(f"{code}\t{product['name'][:12]}\t{product['quantity']}\t\t{reorder_point(product)}")
+
+        lots = self.engine.expiring(30)
+        if lots:
+            print("\nLots expiring within 30 days (expired lots are not sold):")
+            print("Expiry\t\tCode\tName\t\tLot\tQuantity")
+            print("-" * 60)
+            for lot in lots:
+                print(f"{lot['expiry']}\t{lot['code']}\t{lot['name'][:12]}\t{lot['lot']}\t{lot['quantity']}")
+
+    def view_purchase_suggestions(self):
+        print("\n=== Purchase Suggestions ===")
+        try:
+            lead_time = input(f"Lead time in days (Enter for {LEAD_TIME}): ").strip()
+            lead_time = int(lead_time) if lead_time else LEAD_TIME
+        except ValueError:
+            print("Invalid lead time!")
+            return
+        try:
+            suggestions = self.engine.purchase_suggestions(lead_time)
+        except SaleError as e:
+            print(e)
+            return
+        if not suggestions:
+            print("Nothing needs ordering.")
+            return
+
+        print("Code\tName\t\tStock\tPer Day\tDays Left\tOrder")
+        print("-" * 60)
+        for suggestion in suggestions:
+            days_left = f"{suggestion['days_left']:.1f}" if suggestion['days_left'] is not None else '-'
+            print(f"{suggestion['code']}\t{suggestion['name'][:12]}\t{suggestion['stock']}\t"
+                  f"{suggestion['daily']:.2f}\t{days_left}\t\t{suggestion['order']}")
 
     def view_sales_report(self):
         print("\n=== Sales Report ===")
-        if not self.sales:
+        count, total_sales = self.storage.sales_total()
+        if not count:
             print("No sales recorded yet!")
             return
 
-        total_sales = sum(sale['total'] for sale in self.sales)
         print(f"Total Sales: ${total_sales:.2f}")
-        print(f"Number of Transactions: {len(self.sales)}")
+        print(f"Number of Transactions: {count}")
+
+    def view_range_report(self):
+        print("\n=== Sales by Date Range ===")
+        try:
+            start = datetime.strptime(input("From (YYYY-MM-DD): ").strip(), "%Y-%m-%d")
+            end = datetime.strptime(input("To (YYYY-MM-DD): ").strip(), "%Y-%m-%d") + timedelta(days=1)
+        except ValueError:
+            print("Invalid date! Use the YYYY-MM-DD format.")
+            return
+        code = input("Product code (Enter for all): ").strip() or None
+
+        result = self.engine.sales_between(start, end, code)
+        print(f"\nTotal Revenue: ${result['revenue']:.2f}")
+        if code is None:
+            print(f"Number of Transactions: {result['sales']}")
+
+        top_products = heapq.nlargest(10, result['products'].items(), key=lambda x: x[1]['revenue'])
+        for product_code, stats in top_products:
+            name = self.products[product_code]['name'] if product_code in self.products else product_code
+            print(f"{name}: {stats['quantity']} sold, ${stats['revenue']:.2f}")
+
+
+class CommandRunner:
+    # Non-interactive mode. Commands are JSON objects shaped like
+    # pharmacy_server requests, {'id', 'op', ...arguments}, and each gets one
+    # response, {'id', 'ok': True, 'result'} or {'id', 'ok': False, 'error'},
+    # in command order. Consecutive sales are committed together through
+    # process_sales_batch (one journal write per batch), and checkpoints are
+    # left to the end of the run, so a long stream costs one load and one
+    # final save.
+    SALE_BATCH = 500
+
+    def __init__(self, engine, sale_batch=SALE_BATCH):
+        self.engine = engine
+        self.sale_batch = sale_batch
+        self.sales = []         # (request id, sale entry) waiting for commit
+        self.low = []
+        self.failed = 0
+        engine.add_stock_listener(self.stock_alert)
+
+    def stock_alert(self, event, code):
+        if event == 'low':
+            self.low.append(code)
+
+    def product_record(self, code):
+        return dict(self.engine.products[code], code=code)
+
+    # Operations
+
+    def op_products(self):
+        return [self.product_record(code) for code in self.engine.products]
+
+    def op_add_product(self, code, name, price, quantity, barcode=None, reorder_point=None):
+        self.engine.add_product(code, name, price, quantity, barcode, reorder_point)
+        return self.product_record(code)
+
+    def op_restock(self, code, quantity, lot=None, expiry=None):
+        self.engine.restock(code, quantity, lot, expiry)
+        return self.product_record(code)
+
+    def op_write_off(self, code, lot):
+        self.engine.write_off(code, lot)
+        return self.product_record(code)
+
+    def op_expiring(self, days=30):
+        return self.engine.expiring(days)
+
+    def op_set_reorder_point(self, code, reorder_point):
+        self.engine.set_reorder_point(code, reorder_point)
+        return self.product_record(code)
+
+    def op_update_product(self, code, changes):
+        self.engine.update_product(code, changes)
+        return self.product_record(code)
+
+    def op_low_stock(self):
+        return [dict(self.product_record(code), reorder_point=reorder_point(self.engine.products[code]))
+                for code in self.engine.low_stock()]
+
+    def op_purchase_suggestions(self, lead_time=LEAD_TIME, review_days=REVIEW_DAYS):
+        return self.engine.purchase_suggestions(lead_time, review_days)
+
+    def op_sales_between(self, start, end, code=None):
+        return self.engine.sales_between(start, end, code)
+
+    def op_sales_total(self, start=None, end=None):
+        count, total = self.engine.storage.sales_total(start, end)
+        return {'sales': count, 'total': total}
+
+    # Running
+
+    def response(self, request_id, result=None, error=None):
+        if error is not None:
+            self.failed += 1
+            return {'id': request_id, 'ok': False, 'error': error}
+        response = {'id': request_id, 'ok': True, 'result': result}
+        if self.low:
+            response['low_stock'] = self.low
+            self.low = []
+        return response
+
+    def commit_sales(self):
+        if not self.sales:
+            return []
+        pending, self.sales = self.sales, []
+        results = self.engine.process_sales_batch([entry for _, entry in pending])
+        return [self.response(request_id, error=str(result)) if isinstance(result, SaleError)
+                else self.response(request_id, result)
+                for (request_id, _), result in zip(pending, results)]
+
+    def run_command(self, command):
+        # Yields the responses that are ready: a sale only answers once its
+        # batch is committed
+        request_id = command.get('id') if isinstance(command, dict) else None
+        try:
+            if not isinstance(command, dict):
+                raise SaleError('A command must be a JSON object')
+            op = command.get('op')
+            args = {key: value for key, value in command.items() if key not in ('id', 'op')}
+            if op == 'sale':
+                items = [(self.engine.lookup(code) or code, quantity) for code, quantity in
+                         ((item['code'], item['quantity']) if isinstance(item, dict) else item
+                          for item in args['items'])]
+                self.sales.append((request_id, {'items': items, 'date': args.get('date')}))
+                if len(self.sales) >= self.sale_batch:
+                    yield from self.commit_sales()
+                return
+            yield from self.commit_sales()
+            handler = getattr(self, f'op_{op}', None)
+            if handler is None:
+                raise SaleError(f'Unknown operation: {op}')
+            result = handler(**args)
+        except Exception as e:
+            # Bad commands and rejected operations are reported and the
+            # stream carries on
+            yield self.response(request_id, error=str(e))
+            return
+        yield self.response(request_id, result)
+
+    def run(self, commands, out):
+        # commands are (line number, text) pairs of JSON
+        for number, text in commands:
+            text = text.strip()
+            if not text or text.startswith('#'):
+                continue
+            try:
+                command = json.loads(text)
+            except ValueError:
+                for response in self.commit_sales():
+                    self.write(out, response)
+                self.write(out, self.response(None, error=f'Line {number}: not valid JSON'))
+                continue
+            for response in self.run_command(command):
+                self.write(out, response)
+        for response in self.commit_sales():
+            self.write(out, response)
+
+    def write(self, out, response):
+        out.write(json.dumps(response) + '\n')
+
+
+def parse_item(text):
+    # "CODE" or "CODE:QUANTITY" (codes or barcodes)
+    code, _, quantity = text.rpartition(':') if ':' in text else (text, '', '1')
+    try:
+        return [code, int(quantity)]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid item: {text!r}")
+
+
+def command_from_args(args):
+    if args.command == 'sale':
+        return {'op': 'sale', 'items': args.items, 'date': args.date}
+    if args.command == 'restock':
+        return {'op': 'restock', 'code': args.code, 'quantity': args.quantity, 'lot': args.lot,
+                'expiry': args.expiry}
+    if args.command == 'expiring':
+        return {'op': 'expiring', 'days': args.days}
+    if args.command == 'add-product':
+        return {'op': 'add_product', 'code': args.code, 'name': args.name, 'price': args.price,
+                'quantity': args.quantity, 'barcode': args.barcode, 'reorder_point': args.reorder_point}
+    if args.command == 'products':
+        return {'op': 'products'}
+    if args.command == 'low-stock':
+        return {'op': 'low_stock'}
+    if args.command == 'reorder':
+        return {'op': 'purchase_suggestions', 'lead_time': args.lead_time, 'review_days': args.review_days}
+    if args.command == 'report':
+        if args.product or (args.start and args.end):
+            if not (args.start and args.end):
+                raise SystemExit("report: --product needs --from and --to")
+            return {'op': 'sales_between', 'start': args.start, 'end': args.end, 'code': args.product}
+        return {'op': 'sales_total', 'start': args.start, 'end': args.end}
+
+
+def run_batch(args):
+    # One load, every command, one final save
+    engine = open_engine(args.server)
+    auto_checkpoint, engine.storage.auto_checkpoint = engine.storage.auto_checkpoint, False
+    runner = CommandRunner(engine, args.sale_batch)
+    try:
+        if args.command == 'batch':
+            if args.file == '-':
+                runner.run(enumerate(sys.stdin, 1), sys.stdout)
+            else:
+                with open(args.file, 'r', encoding='utf-8') as f:
+                    runner.run(enumerate(f, 1), sys.stdout)
+        else:
+            runner.run([(1, json.dumps(command_from_args(args)))], sys.stdout)
+    finally:
+        engine.storage.auto_checkpoint = auto_checkpoint
+        engine.close()
+    return 1 if runner.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pharmacy Management System. Without a command, runs the "
+                                                 "interactive menu; commands print JSON.")
+    parser.add_argument('--server', help="host:port of a pharmacy_server shared by several tills")
+    commands = parser.add_subparsers(dest='command')
+    batch_parser = commands.add_parser('batch', help="Run JSON commands, one per line")
+    batch_parser.add_argument('file', nargs='?', default='-', help="Command file (default: standard input)")
+    batch_parser.add_argument('--sale-batch', type=int, default=CommandRunner.SALE_BATCH,
+                              help="Sales committed together (1 answers each sale at once)")
+    sale_parser = commands.add_parser('sale', help="Record one sale")
+    sale_parser.add_argument('items', nargs='+', type=parse_item, metavar='CODE[:QUANTITY]')
+    sale_parser.add_argument('--date', help="YYYY-MM-DD HH:MM:SS (default: now)")
+    restock_parser = commands.add_parser('restock', help="Add stock to a product")
+    restock_parser.add_argument('code')
+    restock_parser.add_argument('quantity', type=int)
+    restock_parser.add_argument('--lot', help="Lot number of the delivery")
+    restock_parser.add_argument('--expiry', help="Expiry date of the lot, YYYY-MM-DD")
+    expiring_parser = commands.add_parser('expiring', help="Lots expiring within a number of days")
+    expiring_parser.add_argument('days', type=int, nargs='?', default=30)
+    add_parser = commands.add_parser('add-product', help="Add a new product")
+    add_parser.add_argument('code')
+    add_parser.add_argument('name')
+    add_parser.add_argument('price', type=float)
+    add_parser.add_argument('quantity', type=int)
+    add_parser.add_argument('--barcode')
+    add_parser.add_argument('--reorder-point', type=int)
+    commands.add_parser('products', help="List products")
+    commands.add_parser('low-stock', help="Products below their reorder point")
+    reorder_parser = commands.add_parser('reorder', help="What to order, from the demand forecast")
+    reorder_parser.add_argument('--lead-time', type=int, default=LEAD_TIME, help="Days from order to delivery")
+    reorder_parser.add_argument('--review-days', type=int, default=REVIEW_DAYS, help="Days until the next order")
+    report_parser = commands.add_parser('report', help="Sales totals, optionally for [--from, --to)")
+    report_parser.add_argument('--from', dest='start', help="First day, YYYY-MM-DD")
+    report_parser.add_argument('--to', dest='end', help="Day after the last, YYYY-MM-DD")
+    report_parser.add_argument('--product', help="Only this product (needs --from and --to)")
+    args = parser.parse_args(argv)
+    args.server = args.server or os.environ.get('PHARMACY_SERVER')
+
+    if args.command:
+        if args.command != 'batch':
+            args.sale_batch = 1
+        return run_batch(args)
 
-def main():
-    system = PharmacySystem()
+    system = PharmacySystem(args.server)
     
     while True:
         print("\n=== Pharmacy Management System ===")
@@ -149,9 +463,11 @@ def main():
         print("3. Make Sale")
         print("4. Check Stock")
         print("5. View Sales Report")
-        print("6. Exit")
+        print("6. Sales by Date Range")
+        print("7. Purchase Suggestions")
+        print("8. Exit")
 
-        choice = input("\nEnter your choice (1-6): ")
+        choice = input("\nEnter your choice (1-8): ")
 
         if choice == '1':
             system.add_product()
@@ -164,10 +480,15 @@ def main():
         elif choice == '5':
             system.view_sales_report()
         elif choice == '6':
+            system.view_range_report()
+        elif choice == '7':
+            system.view_purchase_suggestions()
+        elif choice == '8':
+            system.engine.close()
             print("\nThank you for using Pharmacy Management System!")
             break
         else:
             print("\nInvalid choice! Please try again.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file
@@ -0,0 +1,199 @@
+from bisect import bisect_right
+from pharmacy_metrics import metrics
+
+ROW_HEIGHT = 22
+HEADING_HEIGHT = 25
+
+
+class VirtualTree:
+    # Windowed view model behind a ttk.Treeview. The model holds the keys of
+    # every row (filtered and sorted in plain Python); only the rows in the
+    # visible window exist as Treeview items, and scrolling rewrites their
+    # values in place. Changes are applied as diffs: append() adds one row
+    # and update() touches one row, instead of rebuilding the widget.
+    #
+    # row_values(key) returns the tuple shown for a row, sort_value(key,
+    # column) the value used to sort on a column and match_text(key) the
+    # lowercase text a filter is matched against.
+
+    def __init__(self, tree, scrollbar, row_values, sort_value=None, match_text=None):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_values = row_values
+        self.sort_value = sort_value or self.default_sort_value
+        self.match_text = match_text or (lambda key: ' '.join(str(value) for value in row_values(key)).lower())
+        self.columns = list(tree['columns'])
+        self.keys = []
+        self.view = []
+        self.offset = 0
+        self.visible = int(tree.cget('height'))
+        self.slots = []
+        self.rendered = {}
+        self.sort_column = None
+        self.sort_reverse = False
+        self.sort_values = []
+        self.filter_text = ''
+        self.rows_rendered = 0
+
+        scrollbar.configure(command=self.yview)
+        tree.configure(yscrollcommand='')
+        tree.bind('<Configure>', self.on_resize)
+        tree.bind('<MouseWheel>', lambda event: self.scroll(-1 if event.delta > 0 else 1, 'units'))
+        tree.bind('<Button-4>', lambda event: self.scroll(-1, 'units'))
+        tree.bind('<Button-5>', lambda event: self.scroll(1, 'units'))
+        for column in self.columns:
+            tree.heading(column, command=lambda column=column: self.sort_by(column))
+
+    def default_sort_value(self, key, column):
+        return self.row_values(key)[self.columns.index(column)]
+
+    # Model changes
+
+    def set_keys(self, keys):
+        self.keys = list(keys)
+        self.rebuild_view()
+
+    def append(self, key):
+        self.keys.append(key)
+        if not self.matches(key):
+            return
+        if self.sort_column is None:
+            # Keep following the tail if the end of the list was in view
+            at_end = self.offset + self.visible >= len(self.view)
+            self.view.append(key)
+            index = len(self.view) - 1
+            if at_end:
+                self.offset = max(0, len(self.view) - self.visible)
+        else:
+            index = self.insert_sorted(key)
+
+        if index < self.offset + self.visible:
+            self.render()
+        else:
+            self.update_scrollbar()
+
+    def update(self, key):
+        # A row's values changed; only its row is rewritten when visible
+        if self.sort_column is None:
+            if key in self.rendered:
+                self.tree.item(self.rendered[key], values=self.row_values(key))
+                self.rows_rendered += 1
+                metrics.count('rows_rendered')
+            return
+
+        # In a sorted view the row may have to move
+        was_visible = key in self.rendered
+        self.remove_sorted(key)
+        index = self.insert_sorted(key) if self.matches(key) else -1
+        if was_visible or self.offset <= index < self.offset + self.visible:
+            self.render()
+
+    def sort_by(self, column):
+        if self.sort_column == column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_column = column
+            self.sort_reverse = False
+        self.rebuild_view()
+
+    def set_filter(self, text):
+        self.filter_text = text.strip().lower()
+        self.rebuild_view()
+
+    # Internal helpers
+
+    def matches(self, key):
+        return not self.filter_text or self.filter_text in self.match_text(key)
+
+    def rebuild_view(self):
+        self.view = [key for key in self.keys if self.matches(key)]
+        self.sort_values = []
+        if self.sort_column is not None:
+            self.view.sort(key=lambda key: self.sort_value(key, self.sort_column), reverse=self.sort_reverse)
+            self.sort_values = [self.ordered_value(key) for key in self.view]
+        self.offset = 0
+        self.render()
+
+    def ordered_value(self, key):
+        # Sort value mapped so the list is always ascending, for bisect
+        value = self.sort_value(key, self.sort_column)
+        if self.sort_reverse:
+            return Reversed(value)
+        return value
+
+    def insert_sorted(self, key):
+        value = self.ordered_value(key)
+        index = bisect_right(self.sort_values, value)
+        self.sort_values.insert(index, value)
+        self.view.insert(index, key)
+        return index
+
+    def remove_sorted(self, key):
+        # The stored sort value may be stale, so look the key up directly
+        try:
+            index = self.view.index(key)
+        except ValueError:
+            return
+        del self.view[index]
+        del self.sort_values[index]
+
+    def on_resize(self, event):
+        visible = max(1, (event.height - HEADING_HEIGHT) // ROW_HEIGHT)
+        if visible != self.visible:
+            self.visible = visible
+            self.render()
+
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * len(self.view)))
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]), args[2])
+
+    def scroll(self, amount, what):
+        step = self.visible if what == 'pages' else 1
+        self.scroll_to(self.offset + amount * step)
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, len(self.view) - self.visible))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def render(self):
+        # Reuse the visible slots, creating or deleting only the difference
+        self.offset = max(0, min(self.offset, len(self.view) - self.visible))
+        window = self.view[self.offset:self.offset + self.visible]
+        while len(self.slots) < len(window):
+            self.slots.append(self.tree.insert('', 'end'))
+        while len(self.slots) > len(window):
+            self.tree.delete(self.slots.pop())
+
+        self.rendered = {}
+        for slot, key in zip(self.slots, window):
+            self.tree.item(slot, values=self.row_values(key))
+            self.rendered[key] = slot
+        self.rows_rendered += len(window)
+        metrics.count('rows_rendered', len(window))
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        if not self.view:
+            self.scrollbar.set(0, 1)
+            return
+        first = self.offset / len(self.view)
+        last = min(1, (self.offset + self.visible) / len(self.view))
+        self.scrollbar.set(first, last)
+
+
+class Reversed:
+    # Inverts ordering so descending sorts can use bisect on ascending lists
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from pharmacy_storage import JSONStorage
+from pharmacy_core import SalesEngine
+from pharmacy_bulk import BulkImport
+
+
+class BulkImportBadRowsTest(unittest.TestCase):
+    # Bad rows are reported one by one; the rest of the file still goes in
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = JSONStorage(os.path.join(self.directory, 'data'))
+        self.engine = SalesEngine(self.storage)
+        self.engine.add_product('P1', 'Paracetamol 500mg', 2.5, 100)
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def run_import(self, kind, name, text):
+        return BulkImport(self.engine, kind, self.write(name, text)).run()
+
+    def test_sale_items_that_are_not_objects(self):
+        good = {'id': 'S2', 'date': '2024-01-05 10:00:00',
+                'items': [{'code': 'P1', 'quantity': 1, 'price': 2.5}]}
+        job = self.run_import('sales', 'sales.jsonl', '\n'.join([
+            json.dumps({'id': 'S1', 'date': '2024-01-05 09:00:00', 'items': ['P1']}),
+            json.dumps(good)]) + '\n')
+        self.assertEqual(job.applied, 1)
+        self.assertEqual([number for number, _ in job.errors], [1])
+
+    def test_non_finite_sale_numbers(self):
+        lines = [
+            '{"id": "S1", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": Infinity}]}',
+            '{"id": "S2", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": NaN}]}',
+            '{"id": "S3", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": 1, "price": 1e400}]}',
+            '{"id": "S4", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": 1, "price": NaN}]}',
+            '{"id": "S5", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": 1e400}]}',
+            '{"id": "S6", "date": "2024-01-05 09:00:00", "items": [{"code": "P1", "quantity": 2}]}',
+        ]
+        job = self.run_import('sales', 'sales.jsonl', '\n'.join(lines) + '\n')
+        self.assertEqual(job.applied, 1)
+        self.assertEqual([number for number, _ in job.errors], [1, 2, 3, 4, 5])
+
+    def test_non_finite_csv_numbers(self):
+        job = self.run_import('products', 'products.csv',
+                              'code,name,price,quantity\n'
+                              'P2,Ibuprofen,inf,5\n'
+                              'P3,Cetirizine,nan,5\n'
+                              'P4,Loratadine,1.5,1e400\n'
+                              'P5,Omeprazole,3.0,5\n')
+        self.assertEqual(job.applied, 1)
+        self.assertEqual([number for number, _ in job.errors], [2, 3, 4])
+        job = self.run_import('stock', 'stock.csv', 'code,quantity\nP1,inf\nP1,-inf\nP1,5\n')
+        self.assertEqual(job.applied, 1)
+        self.assertEqual(self.engine.products['P1']['quantity'], 105)
+
+
+if __name__ == '__main__':
+    unittest.main()